@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Compare the time taken to copy a file into docstore and hash it, before and
+after we started computing the checksum while copying.
+
+Usage: python benchmarks/copy_and_hash.py [MAX_SIZE_MB]
+
+This creates test files of 1 MB, 16 MB, 128 MB, ... up to MAX_SIZE_MB
+(default 2048) in a temporary directory.  Results depend heavily on whether
+the file is already in the page cache; the test files are freshly written,
+so these numbers are closer to a "warm" import.
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from docstore.documents import sha256
+from docstore.file_normalisation import normalised_filename_copy_with_checksum
+
+
+def old_copy_and_hash(src, dst):
+    with open(dst, "xb") as out_file:
+        with open(src, "rb") as infile:
+            shutil.copyfileobj(infile, out_file)
+
+    h = hashlib.sha256()
+    with open(dst, "rb") as infile:
+        for byte_block in iter(lambda: infile.read(4096), b""):
+            h.update(byte_block)
+
+    return os.stat(dst).st_size, "sha256:%s" % h.hexdigest()
+
+
+def new_copy_and_hash(src, dst):
+    _, size, checksum = normalised_filename_copy_with_checksum(src=src, dst=dst)
+    return size, checksum
+
+
+def best_of(fn, tmp_dir, repeat=3):
+    def run():
+        dst = os.path.join(tmp_dir, "dst.bin")
+        try:
+            return fn(dst)
+        finally:
+            os.unlink(dst)
+
+    return min(timeit.repeat(run, number=1, repeat=repeat))
+
+
+if __name__ == "__main__":
+    try:
+        max_size_mb = int(sys.argv[1])
+    except IndexError:
+        max_size_mb = 2048
+
+    sizes_mb = [s for s in (1, 16, 128, 512, 2048) if s <= max_size_mb]
+
+    print("   size      before     after   sha256()")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size_mb in sizes_mb:
+            src = os.path.join(tmp_dir, "src.bin")
+
+            with open(src, "wb") as out_file:
+                for _ in range(size_mb):
+                    out_file.write(os.urandom(1024 * 1024))
+
+            assert old_copy_and_hash(
+                src, os.path.join(tmp_dir, "a.bin")
+            ) == new_copy_and_hash(src, os.path.join(tmp_dir, "b.bin"))
+            os.unlink(os.path.join(tmp_dir, "a.bin"))
+            os.unlink(os.path.join(tmp_dir, "b.bin"))
+
+            before = best_of(lambda dst: old_copy_and_hash(src, dst), tmp_dir)
+            after = best_of(lambda dst: new_copy_and_hash(src, dst), tmp_dir)
+            hash_only = min(timeit.repeat(lambda: sha256(src), number=1, repeat=3))
+
+            print(
+                "%5d MB  %8.3fs  %8.3fs  %8.3fs" % (size_mb, before, after, hash_only)
+            )
+
+            os.unlink(src)
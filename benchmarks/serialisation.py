@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Compare the speed of loading/saving a docstore database with the old
+cattrs-based serialisation and the dedicated codec in docstore.models.
+
+Usage: python benchmarks/serialisation.py [DOCUMENT_COUNT]
+"""
+
+import datetime
+import json
+import sys
+import timeit
+from typing import List
+
+import cattr
+
+from docstore.models import (
+    DB_SCHEMA,
+    Dimensions,
+    Document,
+    File,
+    Thumbnail,
+    from_json,
+    to_json,
+)
+
+
+def create_documents(count):
+    return [
+        Document(
+            title=f"Statement {i}",
+            tags=["bank:acme", f"year:{2000 + i % 20}", "statement"],
+            files=[
+                File(
+                    filename=f"statement-{i}.pdf",
+                    path=f"files/s/statement-{i}.pdf",
+                    size=123456,
+                    checksum="sha256:" + "0" * 64,
+                    source_url="https://example.org/statements",
+                    thumbnail=Thumbnail(
+                        path=f"thumbnails/s/statement-{i}.pdf.png",
+                        dimensions=Dimensions(width=283, height=400),
+                        tint_color="#1f4e79",
+                    ),
+                )
+            ],
+        )
+        for i in range(count)
+    ]
+
+
+class CattrsEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            return obj.isoformat()
+        else:
+            return super().default(obj)
+
+
+def cattrs_to_json(documents):
+    documents = sorted(documents, key=lambda d: d.date_saved, reverse=True)
+
+    return json.dumps(
+        {
+            "docstore": {
+                "db_schema": DB_SCHEMA,
+                "last_modified": datetime.datetime.now().isoformat(),
+            },
+            "documents": cattr.unstructure(documents),
+        },
+        indent=2,
+        sort_keys=True,
+        cls=CattrsEncoder,
+    )
+
+
+def cattrs_from_json(json_string):
+    parsed_structure = json.loads(json_string)
+    return cattr.structure(parsed_structure["documents"], List[Document])
+
+
+def best_of(fn, repeat=5):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+if __name__ == "__main__":
+    try:
+        count = int(sys.argv[1])
+    except IndexError:
+        count = 20000
+
+    documents = create_documents(count)
+    json_string = to_json(documents)
+
+    assert cattrs_from_json(json_string) == from_json(json_string)
+
+    print(f"{count} documents, {len(json_string) / 1024 / 1024:.1f} MiB of JSON")
+    print("")
+    print("         cattrs    codec")
+    print(
+        "load   %6.3fs  %6.3fs"
+        % (
+            best_of(lambda: cattrs_from_json(json_string)),
+            best_of(lambda: from_json(json_string)),
+        )
+    )
+    print(
+        "save   %6.3fs  %6.3fs"
+        % (
+            best_of(lambda: cattrs_to_json(documents)),
+            best_of(lambda: to_json(documents)),
+        )
+    )
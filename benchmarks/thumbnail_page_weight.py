@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Compare how many bytes of thumbnails a browser downloads for one page of
+the web app, before and after we started serving smaller WebP variants
+with ``srcset``.
+
+Usage: python benchmarks/thumbnail_page_weight.py [DIRECTORY]
+
+This stores every file in DIRECTORY (default: tests/files) in a temporary
+docstore, renders the first page, and picks the image a browser would
+choose from each ``srcset`` at 1x and 2x pixel density.
+"""
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import urllib.parse
+
+import bs4
+
+from docstore.documents import store_new_document
+from docstore.server import create_app
+
+
+def parse_srcset(srcset):
+    """
+    Returns a list of (url, width) tuples from a ``srcset`` attribute.
+    """
+    candidates = []
+
+    for candidate in srcset.split(","):
+        url, width = candidate.split()
+        candidates.append((url, int(width[:-1])))
+
+    return candidates
+
+
+def choose_from_srcset(srcset, *, display_width, density):
+    """
+    Choose the smallest candidate that's at least as wide as the image will
+    be displayed, or the largest if none of them are -- which is roughly
+    what browsers do.
+    """
+    candidates = sorted(parse_srcset(srcset), key=lambda c: c[1])
+
+    for url, width in candidates:
+        if width >= display_width * density:
+            return url
+
+    return candidates[-1][0]
+
+
+def url_size(root, url):
+    path = urllib.parse.urlparse(url).path
+    return os.path.getsize(os.path.join(root, path.lstrip("/")))
+
+
+if __name__ == "__main__":
+    try:
+        directory = sys.argv[1]
+    except IndexError:
+        directory = "tests/files"
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = os.path.join(tmp_dir, "root")
+
+        for name in sorted(os.listdir(directory)):
+            src = os.path.join(directory, name)
+            if not os.path.isfile(src):
+                continue
+
+            shutil.copyfile(src, os.path.join(tmp_dir, name))
+            store_new_document(
+                root=root,
+                path=os.path.join(tmp_dir, name),
+                title=name,
+                tags=[],
+                source_url=None,
+                date_saved=datetime.datetime.now(),
+            )
+
+        app = create_app(root=root, title="", thumbnail_width=200)
+        html = app.test_client().get("/").data
+
+        soup = bs4.BeautifulSoup(html, "html.parser")
+
+        before = 0
+        after = {1: 0, 2: 0}
+
+        for img in soup.find_all("img"):
+            before += url_size(root, img.attrs["src"])
+
+            if img.parent.name != "picture":
+                for density in after:
+                    after[density] += url_size(root, img.attrs["src"])
+                continue
+
+            webp_source = img.parent.find("source", attrs={"type": "image/webp"})
+            display_width = int(webp_source.attrs["sizes"][:-2])
+
+            for density in after:
+                url = choose_from_srcset(
+                    webp_source.attrs["srcset"],
+                    display_width=display_width,
+                    density=density,
+                )
+                after[density] += url_size(root, url)
+
+        print(f"thumbnails on page: {len(soup.find_all('img'))}")
+        print(f"before:             {before:10,d} bytes")
+
+        for density, size in after.items():
+            print(
+                f"after ({density}x):        {size:10,d} bytes  "
+                f"({size / before:.0%} of before)"
+            )
@@ -15,8 +15,8 @@ import sys
 
 import tqdm
 
+from docstore.documents import choose_file_tint_color
 from docstore.git import current_commit
-from docstore.tint_colors import choose_tint_color
 
 OLD_DB_SCHEMA = "v2.1.0"
 NEW_DB_SCHEMA = "v2.2.0"
@@ -34,20 +34,18 @@ if __name__ == "__main__":
     documents = json.load(open(documents_path))
     assert documents["docstore"]["db_schema"] == OLD_DB_SCHEMA
 
-    # Backfill the thumbnail dimensions
+    # Backfill the tint colors.  These are cached by checksum, so if the
+    # migration is interrupted or there are duplicate files, we don't
+    # choose the same tint color twice.
     for doc in tqdm.tqdm(documents["documents"]):
         for f in doc["files"]:
-            tint_color = choose_tint_color(
+            f["thumbnail"]["tint_color"] = choose_file_tint_color(
+                root=root,
                 thumbnail_path=os.path.join(root, f["thumbnail"]["path"]),
                 file_path=os.path.join(root, f["path"]),
+                checksum=f["checksum"],
             )
 
-            hex_tint_color = "#%02x%02x%02x" % tuple(
-                int(component * 255) for component in tint_color
-            )
-
-            f["thumbnail"]["tint_color"] = hex_tint_color
-
     new_output = {
         "docstore": {
             "db_schema": NEW_DB_SCHEMA,
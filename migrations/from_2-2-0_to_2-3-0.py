@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+DB schema migration: v2.2.0 ~> v2.3.0
+
+*   Record smaller/WebP variants on Thumbnail instances, and create them.
+
+This works for both the JSON and SQLite storage engines.
+
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import sys
+
+import attr
+import tqdm
+
+from docstore.documents import create_thumbnail_variants
+from docstore.storage import (
+    SqliteStorage,
+    db_path,
+    get_storage,
+    journal_path,
+    sqlite_path,
+)
+from exceptions import IncorrectSchemaError
+
+OLD_DB_SCHEMA = "v2.2.0"
+NEW_DB_SCHEMA = "v2.3.0"
+
+
+def backup(path):
+    backup_path = path.replace(".", f".{OLD_DB_SCHEMA}.", 1) + ".bak"
+
+    if os.path.exists(backup_path):
+        raise RuntimeError("Have you already started a migration of this version?")
+
+    shutil.copyfile(path, backup_path)
+
+
+def add_empty_variants(doc):
+    for f in doc["files"]:
+        f["thumbnail"]["variants"] = []
+
+
+def upgrade_json(root):
+    # A new instance might only have a journal, and no database yet.
+    if os.path.exists(db_path(root)):
+        with open(db_path(root)) as infile:
+            documents = json.load(infile)
+
+        if documents["docstore"]["db_schema"] != OLD_DB_SCHEMA:
+            raise IncorrectSchemaError(
+                f"The docstore instance at {root} doesn't look like {OLD_DB_SCHEMA}"
+            )
+
+        backup(db_path(root))
+
+        for doc in documents["documents"]:
+            add_empty_variants(doc)
+
+        documents["docstore"]["db_schema"] = NEW_DB_SCHEMA
+
+        with open(db_path(root), "w") as outfile:
+            outfile.write(json.dumps(documents, indent=2, sort_keys=True))
+
+    # Changes in the journal include whole documents, so they need
+    # upgrading too.
+    if os.path.exists(journal_path(root)):
+        backup(journal_path(root))
+
+        with open(journal_path(root)) as infile:
+            records = [json.loads(line) for line in infile if line.endswith("\n")]
+
+        for r in records:
+            if "document" in r:
+                add_empty_variants(r["document"])
+
+        with open(journal_path(root), "w") as outfile:
+            outfile.write("".join(json.dumps(r) + "\n" for r in records))
+
+
+def upgrade_sqlite(root):
+    connection = sqlite3.connect(sqlite_path(root))
+
+    try:
+        (schema,) = connection.execute(
+            "SELECT value FROM docstore WHERE key = 'db_schema'"
+        ).fetchone()
+
+        if schema != OLD_DB_SCHEMA:
+            raise IncorrectSchemaError(
+                f"The docstore instance at {root} doesn't look like {OLD_DB_SCHEMA}"
+            )
+
+        backup(sqlite_path(root))
+
+        with connection:
+            # The new thumbnail_variants table is created when the
+            # database is next opened.
+            connection.execute(
+                "UPDATE docstore SET value = ? WHERE key = 'db_schema'",
+                (NEW_DB_SCHEMA,),
+            )
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    try:
+        root = sys.argv[1]
+    except IndexError:
+        root = "."
+
+    if isinstance(get_storage(root), SqliteStorage):
+        upgrade_sqlite(root)
+    else:
+        upgrade_json(root)
+
+    # Now the database has the new schema, backfill the variants.  They're
+    # made from the existing thumbnails, which may be different from the
+    # ones we'd create today (e.g. the generic icon), so we don't put them
+    # in the artefact cache -- otherwise they'd be reused for a new thumbnail.
+    storage = get_storage(root)
+    documents = storage.read()
+
+    for i, doc in enumerate(tqdm.tqdm(documents)):
+        files = []
+
+        for f in doc.files:
+            variants = create_thumbnail_variants(
+                root=root,
+                thumbnail_path=os.path.join(root, f.thumbnail.path),
+                dimensions=f.thumbnail.dimensions,
+                checksum=None,
+                max_size=400,
+            )
+            files.append(
+                attr.evolve(f, thumbnail=attr.evolve(f.thumbnail, variants=variants))
+            )
+
+        documents[i] = attr.evolve(doc, files=files)
+
+    storage.write(documents)
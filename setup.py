@@ -30,6 +30,7 @@ setuptools.setup(
     package_dir={"": SOURCE},
     url="https://github.com/alexwlchan/docstore",
     install_requires=INSTALL_REQUIRES,
+    extras_require={"fast": ["orjson>=3"]},
     python_requires=">=3.8",
     entry_points={
         "console_scripts": [
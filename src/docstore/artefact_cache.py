@@ -0,0 +1,156 @@
+"""
+A cache of data we derive from stored files, e.g. thumbnails and tint colours.
+
+Creating this data is expensive, and we often create it again from the same
+bytes -- if you store the same file twice, or re-run a migration.  So we
+keep a copy, keyed by the checksum of the original file and the parameters
+of whatever created it.  If you change how something is created, change its
+parameters (e.g. bump a version number), and the old entries won't be used.
+
+The cache is an SQLite database in the root, so it's safe to use from
+several processes at once.  When it gets too big, we throw away the entries
+that were used least recently.
+"""
+
+import os
+import sqlite3
+import time
+
+from docstore.models import dumps, loads
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artefacts (
+    key TEXT PRIMARY KEY,
+    metadata TEXT NOT NULL,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS artefacts_last_used ON artefacts (last_used);
+"""
+
+
+def artefact_cache_path(root):
+    return os.path.join(root, "artefact_cache.sqlite3")
+
+
+class ArtefactCache:
+    def __init__(self, path, *, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.executescript(CACHE_SCHEMA)
+        return conn
+
+    @staticmethod
+    def _key(kind, checksum, params):
+        return f"{kind}:{checksum}:{dumps(params)}"
+
+    def get(self, kind, checksum, params):
+        """
+        Look up an artefact.
+
+        Returns a (metadata, data) tuple, or None if it isn't cached.
+        """
+        key = self._key(kind, checksum, params)
+
+        conn = self._connect()
+
+        try:
+            with conn:
+                row = conn.execute(
+                    "SELECT metadata, data FROM artefacts WHERE key = ?", (key,)
+                ).fetchone()
+
+                if row is None:
+                    return None
+
+                conn.execute(
+                    "UPDATE artefacts SET last_used = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+        finally:
+            conn.close()
+
+        metadata, data = row
+        return loads(metadata), bytes(data)
+
+    def put(self, kind, checksum, params, *, metadata, data=b""):
+        """
+        Store an artefact.  ``metadata`` is anything JSON-serialisable,
+        and ``data`` is an optional blob, e.g. the bytes of a thumbnail.
+        """
+        key = self._key(kind, checksum, params)
+        metadata = dumps(metadata)
+
+        conn = self._connect()
+
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO artefacts (key, metadata, data, size, last_used) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (
+                        key,
+                        metadata,
+                        data,
+                        len(key) + len(metadata) + len(data),
+                        time.time(),
+                    ),
+                )
+
+                self._evict(conn)
+        finally:
+            conn.close()
+
+    def _evict(self, conn):
+        (total_size,) = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM artefacts"
+        ).fetchone()
+
+        if total_size <= self.max_bytes:
+            return
+
+        cursor = conn.execute("SELECT key, size FROM artefacts ORDER BY last_used")
+        evicted = []
+
+        for key, size in cursor:
+            if total_size <= self.max_bytes:
+                break
+
+            evicted.append((key,))
+            total_size -= size
+
+        conn.executemany("DELETE FROM artefacts WHERE key = ?", evicted)
+
+    def get_or_create(self, kind, checksum, params, create):
+        """
+        Look up an artefact, and if it isn't cached, call ``create()`` to
+        make it.  ``create`` should return a (metadata, data) tuple.
+
+        If ``checksum`` is None, we can't cache the artefact, so we always
+        call ``create()``.
+        """
+        if checksum is None:
+            return create()
+
+        cached = self.get(kind, checksum, params)
+
+        if cached is not None:
+            return cached
+
+        metadata, data = create()
+        self.put(kind, checksum, params, metadata=metadata, data=data)
+
+        return metadata, data
+
+
+def get_artefact_cache(root):
+    return ArtefactCache(artefact_cache_path(root))
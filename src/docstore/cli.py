@@ -31,13 +31,13 @@ def _require_existing_instance(inner):
 
     @functools.wraps(inner)
     def wrapper(*args, **kwargs):
-        from docstore.documents import db_path
+        from docstore.documents import database_exists
 
         root = click.get_current_context().obj
 
         if (
             root == "."
-            and not os.path.exists(db_path("."))
+            and not database_exists(".")
             and not any(ag == "--root" or ag.startswith("--root=") for ag in sys.argv)
         ):  # pragma: no cover
             click.echo(
@@ -60,6 +60,23 @@ def _require_existing_instance(inner):
 @click.option(
     "--thumbnail_width", default=200, help="Thumbnail width (px).", show_default=True
 )
+@click.option(
+    "--page_size",
+    default=100,
+    help="How many documents to show on each page.",
+    show_default=True,
+)
+@click.option(
+    "--file_offload",
+    type=click.Choice(["x-sendfile", "x-accel-redirect"]),
+    help="Let a front-end server send stored files, using this header.",
+)
+@click.option(
+    "--accel_redirect_prefix",
+    default="/_docstore/",
+    help="The nginx location that serves the docstore root, for X-Accel-Redirect.",
+    show_default=True,
+)
 @click.option("--debug", default=False, is_flag=True, help="Run in debug mode.")
 @click.option("--profile", default=False, is_flag=True, help="Run a profiler.")
 @click.pass_obj
@@ -72,7 +89,9 @@ def serve(root, debug, profile, **kwargs):  # pragma: no cover
         run_server(root=root, debug=debug, **kwargs)
 
 
-def _add_document(root, path, title, tags, source_url):
+def _add_document(
+    root, path, title, tags, source_url, on_duplicate="store", defer_thumbnail=False
+):
     tags = tags or ""
     tags = [t.strip() for t in tags.split(",") if t.strip()]
 
@@ -87,6 +106,8 @@ def _add_document(root, path, title, tags, source_url):
         tags=tags,
         source_url=source_url,
         date_saved=datetime.datetime.now(),
+        on_duplicate=on_duplicate,
+        defer_thumbnail=defer_thumbnail,
     )
 
     print(document.id)
@@ -107,14 +128,199 @@ def _add_document(root, path, title, tags, source_url):
     prompt="How should the file be tagged?",
 )
 @click.option("--source_url", help="Where was this file downloaded from?.")
+@click.option(
+    "--on_duplicate",
+    type=click.Choice(["store", "skip", "attach", "hardlink"]),
+    default="store",
+    help="What to do with a file that's identical to one already stored.",
+    show_default=True,
+)
+@click.option(
+    "--defer_thumbnail",
+    is_flag=True,
+    help="Use a placeholder thumbnail, and leave `docstore worker` to create the real one.",
+)
 @click.pass_obj
 @_require_existing_instance
-def add(root, path, title, tags, source_url):
+def add(root, path, title, tags, source_url, on_duplicate, defer_thumbnail):
     return _add_document(
-        root=root, path=path, title=title, tags=tags, source_url=source_url
+        root=root,
+        path=path,
+        title=title,
+        tags=tags,
+        source_url=source_url,
+        on_duplicate=on_duplicate,
+        defer_thumbnail=defer_thumbnail,
     )
 
 
+@main.command(
+    help="Store every file in a directory, or every file listed in a manifest. "
+    "A manifest is a CSV or JSON Lines file with a 'path' for each file, "
+    "and optionally a 'title', 'tags' and 'source_url'."
+)
+@click.argument("source", nargs=1, type=click.Path(exists=True), required=True)
+@click.option(
+    "--tags",
+    help="Tags to apply to every file, if SOURCE is a directory.",
+    default="",
+)
+@click.option(
+    "--workers",
+    type=int,
+    help="How many files to process in parallel.  [default: CPU count]",
+)
+@click.option(
+    "--batch_size",
+    default=100,
+    help="How many documents to record in each database write.",
+    show_default=True,
+)
+@click.option(
+    "--on_duplicate",
+    type=click.Choice(["store", "skip", "attach", "hardlink"]),
+    default="store",
+    help="What to do with a file that's identical to one already stored.",
+    show_default=True,
+)
+@click.option(
+    "--defer_thumbnails",
+    is_flag=True,
+    help="Use placeholder thumbnails, and leave `docstore worker` to create the real ones.",
+)
+@click.pass_obj
+@_require_existing_instance
+def add_many(root, source, tags, workers, batch_size, on_duplicate, defer_thumbnails):
+    from docstore.ingest import (
+        entries_from_directory,
+        read_manifest,
+        store_many_documents,
+    )
+
+    if os.path.isdir(source):
+        tags = [t.strip() for t in tags.split(",") if t.strip()]
+        entries = entries_from_directory(source, tags=tags)
+    else:
+        entries = read_manifest(source)
+
+    failures = 0
+    duplicates = 0
+
+    for result in store_many_documents(
+        root,
+        entries,
+        workers=workers,
+        batch_size=batch_size,
+        on_duplicate=on_duplicate,
+        defer_thumbnails=defer_thumbnails,
+    ):
+        if result.error is not None:
+            click.echo(
+                f"Unable to store {result.entry['path']}: {result.error}", err=True
+            )
+            failures += 1
+        elif result.duplicate_of is not None:
+            click.echo(
+                f"{result.entry['path']} is a duplicate of {result.duplicate_of.id}",
+                err=True,
+            )
+            duplicates += 1
+            if on_duplicate != "skip":
+                print(result.document.id)
+        else:
+            print(result.document.id)
+
+    if duplicates:
+        click.echo(
+            f"Found {duplicates} duplicate{'s' if duplicates > 1 else ''}", err=True
+        )
+
+    if failures:
+        sys.exit(f"Unable to store {failures} file{'s' if failures > 1 else ''}")
+
+
+@main.command(help="Create thumbnails for files stored with --defer_thumbnail")
+@click.option(
+    "--workers",
+    type=int,
+    help="How many thumbnails to create in parallel.  [default: CPU count]",
+)
+@click.option(
+    "--batch_size",
+    default=100,
+    help="How many thumbnails to record in each database write.",
+    show_default=True,
+)
+@click.option("--once", is_flag=True, help="Stop once the queue is empty.")
+@click.pass_obj
+@_require_existing_instance
+def worker(root, workers, batch_size, once):
+    import time
+    from docstore.ingest import create_queued_thumbnails
+    from docstore.job_queue import thumbnail_queue
+
+    queue = thumbnail_queue(root)
+
+    while True:
+        if len(queue):
+            for result in create_queued_thumbnails(
+                root, workers=workers, batch_size=batch_size
+            ):
+                if result.error is not None:
+                    click.echo(
+                        f"Unable to create thumbnail for {result.file_id}: {result.error}",
+                        err=True,
+                    )
+                elif result.thumbnail is not None:
+                    print(result.file_id)
+
+        if once:
+            break
+
+        time.sleep(5)  # pragma: no cover
+
+
+@main.command(help="Re-create the thumbnails for every stored file")
+@click.option(
+    "--max_size",
+    default=400,
+    help="The maximum width or height of each thumbnail (px).",
+    show_default=True,
+)
+@click.option(
+    "--workers",
+    type=int,
+    help="How many thumbnails to create in parallel.  [default: CPU count]",
+)
+@click.option(
+    "--batch_size",
+    default=100,
+    help="How many thumbnails to record in each database write.",
+    show_default=True,
+)
+@click.pass_obj
+@_require_existing_instance
+def regenerate_thumbnails(root, max_size, workers, batch_size):
+    from docstore.ingest import regenerate_thumbnails
+
+    failures = 0
+
+    for result in regenerate_thumbnails(
+        root, max_size=max_size, workers=workers, batch_size=batch_size
+    ):
+        if result.error is not None:
+            click.echo(
+                f"Unable to create thumbnail for {result.file_id}: {result.error}",
+                err=True,
+            )
+            failures += 1
+        else:
+            print(result.file_id)
+
+    if failures:
+        sys.exit(f"Unable to create {failures} thumbnail{'s' if failures > 1 else ''}")
+
+
 @main.command(help="Store a file on the web in docstore")
 @click.option(
     "--url", help="URL of the file to store.", type=click.Path(), required=True
@@ -143,68 +349,188 @@ def add_from_url(root, url, title, tags, source_url):  # pragma: no cover
 )
 @click.pass_obj
 def migrate(root, v1_path):  # pragma: no cover
-    documents = json.load(open(os.path.join(v1_path, "documents.json")))
+    from docstore.documents import get_store, store_new_document
 
-    for _, doc in documents.items():
-        stored_file_path = os.path.join(v1_path, "files", doc["file_identifier"])
+    documents = json.load(open(os.path.join(v1_path, "documents.json")))
 
-        try:
-            filename_path = os.path.join(v1_path, "files", doc["filename"])
-        except KeyError:
-            filename_path = stored_file_path
+    # Record all the migrated documents in a single write, rather than
+    # rewriting the database once per document.
+    with get_store(root).transaction() as tx:
+        for _, doc in documents.items():
+            stored_file_path = os.path.join(v1_path, "files", doc["file_identifier"])
 
-        if os.path.exists(stored_file_path):
-            os.rename(stored_file_path, filename_path)
+            try:
+                filename_path = os.path.join(v1_path, "files", doc["filename"])
+            except KeyError:
+                filename_path = stored_file_path
 
-            from docstore.documents import store_new_document
+            if os.path.exists(stored_file_path):
+                os.rename(stored_file_path, filename_path)
 
-            store_new_document(
-                root=root,
-                path=filename_path,
-                title=doc.get("title", ""),
-                tags=doc.get("tags", []),
-                source_url=doc.get("user_data", {}).get("source_url", ""),
-                date_saved=datetime.datetime.fromisoformat(doc["date_created"]),
-            )
-            print(doc.get("filename", os.path.basename(doc["file_identifier"])))
+                store_new_document(
+                    root=root,
+                    path=filename_path,
+                    title=doc.get("title", ""),
+                    tags=doc.get("tags", []),
+                    source_url=doc.get("user_data", {}).get("source_url", ""),
+                    date_saved=datetime.datetime.fromisoformat(doc["date_created"]),
+                    transaction=tx,
+                )
+                print(doc.get("filename", os.path.basename(doc["file_identifier"])))
 
 
 @main.command(help="Delete one or more documents")
 @click.argument("doc_ids", nargs=-1)
 @click.pass_obj
 def delete(root, doc_ids):
-    from docstore.documents import db_path, delete_document
+    from docstore.documents import database_exists, get_store
 
-    if not os.path.exists(db_path(root)):
+    if not database_exists(root):
         sys.exit(f"There is no docstore instance at {root}!")
 
+    with get_store(root).transaction() as tx:
+        for d_id in doc_ids:
+            tx.delete(d_id)
+
     for d_id in doc_ids:
-        delete_document(root=root, doc_id=d_id)
         print(d_id)
 
 
+@main.command(help="Fold the change journal back into the database")
+@click.pass_obj
+def compact(root):
+    from docstore.documents import compact_documents, database_exists
+
+    if not database_exists(root):
+        sys.exit(f"There is no docstore instance at {root}!")
+
+    compact_documents(root)
+
+
+@main.command(help="Convert the database to a different storage engine")
+@click.option(
+    "--to",
+    "engine",
+    type=click.Choice(["json", "sqlite"]),
+    required=True,
+    help="The storage engine to convert to.",
+)
+@click.pass_obj
+def convert(root, engine):
+    from docstore.documents import database_exists
+    from docstore.storage import convert_storage
+
+    if not database_exists(root):
+        sys.exit(f"There is no docstore instance at {root}!")
+
+    try:
+        convert_storage(root, engine=engine)
+    except (ValueError, FileExistsError) as err:
+        sys.exit(str(err))
+
+
+def _parse_percentage(ctx, param, value):
+    if value is None:
+        return None
+
+    try:
+        percentage = float(value.rstrip("%"))
+    except ValueError:
+        raise click.BadParameter(f"{value!r} is not a percentage")
+
+    if not 0 < percentage <= 100:
+        raise click.BadParameter(f"{value!r} is not between 0% and 100%")
+
+    return percentage
+
+
 @main.command(help="Verify your stored files")
+@click.option("--workers", type=int, help="How many files to hash at once.")
+@click.option(
+    "--changed-only",
+    is_flag=True,
+    help="Skip files that haven't changed since they were last verified.",
+)
+@click.option(
+    "--sample",
+    callback=_parse_percentage,
+    help="Only verify a percentage of files, chosen at random, e.g. 10%.",
+)
 @click.pass_obj
-def verify(root):
-    import collections
-    from docstore.documents import read_documents, sha256
+def verify(root, workers, changed_only, sample):
+    from docstore.documents import read_documents
+    from docstore.verification import choose_files, verify_files
     import tqdm
 
-    errors = collections.defaultdict(list)
-
-    for doc in tqdm.tqdm(list(read_documents(root))):
-        for f in doc.files:
-            f_path = os.path.join(root, f.path)
-            if f.size != os.stat(f_path).st_size:
-                errors[f.id].append(f"Size mismatch\n  actual   = {os.stat(f_path).st_size}\n  expected = {f.size}")
+    files = choose_files(
+        root, read_documents(root), changed_only=changed_only, sample=sample
+    )
 
-            if f.checksum != sha256(f_path):
-                errors[f.id].append(f"Checksum mismatch\n  actual   = {sha256(f_path)}\n  expected = {f.checksum}")
+    with tqdm.tqdm(total=len(files)) as progress_bar:
+        errors = verify_files(
+            root, files, workers=workers, progress=progress_bar.update
+        )
 
     from pprint import pprint
+
     pprint(errors)
 
 
+def _parse_byte_size(ctx, param, value):
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+    try:
+        if value[-1].upper() in units:
+            return int(float(value[:-1]) * units[value[-1].upper()])
+        else:
+            return int(value)
+    except (IndexError, ValueError):
+        raise click.BadParameter(f"{value!r} is not a size, e.g. 500K or 20M")
+
+
+@main.command(help="Continuously re-verify your stored files in the background")
+@click.option(
+    "--bytes_per_second",
+    default="10M",
+    callback=_parse_byte_size,
+    help="How quickly to read files, e.g. 500K or 20M.",
+    show_default=True,
+)
+@click.option("--once", is_flag=True, help="Stop after checking every file once.")
+@click.pass_obj
+def scrub(root, bytes_per_second, once):
+    import time
+    from docstore.documents import get_store
+    from docstore.verification import scrub, scrub_coverage
+
+    while True:
+        checked = 0
+
+        for f, errors in scrub(root, bytes_per_second=bytes_per_second):
+            checked += 1
+
+            for e in errors:
+                click.echo(f"{f.path}: {e}", err=True)
+
+        coverage = scrub_coverage(
+            root,
+            get_store(root).snapshot().documents,
+            now=datetime.datetime.now(),
+            window=datetime.timedelta(days=7),
+        )
+        click.echo(
+            f"Checked {checked} files; {coverage.ratio:.1%} of the store "
+            f"checked in the last week, {coverage.failed_files} failing"
+        )
+
+        if once:
+            break
+
+        # If there's nothing to check, don't spin.
+        if checked == 0:  # pragma: no cover
+            time.sleep(60)
+
+
 @main.command(help="Merge the files on two documents")
 @click.argument("doc_ids", nargs=-1)
 @click.option("--yes", is_flag=True, help="Skip confirmation prompts.")
@@ -213,9 +539,9 @@ def merge(root, doc_ids, yes):
     if len(doc_ids) == 1:
         return
 
-    from docstore.documents import read_documents
+    from docstore.documents import get_store
 
-    documents = {d.id: d for d in read_documents(root)}
+    documents = get_store(root).snapshot().documents_by_id
 
     documents_to_merge = [documents[d_id] for d_id in doc_ids]
 
@@ -260,14 +586,13 @@ def merge(root, doc_ids, yes):
         else:  # pragma: no cover
             new_tags = click.edit("\n".join(all_tags)).strip().splitlines()
 
-    from docstore.documents import pairwise_merge_documents
-
-    doc1 = documents[doc_ids[0]]
-    for doc2_id in doc_ids[1:]:
-        doc2 = documents[doc2_id]
-        doc1 = pairwise_merge_documents(
-            root=root, doc1=doc1, doc2=doc2, new_title=new_title, new_tags=new_tags
-        )
+    with get_store(root).transaction() as tx:
+        doc1 = documents[doc_ids[0]]
+        for doc2_id in doc_ids[1:]:
+            doc2 = documents[doc2_id]
+            doc1 = tx.merge(
+                doc1=doc1, doc2=doc2, new_title=new_title, new_tags=new_tags
+            )
 
 
 def find_similar_pairs(tags, *, required_similarity=80):
@@ -296,15 +621,10 @@ def find_similar_pairs(tags, *, required_similarity=80):
 @main.command(help="Show tags that might be similar")
 @click.pass_obj
 def show_similar_tags(root):
-    import collections
-    from docstore.documents import read_documents
-
-    documents = read_documents(root)
-    tags = collections.Counter()
+    from docstore.documents import get_store
 
-    for doc in documents:
-        for t in doc.tags:
-            tags[t] += 1
+    positions_by_tag = get_store(root).snapshot().document_positions_by_tag
+    tags = {t: len(positions) for t, positions in positions_by_tag.items()}
 
     for t1, t2 in find_similar_pairs(set(tags)):
         print("%3d %s" % (tags[t1], t1))
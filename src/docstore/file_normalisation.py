@@ -1,9 +1,40 @@
+import hashlib
 import os
 import secrets
-import shutil
 
 from docstore.text_utils import slugify
 
+# Reading files in big chunks makes a noticeable difference to how quickly
+# we can copy and hash large files (e.g. scans and videos).
+BUFFER_SIZE = 1024 * 1024
+
+
+def _copy_and_hash(infile, out_file):
+    """
+    Copy ``infile`` to ``out_file``, and return the size and SHA-256 checksum
+    of the data copied.
+
+    This only reads the file once, rather than reading it once to copy it
+    and again to hash it.
+    """
+    h = hashlib.sha256()
+    size = 0
+
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+
+    while True:
+        bytes_read = infile.readinto(buf)
+        if not bytes_read:
+            break
+
+        chunk = view[:bytes_read]
+        out_file.write(chunk)
+        h.update(chunk)
+        size += bytes_read
+
+    return size, "sha256:%s" % h.hexdigest()
+
 
 def normalised_filename_copy(*, src, dst):
     """
@@ -24,6 +55,15 @@ def normalised_filename_copy(*, src, dst):
 
     Returns the name of the final file.
 
+    """
+    out_path, _, _ = normalised_filename_copy_with_checksum(src=src, dst=dst)
+    return out_path
+
+
+def _candidate_paths(dst):
+    """
+    Generates normalised paths for ``dst``: first the plain normalised name,
+    then names with a random suffix.
     """
     out_dir, filename = os.path.split(dst)
 
@@ -32,14 +72,55 @@ def normalised_filename_copy(*, src, dst):
     name, ext = os.path.splitext(filename)
     name = slugify(name)
 
-    out_path = os.path.join(out_dir, name + ext)
+    yield os.path.join(out_dir, name + ext)
 
     while True:
+        yield os.path.join(out_dir, name + "_" + secrets.token_hex(2) + ext)
+
+
+def normalised_filename_copy_with_checksum(*, src, dst):
+    """
+    Copies a file from ``src`` to ``dst``, like ``normalised_filename_copy``.
+
+    Returns a tuple (name of the final file, size, SHA-256 checksum), which
+    are computed as the file is copied.
+    """
+    # Open the source first, so a missing or unreadable source doesn't
+    # leave an empty file behind.
+    with open(src, "rb") as infile:
+        for out_path in _candidate_paths(dst):
+            try:
+                out_file = open(out_path, "xb")
+            except FileExistsError:
+                continue
+
+            # If the copy fails halfway, don't leave a partial file behind.
+            try:
+                with out_file:
+                    size, checksum = _copy_and_hash(infile, out_file)
+            except BaseException:
+                os.unlink(out_path)
+                raise
+
+            return out_path, size, checksum
+
+
+def normalised_filename_link(*, src, dst):
+    """
+    Creates a hard link to ``src`` at ``dst``, using the same normalisation
+    rules as ``normalised_filename_copy``.
+
+    If the file can't be hard linked (e.g. because ``dst`` is on a different
+    filesystem), it's copied instead.
+
+    Returns the name of the final file.
+    """
+    for out_path in _candidate_paths(dst):
         try:
-            with open(out_path, "xb") as out_file:
-                with open(src, "rb") as infile:
-                    shutil.copyfileobj(infile, out_file)
+            os.link(src, out_path)
         except FileExistsError:
-            out_path = os.path.join(out_dir, name + "_" + secrets.token_hex(2) + ext)
+            continue
+        except OSError:
+            return normalised_filename_copy(src=src, dst=dst)
         else:
             return out_path
@@ -0,0 +1,478 @@
+"""
+Store lots of files at once.
+
+Storing a file is dominated by the per-file work -- copying it, creating
+a thumbnail, choosing a tint colour, hashing it -- and that work doesn't
+touch the database, so we can spread it across a pool of processes.
+The new documents are then recorded in batches, one write per batch.
+"""
+
+import concurrent.futures
+import csv
+import datetime
+import functools
+import json
+import os
+
+import attr
+
+from docstore.documents import (
+    DUPLICATE_POLICIES,
+    add_prepared_document,
+    create_file_thumbnail,
+    get_store,
+    prepare_new_document,
+    record_duplicate_document,
+    sha256,
+    thumbnail_paths,
+)
+from docstore.job_queue import thumbnail_queue
+from docstore.storage import read_json, write_json
+from docstore.thumbnails import THUMBNAIL_VARIANTS, THUMBNAIL_VERSION
+from docstore.tint_colors import TINT_COLOR_VERSION
+
+
+def _parse_tags(tags):
+    if isinstance(tags, str):
+        tags = tags.split(",")
+
+    return [t.strip() for t in tags or [] if t.strip()]
+
+
+def read_manifest(path):
+    """
+    Read a list of files to store from a CSV or JSON Lines manifest.
+
+    Each entry has a ``path`` and, optionally, a ``title``, ``tags`` and
+    ``source_url``.  Tags can be a list, or a comma-separated string.
+    Relative paths are resolved relative to the manifest.
+    """
+    if path.endswith(".csv"):
+        with open(path, newline="", encoding="utf8") as infile:
+            rows = list(csv.DictReader(infile))
+    elif path.endswith((".jsonl", ".ndjson")):
+        with open(path, encoding="utf8") as infile:
+            rows = [json.loads(line) for line in infile if line.strip()]
+    else:
+        raise ValueError(f"Unrecognised manifest format: {path}")
+
+    manifest_dir = os.path.dirname(os.path.abspath(path))
+
+    return [
+        {
+            "path": os.path.join(manifest_dir, r["path"]),
+            "title": r.get("title") or "",
+            "tags": _parse_tags(r.get("tags")),
+            "source_url": r.get("source_url") or None,
+        }
+        for r in rows
+    ]
+
+
+def entries_from_directory(directory, *, tags):
+    """
+    Create a list of files to store from every file in a directory.
+
+    Each file is titled with its name, minus the extension.
+    """
+    return [
+        {
+            "path": os.path.join(directory, name),
+            "title": os.path.splitext(name)[0],
+            "tags": list(tags),
+            "source_url": None,
+        }
+        for name in sorted(os.listdir(directory))
+        if not name.startswith(".") and os.path.isfile(os.path.join(directory, name))
+    ]
+
+
+@attr.s
+class IngestResult:
+    """
+    What happened to a single file in ``store_many_documents``.
+
+    If the file was stored, ``document`` is the document that now holds it.
+    If it was identical to a file that was already stored, ``duplicate_of``
+    is the document with the original copy.  If something went wrong,
+    ``error`` is the exception.
+    """
+
+    entry = attr.ib()
+    document = attr.ib(default=None)
+    duplicate_of = attr.ib(default=None)
+    error = attr.ib(default=None)
+
+
+def _try_sha256(path):
+    # If we can't read the file, we'll report the error when we try to
+    # store it, along with any other errors.
+    try:
+        return sha256(path)
+    except OSError:
+        return None
+
+
+def _prepare(root, entry, date_saved, defer_thumbnail):
+    return prepare_new_document(
+        root=root, date_saved=date_saved, defer_thumbnail=defer_thumbnail, **entry
+    )
+
+
+def _record(
+    tx, *, root, entry, checksum, future, date_saved, on_duplicate, defer_thumbnail
+):
+    if future is not None:
+        document = future.result()
+        add_prepared_document(
+            tx, document=document, path=entry["path"], defer_thumbnail=defer_thumbnail
+        )
+        return IngestResult(entry=entry, document=document)
+
+    # We didn't prepare this file because it looked like a duplicate; check
+    # that's still true.  If not (e.g. because the original failed to store),
+    # store it now.
+    existing = tx.find_duplicate(checksum)
+
+    if existing is None:
+        document = _prepare(root, entry, date_saved, defer_thumbnail)
+        add_prepared_document(
+            tx, document=document, path=entry["path"], defer_thumbnail=defer_thumbnail
+        )
+        return IngestResult(entry=entry, document=document)
+
+    document = record_duplicate_document(
+        tx,
+        root=root,
+        date_saved=date_saved,
+        existing=existing,
+        on_duplicate=on_duplicate,
+        **entry,
+    )
+
+    return IngestResult(entry=entry, document=document, duplicate_of=existing[0])
+
+
+def store_many_documents(
+    root,
+    entries,
+    *,
+    workers=None,
+    batch_size=100,
+    on_duplicate="store",
+    defer_thumbnails=False,
+):
+    """
+    Store every file described in ``entries``.
+
+    The per-file work runs in a pool of ``workers`` processes, and the
+    new documents are recorded in batches of ``batch_size``.  If the
+    import is interrupted, every complete batch has already been saved.
+
+    Unless ``on_duplicate`` is "store", every file is hashed first, and
+    files that are already stored -- or that appear earlier in ``entries`` --
+    skip the expensive per-file work.  See ``DUPLICATE_POLICIES``.
+
+    If ``defer_thumbnails`` is True, files get a placeholder thumbnail, and
+    the real thumbnails are created later by ``create_queued_thumbnails``.
+
+    Generates an IngestResult for every entry.
+    """
+    if on_duplicate not in DUPLICATE_POLICIES:
+        raise ValueError(f"Unrecognised duplicate policy: {on_duplicate}")
+
+    date_saved = datetime.datetime.now()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        if on_duplicate == "store":
+            checksums = [None for _ in entries]
+            is_duplicate = [False for _ in entries]
+        else:
+            checksums = list(executor.map(_try_sha256, [e["path"] for e in entries]))
+
+            stored_checksums = get_store(root).snapshot().files_by_checksum
+            seen_checksums = set()
+            is_duplicate = []
+
+            for c in checksums:
+                is_duplicate.append(
+                    c is not None and (c in stored_checksums or c in seen_checksums)
+                )
+                seen_checksums.add(c)
+
+        # Submit all the work up front, so the workers stay busy while
+        # we're writing each batch to the database.
+        futures = [
+            (
+                None
+                if dup
+                else executor.submit(
+                    _prepare, root, entry, date_saved, defer_thumbnails
+                )
+            )
+            for entry, dup in zip(entries, is_duplicate)
+        ]
+
+        try:
+            for batch_start in range(0, len(entries), batch_size):
+                batch_end = batch_start + batch_size
+                batch = zip(
+                    entries[batch_start:batch_end],
+                    checksums[batch_start:batch_end],
+                    futures[batch_start:batch_end],
+                )
+
+                results = []
+
+                with get_store(root).transaction() as tx:
+                    for entry, checksum, fut in batch:
+                        try:
+                            result = _record(
+                                tx,
+                                root=root,
+                                entry=entry,
+                                checksum=checksum,
+                                future=fut,
+                                date_saved=date_saved,
+                                on_duplicate=on_duplicate,
+                                defer_thumbnail=defer_thumbnails,
+                            )
+                        except Exception as err:
+                            result = IngestResult(entry=entry, error=err)
+
+                        results.append(result)
+
+                yield from results
+        finally:
+            for fut in futures:
+                if fut is not None:
+                    fut.cancel()
+
+
+@attr.s
+class ThumbnailResult:
+    """
+    What happened to a single job in ``create_queued_thumbnails``.
+
+    If the file was deleted before we got to it, ``thumbnail`` is None.
+    If something went wrong, ``error`` is the exception, and the job
+    stays in the queue.
+    """
+
+    file_id = attr.ib()
+    thumbnail = attr.ib(default=None)
+    error = attr.ib(default=None)
+
+
+def _create_queued_thumbnail(root, job):
+    return create_file_thumbnail(
+        root=root,
+        file_path=os.path.join(root, job["path"]),
+        checksum=job.get("checksum"),
+    )
+
+
+def _remove_thumbnail(root, thumbnail, *, keep=None):
+    """
+    Delete the files that make up ``thumbnail``, except any that are
+    also used by the thumbnail ``keep``.
+    """
+    keep_paths = set(thumbnail_paths(keep)) if keep is not None else set()
+
+    for path in thumbnail_paths(thumbnail):
+        if path in keep_paths:
+            continue
+
+        try:
+            os.unlink(os.path.join(root, path))
+        except FileNotFoundError:
+            pass
+
+
+def create_queued_thumbnails(root, *, workers=None, batch_size=100):
+    """
+    Create the real thumbnails for files that were stored with a placeholder.
+
+    The thumbnails are created in a pool of ``workers`` processes, and
+    recorded in batches of ``batch_size``, one write per batch.  Each job
+    is removed from the queue once its thumbnail has been recorded.
+
+    Generates a ThumbnailResult for every queued file that is still stored.
+    """
+    queue = thumbnail_queue(root)
+    stored_files = get_store(root).snapshot().documents_by_file_id
+
+    jobs = []
+
+    # Jobs are only queued after a file is stored, so if we can't find the
+    # file, it's been deleted and there's nothing to do.
+    for job_id, job in queue.jobs():
+        if job["file_id"] in stored_files:
+            jobs.append((job_id, job))
+        else:
+            queue.remove(job_id)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_create_queued_thumbnail, root, job) for _, job in jobs
+        ]
+
+        try:
+            for batch_start in range(0, len(jobs), batch_size):
+                batch_end = batch_start + batch_size
+                batch = zip(jobs[batch_start:batch_end], futures[batch_start:batch_end])
+
+                results = []
+                finished = []
+
+                for (job_id, job), fut in batch:
+                    try:
+                        finished.append((job_id, job, fut.result()))
+                    except Exception as err:
+                        results.append(ThumbnailResult(job["file_id"], error=err))
+
+                # Wait for the whole batch before we start the transaction,
+                # so it's working from an up-to-date copy of the database.
+                with get_store(root).transaction() as tx:
+                    for job_id, job, thumbnail in finished:
+                        try:
+                            old_thumbnail = tx.set_thumbnail(
+                                job["file_id"], thumbnail=thumbnail
+                            )
+                        except KeyError:
+                            # The file was deleted while it was in the queue
+                            _remove_thumbnail(root, thumbnail)
+                            queue.remove(job_id)
+                            results.append(ThumbnailResult(job["file_id"]))
+                            continue
+
+                        tx.call_after_commit(
+                            functools.partial(
+                                _remove_thumbnail, root, old_thumbnail, keep=thumbnail
+                            )
+                        )
+
+                        tx.call_after_commit(functools.partial(queue.remove, job_id))
+                        results.append(ThumbnailResult(job["file_id"], thumbnail))
+
+                yield from results
+        finally:
+            for fut in futures:
+                fut.cancel()
+
+
+def thumbnail_state_path(root):
+    return os.path.join(root, "thumbnail_state.json")
+
+
+def _read_thumbnail_state(root):
+    return read_json(thumbnail_state_path(root))
+
+
+def _write_thumbnail_state(root, state):
+    write_json(thumbnail_state_path(root), state)
+
+
+def _regenerate_thumbnail(root, f, max_size):
+    return create_file_thumbnail(
+        root=root,
+        file_path=os.path.join(root, f.path),
+        checksum=f.checksum,
+        max_size=max_size,
+    )
+
+
+def regenerate_thumbnails(root, *, max_size=400, workers=None, batch_size=100):
+    """
+    Re-create the thumbnail and choose the tint colour of every stored file,
+    e.g. after changing the thumbnail size.
+
+    We remember the checksum and parameters each thumbnail was created
+    with, and skip files where neither has changed.  That's saved after
+    every batch, so if this is interrupted, the next run carries on from
+    where it stopped.  Thumbnails created before we started remembering
+    are regenerated once, but that's cheap if they're in the artefact cache.
+
+    The thumbnails are created in a pool of ``workers`` processes, and
+    recorded in batches of ``batch_size``, one write per batch.
+
+    Generates a ThumbnailResult for every file that was regenerated.
+    """
+    params = {
+        "max_size": max_size,
+        "thumbnail_version": THUMBNAIL_VERSION,
+        "tint_color_version": TINT_COLOR_VERSION,
+        "variants": [list(v) for v in THUMBNAIL_VARIANTS],
+    }
+
+    documents = get_store(root).snapshot().documents
+    files_by_id = {f.id: f for doc in documents for f in doc.files}
+
+    # Forget about files that have been deleted since we last looked.
+    state = {
+        file_id: file_state
+        for file_id, file_state in _read_thumbnail_state(root).items()
+        if file_id in files_by_id
+    }
+
+    stale_files = [
+        f
+        for f in files_by_id.values()
+        if state.get(f.id) != {"checksum": f.checksum, "params": params}
+    ]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_regenerate_thumbnail, root, f, max_size)
+            for f in stale_files
+        ]
+
+        try:
+            for batch_start in range(0, len(stale_files), batch_size):
+                batch_end = batch_start + batch_size
+                batch = zip(
+                    stale_files[batch_start:batch_end],
+                    futures[batch_start:batch_end],
+                )
+
+                results = []
+                finished = []
+
+                for f, fut in batch:
+                    try:
+                        finished.append((f, fut.result()))
+                    except Exception as err:
+                        results.append(ThumbnailResult(f.id, error=err))
+
+                # As in create_queued_thumbnails, only start the transaction
+                # once the whole batch is ready.
+                with get_store(root).transaction() as tx:
+                    for f, thumbnail in finished:
+                        try:
+                            old_thumbnail = tx.set_thumbnail(f.id, thumbnail=thumbnail)
+                        except KeyError:
+                            # The file was deleted while we were working
+                            _remove_thumbnail(root, thumbnail)
+                            continue
+
+                        tx.call_after_commit(
+                            functools.partial(
+                                _remove_thumbnail, root, old_thumbnail, keep=thumbnail
+                            )
+                        )
+
+                        results.append(ThumbnailResult(f.id, thumbnail))
+
+                for r in results:
+                    if r.error is None:
+                        state[r.file_id] = {
+                            "checksum": files_by_id[r.file_id].checksum,
+                            "params": params,
+                        }
+
+                _write_thumbnail_state(root, state)
+
+                yield from results
+        finally:
+            for fut in futures:
+                fut.cancel()
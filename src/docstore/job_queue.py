@@ -0,0 +1,81 @@
+"""
+A simple persistent queue of jobs, for work we want to do in the background.
+
+Each job is a JSON file in the queue directory, so the queue survives
+restarts, and adding a job is safe to do from many processes at once.
+A job is only removed once it's been done successfully.
+"""
+
+import os
+
+import attr
+
+from docstore.models import dumps, loads
+
+
+@attr.s
+class JobQueue:
+    path = attr.ib()
+
+    def _job_path(self, job_id):
+        return os.path.join(self.path, f"{job_id}.json")
+
+    def put(self, job_id, job):
+        """
+        Add a job to the queue.  If there's already a job with this ID,
+        it's replaced.
+        """
+        os.makedirs(self.path, exist_ok=True)
+
+        tmp_path = self._job_path(job_id) + ".tmp"
+
+        with open(tmp_path, "w", encoding="utf8") as out_file:
+            out_file.write(dumps(job))
+
+        os.replace(tmp_path, self._job_path(job_id))
+
+    def jobs(self):
+        """
+        Returns a list of (job_id, job) tuples, oldest first.
+        """
+        try:
+            entries = [
+                entry for entry in os.scandir(self.path) if entry.name.endswith(".json")
+            ]
+        except FileNotFoundError:
+            return []
+
+        entries.sort(key=lambda entry: (entry.stat().st_mtime_ns, entry.name))
+
+        result = []
+
+        for entry in entries:
+            try:
+                with open(entry.path, encoding="utf8") as infile:
+                    job = loads(infile.read())
+            except FileNotFoundError:  # pragma: no cover
+                # Somebody else finished this job while we were looking
+                continue
+
+            result.append((entry.name[: -len(".json")], job))
+
+        return result
+
+    def remove(self, job_id):
+        try:
+            os.unlink(self._job_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        try:
+            return sum(1 for name in os.listdir(self.path) if name.endswith(".json"))
+        except FileNotFoundError:
+            return 0
+
+
+def thumbnail_queue(root):
+    """
+    Files whose thumbnail and tint colour haven't been created yet.
+    """
+    return JobQueue(os.path.join(root, "queue", "thumbnails"))
@@ -1,15 +1,18 @@
 import datetime
 import json
-from typing import List
 import uuid
 
 import attr
-import cattr
 
 from docstore.git import current_commit
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
 
-DB_SCHEMA = "v2.2.0"
+
+DB_SCHEMA = "v2.3.0"
 
 
 def _convert_to_datetime(d):
@@ -33,6 +36,12 @@ def _convert_to_dimensions(d):
         return Dimensions(**d)
 
 
+def _convert_to_variants(v_list):
+    return [
+        v if isinstance(v, ThumbnailVariant) else ThumbnailVariant(**v) for v in v_list
+    ]
+
+
 def _convert_to_file(f_list):
     return [f if isinstance(f, File) else File(**f) for f in f_list]
 
@@ -43,11 +52,24 @@ class Dimensions:
     height = attr.ib(type=int)
 
 
+@attr.s
+class ThumbnailVariant:
+    """
+    A smaller or better-compressed copy of a thumbnail, which browsers can
+    choose instead of the original (e.g. a 200px WebP).
+    """
+
+    path = attr.ib(type=str)
+    dimensions = attr.ib(type=Dimensions, converter=_convert_to_dimensions)
+    media_type = attr.ib(type=str)
+
+
 @attr.s
 class Thumbnail:
     path = attr.ib(type=str)
     dimensions = attr.ib(type=Dimensions, converter=_convert_to_dimensions)
     tint_color = attr.ib(type=str)
+    variants = attr.ib(factory=list, converter=_convert_to_variants)
 
 
 @attr.s
@@ -71,12 +93,132 @@ class Document:
     files = attr.ib(factory=list, converter=_convert_to_file)
 
 
-class DocstoreEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime.datetime):
-            return obj.isoformat()
-        else:  # pragma: no cover
-            return super().default(obj)
+# These functions convert models to/from the plain dicts we store as JSON.
+#
+# We used to use cattrs for this, but its generic dispatch was the bulk of
+# the time spent loading a big database -- building the models directly is
+# several times faster.  See benchmarks/serialisation.py.
+
+
+def _dimensions_from_dict(d):
+    return Dimensions(width=d["width"], height=d["height"])
+
+
+def thumbnail_from_dict(t):
+    """
+    Creates a Thumbnail from a dict, as created by ``thumbnail_to_dict``.
+    """
+    return Thumbnail(
+        path=t["path"],
+        dimensions=_dimensions_from_dict(t["dimensions"]),
+        tint_color=t["tint_color"],
+        variants=[
+            ThumbnailVariant(
+                path=v["path"],
+                dimensions=_dimensions_from_dict(v["dimensions"]),
+                media_type=v["media_type"],
+            )
+            for v in t["variants"]
+        ],
+    )
+
+
+def _file_from_dict(f):
+    return File(
+        id=f["id"],
+        filename=f["filename"],
+        path=f["path"],
+        size=f["size"],
+        checksum=f["checksum"],
+        thumbnail=thumbnail_from_dict(f["thumbnail"]),
+        source_url=f.get("source_url"),
+        date_saved=datetime.datetime.fromisoformat(f["date_saved"]),
+    )
+
+
+def document_from_dict(d):
+    """
+    Creates a Document from a dict, as created by ``document_to_dict``.
+    """
+    return Document(
+        id=d["id"],
+        title=d["title"],
+        date_saved=datetime.datetime.fromisoformat(d["date_saved"]),
+        tags=d["tags"],
+        files=[_file_from_dict(f) for f in d["files"]],
+    )
+
+
+def _dimensions_to_dict(d):
+    return {"width": d.width, "height": d.height}
+
+
+def thumbnail_to_dict(t):
+    """
+    Returns a dict representation of a Thumbnail that can be serialised as JSON.
+    """
+    return {
+        "path": t.path,
+        "dimensions": _dimensions_to_dict(t.dimensions),
+        "tint_color": t.tint_color,
+        "variants": [
+            {
+                "path": v.path,
+                "dimensions": _dimensions_to_dict(v.dimensions),
+                "media_type": v.media_type,
+            }
+            for v in t.variants
+        ],
+    }
+
+
+def _file_to_dict(f):
+    return {
+        "id": f.id,
+        "filename": f.filename,
+        "path": f.path,
+        "size": f.size,
+        "checksum": f.checksum,
+        "thumbnail": thumbnail_to_dict(f.thumbnail),
+        "source_url": f.source_url,
+        "date_saved": f.date_saved.isoformat(),
+    }
+
+
+def document_to_dict(doc):
+    """
+    Returns a dict representation of a Document that can be serialised as JSON.
+    """
+    return {
+        "id": doc.id,
+        "title": doc.title,
+        "date_saved": doc.date_saved.isoformat(),
+        "tags": list(doc.tags),
+        "files": [_file_to_dict(f) for f in doc.files],
+    }
+
+
+def dumps(value, *, indent=False):
+    """
+    Serialise ``value`` as a JSON string, using orjson if it's installed.
+
+    Keys are always sorted, so the output is stable.
+    """
+    if orjson is not None:
+        option = orjson.OPT_SORT_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(value, option=option).decode("utf8")
+    else:  # pragma: no cover
+        return json.dumps(value, indent=2 if indent else None, sort_keys=True)
+
+
+def loads(json_string):
+    """
+    Parse a JSON string, using orjson if it's installed.
+    """
+    if orjson is not None:
+        return orjson.loads(json_string)
+    else:  # pragma: no cover
+        return json.loads(json_string)
 
 
 def to_json(documents):
@@ -92,18 +234,16 @@ def to_json(documents):
     # function goes faster if the documents are already in the right order.
     documents = sorted(documents, key=lambda d: d.date_saved, reverse=True)
 
-    return json.dumps(
+    return dumps(
         {
             "docstore": {
                 "db_schema": DB_SCHEMA,
                 "commit": current_commit(),
                 "last_modified": datetime.datetime.now().isoformat(),
             },
-            "documents": cattr.unstructure(documents),
+            "documents": [document_to_dict(d) for d in documents],
         },
-        indent=2,
-        sort_keys=True,
-        cls=DocstoreEncoder,
+        indent=True,
     )
 
 
@@ -111,6 +251,6 @@ def from_json(json_string):
     """
     Parses a JSON string containing all the documents.
     """
-    parsed_structure = json.loads(json_string)
+    parsed_structure = loads(json_string)
     assert parsed_structure["docstore"]["db_schema"] == DB_SCHEMA
-    return cattr.structure(parsed_structure["documents"], List[Document])
+    return [document_from_dict(d) for d in parsed_structure["documents"]]
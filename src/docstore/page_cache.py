@@ -0,0 +1,76 @@
+"""
+A cache of rendered pages, for the web app.
+
+Most visits are to the same handful of pages -- the front page, and a few
+favourite tags -- and rendering them means filtering, tallying and running
+the templates again, even if nothing has changed.  So we keep the HTML of
+recently rendered pages, keyed by the version of the database they were
+rendered from.  When the database changes, the whole cache is thrown away.
+
+Pages include relative dates like "3 minutes ago", so entries also expire
+after ``max_age`` seconds, even if the database hasn't changed.
+"""
+
+import collections
+import threading
+import time
+
+DEFAULT_MAX_ENTRIES = 256
+
+DEFAULT_MAX_AGE = 60
+
+
+class PageCache:
+    def __init__(self, *, max_entries=DEFAULT_MAX_ENTRIES, max_age=DEFAULT_MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+        self._version = None
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        # Callers must hold the lock
+        if version != self._version:
+            if self._entries:
+                self.stats["invalidations"] += 1
+
+            self._entries.clear()
+            self._version = version
+
+    def get(self, version, key):
+        """
+        Returns the page cached for ``key`` at this database version,
+        or None if there isn't one.
+        """
+        with self._lock:
+            self._check_version(version)
+
+            try:
+                created_at, page = self._entries[key]
+            except KeyError:
+                self.stats["misses"] += 1
+                return None
+
+            if time.monotonic() - created_at > self.max_age:
+                del self._entries[key]
+                self.stats["misses"] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return page
+
+    def put(self, version, key, page):
+        with self._lock:
+            self._check_version(version)
+
+            self._entries[key] = (time.monotonic(), page)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
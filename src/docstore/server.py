@@ -1,14 +1,15 @@
-import collections
 import datetime
 import functools
 import hashlib
 import os
 import secrets
+import time
 import urllib.parse
 from urllib.parse import parse_qsl, urlparse, urlencode
 
 from flask import (
     Flask,
+    abort,
     make_response,
     render_template,
     request,
@@ -17,12 +18,16 @@ from flask import (
 )
 import hyperlink
 import smartypants
+from werkzeug.http import is_resource_modified
 from werkzeug.middleware.profiler import ProfilerMiddleware
 
-from docstore.documents import find_original_filename, read_documents
+from docstore.documents import find_stored_file, get_store
+from docstore.page_cache import PageCache
+from docstore.storage import get_storage, last_modified as storage_last_modified
 from docstore.tag_cloud import TagCloud
 from docstore.tag_list import render_tag_list
 from docstore.text_utils import hostname, pretty_date
+from docstore.verification import scrub_coverage
 
 
 def tags_with_prefix(document, prefix):
@@ -33,12 +38,103 @@ def tags_without_prefix(document, prefix):
     return [t for t in document.tags if not t.startswith(prefix)]
 
 
+def thumbnail_url(f, image=None):
+    """
+    Returns the URL of the thumbnail of a stored file, or of one of its
+    variants if ``image`` is given.
+
+    Thumbnails are cached forever, but a path can be reused -- e.g. if you
+    delete "cat.pdf" and store a different "cat.pdf" -- so the URL includes
+    a version derived from the file's checksum and the size of the image.
+    """
+    if image is None:
+        image = f.thumbnail
+
+    version = hashlib.sha256(
+        f"{f.checksum}:{image.dimensions.width}x{image.dimensions.height}".encode()
+    ).hexdigest()[:8]
+
+    return f"/{image.path}?v={version}"
+
+
+def thumbnail_srcset(f, media_type):
+    """
+    Returns a ``srcset`` attribute listing every copy of a file's thumbnail
+    in the given format, so the browser can pick the smallest one that
+    looks sharp at the size it's displayed.
+    """
+    candidates = [v for v in f.thumbnail.variants if v.media_type == media_type]
+
+    # The thumbnail itself is a PNG, and the fallback for browsers that
+    # can't use any of the variants.
+    if media_type == "image/png":
+        candidates.append(f.thumbnail)
+
+    return ", ".join(f"{thumbnail_url(f, c)} {c.dimensions.width}w" for c in candidates)
+
+
 def url_without_sortby(u):
     url = hyperlink.URL.from_text(u)
-    return str(url.remove("sortBy"))
 
+    # The ``after`` cursor only makes sense in the order it came from
+    return str(url.remove("sortBy").remove("after"))
+
+
+# Thumbnail URLs change whenever the thumbnail does (see ``thumbnail_url``),
+# so browsers can keep them for as long as they like.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+# Pages show relative dates like "3 minutes ago", so a page can change even
+# if the database doesn't.  We treat every page as changed at the start of
+# each interval, so browsers don't keep showing stale dates.
+PAGE_VALIDATOR_INTERVAL = 60
+
+
+def page_validators(*, version, cache_key, db_last_modified, now):
+    """
+    Returns an (ETag, Last-Modified) pair for a page of the web app.
+
+    These only depend on the database version, the URL and the time, so we
+    can answer a conditional request without looking at the documents.
+    """
+    interval_start = now - now % PAGE_VALIDATOR_INTERVAL
+
+    etag = hashlib.sha256(
+        repr((version, cache_key, interval_start)).encode("utf8")
+    ).hexdigest()[:16]
+
+    last_modified = datetime.datetime.fromtimestamp(
+        max(db_last_modified or 0, interval_start), tz=datetime.timezone.utc
+    )
+
+    return etag, last_modified
+
+
+def _index_response(html, *, etag, last_modified, status=200):
+    response = make_response(html, status)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+
+    # Browsers should always check with us before reusing a page -- which
+    # is cheap, because we answer with a 304 if nothing's changed.
+    response.cache_control.no_cache = True
 
-def serve_file(*, root, shard, filename):
+    return response
+
+
+# Ways to hand the work of sending a file to a front-end server:
+#
+#   - "x-sendfile" -- for Apache with mod_xsendfile, or lighttpd
+#   - "x-accel-redirect" -- for nginx, with an internal location that
+#     serves the docstore root at ``accel_redirect_prefix``
+#
+FILE_OFFLOAD_MODES = ("x-sendfile", "x-accel-redirect")
+
+
+def serve_file(
+    *, root, shard, filename, offload=None, accel_redirect_prefix="/_docstore/"
+):
     """
     Serves a file which has been saved in docstore.
 
@@ -46,23 +142,69 @@ def serve_file(*, root, shard, filename):
     are downloaded with the original filename they were uploaded as,
     rather than the normalised filename.
 
+    The ETag is the checksum we recorded when the file was stored, so we
+    don't have to hash the file to answer a conditional request.
+
+    Range requests get a 206 Partial Content response.  If the WSGI server
+    provides a ``wsgi.file_wrapper`` (e.g. gunicorn), it sends whole files
+    with sendfile(), so the bytes never pass through Python.  If ``offload``
+    is set, we don't send the file at all -- we tell the front-end server
+    which file to send, and it handles Range requests itself.
+
     """
     path = os.path.abspath(os.path.join(root, "files", shard, filename))
-    response = make_response(send_file(path))
 
-    original_filename = find_original_filename(root, path=path)
+    try:
+        stored_file = find_stored_file(root, path=path)
+    except ValueError:
+        abort(404)
+
+    _, checksum = stored_file.checksum.split(":", 1)
+
+    if offload is None:
+        response = make_response(send_file(path, etag=checksum, conditional=True))
+    elif request.if_none_match.contains(checksum):
+        response = make_response("", 304)
+        response.set_etag(checksum)
+    elif offload == "x-sendfile":
+        response = make_response("")
+        response.headers["X-Sendfile"] = path
+        response.set_etag(checksum)
+    elif offload == "x-accel-redirect":
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = urllib.parse.quote(
+            f"{accel_redirect_prefix.rstrip('/')}/files/{shard}/{filename}"
+        )
+        response.set_etag(checksum)
+    else:  # pragma: no cover
+        raise ValueError(f"Unrecognised file offload mode: {offload}")
+
+    # The front-end server sets the right Content-Type for the file it sends
+    if offload is not None:
+        del response.headers["Content-Type"]
 
     # See https://stackoverflow.com/a/49481671/1558022 for UTF-8 encoding
-    encoded_filename = urllib.parse.quote(original_filename, encoding="utf-8")
+    encoded_filename = urllib.parse.quote(stored_file.filename, encoding="utf-8")
     response.headers["Content-Disposition"] = f"filename*=utf-8''{encoded_filename}"
 
     return response
 
 
-def create_app(title, root, thumbnail_width):
+def create_app(
+    title,
+    root,
+    thumbnail_width,
+    page_size=100,
+    file_offload=None,
+    accel_redirect_prefix="/_docstore/",
+):
     app = Flask(__name__)
 
     app.config["THUMBNAIL_WIDTH"] = thumbnail_width
+    app.config["PAGE_SIZE"] = page_size
+
+    page_cache = PageCache()
+    app.config["PAGE_CACHE"] = page_cache
 
     app.jinja_env.trim_blocks = True
     app.jinja_env.lstrip_blocks = True
@@ -77,18 +219,12 @@ def create_app(title, root, thumbnail_width):
 
     app.jinja_env.filters["tags_with_prefix"] = tags_with_prefix
     app.jinja_env.filters["tags_without_prefix"] = tags_without_prefix
+    app.jinja_env.filters["thumbnail_srcset"] = thumbnail_srcset
+    app.jinja_env.filters["thumbnail_url"] = thumbnail_url
 
     @app.route("/")
     def list_documents():
         request_tags = set(request.args.getlist("tag"))
-        documents = [
-            doc for doc in read_documents(root) if request_tags.issubset(set(doc.tags))
-        ]
-
-        tag_tally = collections.Counter()
-        for doc in documents:
-            for t in doc.tags:
-                tag_tally[t] += 1
 
         try:
             page = int(request.args["page"])
@@ -97,76 +233,185 @@ def create_app(title, root, thumbnail_width):
 
         sort_by = request.args.get("sortBy", "date (newest first)")
 
+        # Read the modification time before the snapshot, so if the database
+        # changes in between, we understate the Last-Modified date rather
+        # than claim the snapshot includes a change it doesn't.
+        db_last_modified = storage_last_modified(get_storage(root))
+        snapshot = get_store(root).snapshot()
+
+        # Random pages are different every time, so there's no point caching
+        # them.  Otherwise, the page only depends on the database and the URL.
+        if sort_by == "random":
+            cache_key = None
+        else:
+            cache_key = (
+                request.base_url,
+                tuple(sorted(request.args.items(multi=True))),
+            )
+
+            etag, last_modified = page_validators(
+                version=snapshot.version,
+                cache_key=cache_key,
+                db_last_modified=db_last_modified,
+                now=time.time(),
+            )
+
+            if not is_resource_modified(
+                request.environ, etag=etag, last_modified=last_modified
+            ):
+                return _index_response(
+                    "", status=304, etag=etag, last_modified=last_modified
+                )
+
+            html = page_cache.get(snapshot.version, cache_key)
+
+            if html is not None:
+                return _index_response(html, etag=etag, last_modified=last_modified)
+
         if sort_by.startswith("date"):
-            sort_key = lambda d: d.date_saved
+            order = snapshot.sort_order(
+                "date_saved", reverse=sort_by == "date (newest first)"
+            )
         elif sort_by.startswith("title"):
-            sort_key = lambda d: d.title.lower()
+            order = snapshot.sort_order("title", reverse=sort_by == "title (Z to A)")
         elif sort_by == "random":
             if page == 1:
                 app.config["_RANDOM_SEED"] = secrets.token_bytes()
-            seed = app.config["_RANDOM_SEED"]
-
-            def sort_key(d):
-                h = hashlib.md5()
-                h.update(d.id.encode("utf8"))
-                h.update(seed)
-                return h.hexdigest()
+            order = snapshot.random_order(app.config["_RANDOM_SEED"])
         else:
             raise ValueError(f"Unrecognised sortBy query parameter: {sort_by}")
 
-        if sort_by in {"date (newest first)", "title (Z to A)"}:
-            sort_reverse = True
-        else:
-            sort_reverse = False
+        page_size = app.config["PAGE_SIZE"]
+
+        documents, total_documents = snapshot.page_of_documents(
+            request_tags,
+            order=order,
+            page_size=page_size,
+            offset=(page - 1) * page_size,
+            after=request.args.get("after"),
+        )
+
+        page_start = (page - 1) * page_size + 1
+        page_end = page_start + len(documents) - 1
 
         html = render_template(
             "index.html",
-            documents=sorted(documents, key=sort_key, reverse=sort_reverse),
+            documents=documents,
+            total_documents=total_documents,
+            page_start=page_start,
+            page_end=page_end,
             request_tags=request_tags,
             query_string=tuple(parse_qsl(urlparse(request.url).query)),
-            tag_tally=tag_tally,
+            tag_tally=snapshot.tag_tally(request_tags),
             title=title,
             page=page,
             sort_by=sort_by,
             TagCloud=TagCloud,
         )
 
-        return html
+        if cache_key is None:
+            return html
+
+        page_cache.put(snapshot.version, cache_key, html)
+
+        return _index_response(html, etag=etag, last_modified=last_modified)
 
     @app.route("/thumbnails/<shard>/<filename>")
     def thumbnails(shard, filename):
-        return send_from_directory(
-            os.path.abspath(os.path.join(root, "thumbnails", shard)), filename
+        # A new thumbnail always gets a new path, so browsers never need
+        # to check whether a thumbnail has changed.
+        response = send_from_directory(
+            os.path.abspath(os.path.join(root, "thumbnails", shard)),
+            filename,
+            max_age=IMMUTABLE_MAX_AGE,
         )
+        response.cache_control.immutable = True
+        return response
 
     app.add_url_rule(
         rule="/files/<shard>/<filename>",
         view_func=lambda shard, filename: serve_file(
-            root=root, shard=shard, filename=filename
+            root=root,
+            shard=shard,
+            filename=filename,
+            offload=file_offload,
+            accel_redirect_prefix=accel_redirect_prefix,
         ),
     )
 
+    @app.route("/metrics")
+    def metrics():
+        """
+        Some numbers about this instance, in the Prometheus text format.
+        """
+        store = get_store(root)
+        coverage = scrub_coverage(
+            root,
+            store.snapshot().documents,
+            now=datetime.datetime.now(),
+            window=datetime.timedelta(days=7),
+        )
+
+        if coverage.oldest_check is None:
+            oldest_check = 0
+        else:
+            oldest_check = coverage.oldest_check.timestamp()
+
+        lines = (
+            [
+                f"docstore_files {coverage.total_files}",
+                f"docstore_bytes {coverage.total_bytes}",
+                f"docstore_scrub_checked_files {coverage.checked_files}",
+                f"docstore_scrub_checked_bytes {coverage.checked_bytes}",
+                f"docstore_scrub_coverage_ratio {coverage.ratio}",
+                f"docstore_scrub_failed_files {coverage.failed_files}",
+                f"docstore_scrub_oldest_check_timestamp_seconds {oldest_check}",
+            ]
+            + [
+                f"docstore_snapshot_{name}_total {value}"
+                for name, value in sorted(store.stats.items())
+            ]
+            + [
+                f"docstore_page_cache_{name}_total {value}"
+                for name, value in sorted(page_cache.stats.items())
+            ]
+        )
+
+        response = make_response("\n".join(lines) + "\n")
+        response.headers["Content-Type"] = "text/plain; version=0.0.4"
+        return response
+
     @app.template_filter("add_tag")
     @functools.lru_cache()
     def add_tag(query_string, tag):
         return "?" + urlencode(
-            [(k, v) for k, v in query_string if k != "page"] + [("tag", tag)]
+            [(k, v) for k, v in query_string if k not in {"page", "after"}]
+            + [("tag", tag)]
         )
 
     @app.template_filter("remove_tag")
     def remove_tag(query_string, tag):
         return "?" + urlencode(
-            [(k, v) for k, v in query_string if (k, v) != ("tag", tag)]
+            [(k, v) for k, v in query_string if (k, v) != ("tag", tag) and k != "after"]
         )
 
     @app.template_filter("set_page")
     @functools.lru_cache()
-    def set_page(query_string, page):
-        pageless_qs = [(k, v) for k, v in query_string if k != "page"]
+    def set_page(query_string, page, after=None):
+        """
+        Link to a page of documents.  If ``after`` is the ID of the last
+        document on the current page, the next page starts right after it
+        (a cursor), so we don't have to count our way through every
+        earlier page -- and nothing is skipped or repeated if documents
+        are added in the meantime.
+        """
+        pageless_qs = [(k, v) for k, v in query_string if k not in {"page", "after"}]
         if page == 1:
             return "?" + urlencode(pageless_qs)
-        else:
+        elif after is None:
             return "?" + urlencode(pageless_qs + [("page", page)])
+        else:
+            return "?" + urlencode(pageless_qs + [("page", page), ("after", after)])
 
     return app
 
@@ -0,0 +1,831 @@
+"""
+Storage engines for the docstore database.
+
+A docstore instance keeps its metadata in one of two formats:
+
+-   ``documents.json``, a single JSON file with a journal of recent changes
+    alongside it.  This is the default, and easy to read/edit by hand.
+-   ``documents.sqlite3``, a SQLite database with indexes on tags, dates,
+    checksums and file paths.  This scales to much bigger libraries.
+
+Which engine is used is decided per-root, based on which file exists;
+see ``get_storage``.  Both engines expose the same interface:
+
+-   ``exists()`` -- is there a database at this root?
+-   ``version()`` -- a cheap, hashable value that changes whenever the
+    database changes, so callers can cache the result of ``read()``
+-   ``read()`` -- returns a list of all the documents
+-   ``write(documents)`` -- replaces the database with these documents
+-   ``apply(changes)`` -- applies a list of changes, as created by
+    ``add_change``, ``update_change``, ``delete_change`` and
+    ``thumbnail_change``
+-   ``compact()`` -- tidies up the on-disk representation
+
+"""
+
+import contextlib
+import fcntl
+import os
+import pickle
+import sqlite3
+
+import attr
+
+from docstore.models import (
+    DB_SCHEMA,
+    Dimensions,
+    Document,
+    File,
+    Thumbnail,
+    ThumbnailVariant,
+    document_from_dict,
+    document_to_dict,
+    dumps,
+    from_json,
+    loads,
+    thumbnail_from_dict,
+    thumbnail_to_dict,
+    to_json,
+)
+
+
+def add_change(doc):
+    return {"op": "add", "document": doc}
+
+
+def update_change(doc):
+    return {"op": "update", "document": doc}
+
+
+def delete_change(doc_id):
+    return {"op": "delete", "id": doc_id}
+
+
+def thumbnail_change(file_id, thumbnail):
+    """
+    Replace the thumbnail of a single file.
+
+    Unlike ``update_change``, this doesn't rewrite the rest of the document,
+    so it can't undo a change made to the document in the meantime.  If the
+    file has been deleted, the change is ignored.
+    """
+    return {"op": "set_thumbnail", "file_id": file_id, "thumbnail": thumbnail}
+
+
+def db_path(root):
+    """
+    Returns the path to the JSON database.
+    """
+    return os.path.join(root, "documents.json")
+
+
+def journal_path(root):
+    """
+    Returns the path to the change journal.
+
+    Rather than rewriting the whole JSON database every time a document
+    is added, deleted or updated, we append a small record describing the
+    change to this file.  The records are replayed on top of the database
+    when it's read, and periodically folded back into it by ``compact()``.
+    """
+    return os.path.join(root, "documents.journal")
+
+
+def snapshot_cache_path(root):
+    """
+    Returns the path to the binary snapshot of the JSON database.
+
+    Parsing a big JSON file is slow, so we keep a pickled copy of the parsed
+    documents next to it.  The snapshot records the size, mtime and inode
+    of the JSON file it was built from, and it's only used if they still
+    match -- so if the JSON file is edited by hand, the snapshot is ignored
+    and rebuilt.
+    """
+    return os.path.join(root, "documents.json.cache")
+
+
+def lock_path(root):
+    """
+    Returns the path to the lock file for the JSON database.
+
+    Compacting the journal means reading it, writing the database, and then
+    deleting it -- if another process appended a change in the meantime, it
+    would be lost.  So anything that writes to the database or the journal
+    holds an exclusive lock on this file first.
+    """
+    return os.path.join(root, "documents.lock")
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on the file at ``path``, creating it if necessary.
+
+    The lock is shared between processes, and between threads that open
+    the file separately -- but it isn't re-entrant, so don't take it twice.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_json(path):
+    """
+    Read a JSON dict that's kept alongside the database, e.g. the verify
+    stamps.  Returns an empty dict if the file doesn't exist yet.
+    """
+    try:
+        with open(path, encoding="utf8") as infile:
+            return loads(infile.read())
+    except FileNotFoundError:
+        return {}
+
+
+def write_json(path, value):
+    """
+    Write a JSON file atomically, so a reader never sees half a file.
+    """
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "w", encoding="utf8") as out_file:
+        out_file.write(dumps(value))
+
+    os.replace(tmp_path, path)
+
+
+# Bump this whenever the models change in a way that means old snapshots
+# can't be unpickled correctly.
+SNAPSHOT_CACHE_VERSION = 1
+
+
+def sqlite_path(root):
+    """
+    Returns the path to the SQLite database.
+    """
+    return os.path.join(root, "documents.sqlite3")
+
+
+# Once the journal is at least this big, *and* at least this fraction of the
+# size of the database, we fold it back into the database.  Tying compaction
+# to the size of the database means the cost of a full rewrite is amortised
+# over a number of changes proportional to the size of the library.
+JOURNAL_COMPACTION_MIN_BYTES = 1024 * 1024
+JOURNAL_COMPACTION_RATIO = 0.5
+
+
+def _file_version(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    else:
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _replay_changes(documents, changes):
+    """
+    Apply a list of changes to a list of documents.
+
+    Replaying a change is idempotent, so it's safe to replay a journal
+    against a database that already includes some of its changes.
+    """
+    documents_by_id = {d.id: d for d in documents}
+
+    # Only built if there are thumbnail changes to replay.  Entries for
+    # deleted documents aren't removed, so check the document still exists.
+    document_ids_by_file_id = None
+
+    for c in changes:
+        if c["op"] in {"add", "update"}:
+            documents_by_id[c["document"].id] = c["document"]
+
+            if document_ids_by_file_id is not None:
+                for f in c["document"].files:
+                    document_ids_by_file_id[f.id] = c["document"].id
+        elif c["op"] == "delete":
+            documents_by_id.pop(c["id"], None)
+        elif c["op"] == "set_thumbnail":
+            if document_ids_by_file_id is None:
+                document_ids_by_file_id = {
+                    f.id: doc.id for doc in documents_by_id.values() for f in doc.files
+                }
+
+            try:
+                doc = documents_by_id[document_ids_by_file_id[c["file_id"]]]
+            except KeyError:
+                continue
+
+            documents_by_id[doc.id] = attr.evolve(
+                doc,
+                files=[
+                    (
+                        attr.evolve(f, thumbnail=c["thumbnail"])
+                        if f.id == c["file_id"]
+                        else f
+                    )
+                    for f in doc.files
+                ],
+            )
+        else:  # pragma: no cover
+            raise ValueError(f"Unrecognised change operation: {c['op']}")
+
+    return list(documents_by_id.values())
+
+
+class JsonStorage:
+    """
+    Stores documents in ``documents.json``, with a journal of recent changes.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def paths(self):
+        return [db_path(self.root), journal_path(self.root)]
+
+    def exists(self):
+        return any(os.path.exists(p) for p in self.paths())
+
+    def version(self):
+        return (
+            _file_version(db_path(self.root)),
+            _file_version(journal_path(self.root)),
+        )
+
+    def _read_journal(self):
+        """
+        Returns a list of all the complete changes in the journal.
+        """
+        try:
+            with open(journal_path(self.root), encoding="utf8") as infile:
+                lines = infile.readlines()
+        except FileNotFoundError:
+            return []
+
+        # If we crashed halfway through appending a record, the last line
+        # will be incomplete -- skip it, because it was never acknowledged.
+        changes = []
+
+        for line in lines:
+            if not line.endswith("\n"):
+                continue
+
+            record = loads(line)
+            if "document" in record:
+                record["document"] = document_from_dict(record["document"])
+            if "thumbnail" in record:
+                record["thumbnail"] = thumbnail_from_dict(record["thumbnail"])
+            changes.append(record)
+
+        return changes
+
+    def _snapshot_key(self):
+        stat = os.stat(db_path(self.root))
+        return (
+            SNAPSHOT_CACHE_VERSION,
+            DB_SCHEMA,
+            stat.st_size,
+            stat.st_mtime_ns,
+            stat.st_ino,
+        )
+
+    def _read_snapshot_cache(self, key):
+        try:
+            with open(snapshot_cache_path(self.root), "rb") as infile:
+                if pickle.load(infile) != key:
+                    return None
+                return pickle.load(infile)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # The snapshot is only a cache, so if it's unreadable for any
+            # reason (truncated, written by an older version of docstore),
+            # just ignore it and go back to the JSON.
+            return None
+
+    def _write_snapshot_cache(self, key, documents):
+        tmp_path = snapshot_cache_path(self.root) + ".tmp"
+
+        try:
+            with open(tmp_path, "wb") as out_file:
+                pickle.dump(key, out_file, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(documents, out_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmp_path, snapshot_cache_path(self.root))
+        except OSError:  # pragma: no cover
+            pass
+
+    def _read_database(self):
+        try:
+            key = self._snapshot_key()
+        except FileNotFoundError:
+            return []
+
+        documents = self._read_snapshot_cache(key)
+
+        if documents is None:
+            with open(db_path(self.root), encoding="utf8") as infile:
+                documents = from_json(infile.read())
+
+            self._write_snapshot_cache(key, documents)
+
+        return documents
+
+    def read(self):
+        return _replay_changes(self._read_database(), self._read_journal())
+
+    def write(self, documents):
+        with file_lock(lock_path(self.root)):
+            self._write(documents)
+
+    def _write(self, documents):
+        json_string = to_json(documents)
+
+        os.makedirs(self.root, exist_ok=True)
+
+        # Write to a temporary file and rename it into place, so a crash
+        # halfway through a write can't leave a truncated database.
+        tmp_path = db_path(self.root) + ".tmp"
+
+        with open(tmp_path, "w", encoding="utf8") as out_file:
+            out_file.write(json_string)
+
+        os.replace(tmp_path, db_path(self.root))
+
+        # We already have the parsed documents, so we can build the snapshot
+        # now rather than waiting for the next read.  Documents are stored
+        # newest first, so store them in the same order.
+        self._write_snapshot_cache(
+            self._snapshot_key(),
+            sorted(documents, key=lambda d: d.date_saved, reverse=True),
+        )
+
+        # Everything in the journal is now in the database.  If we crash
+        # before we delete it, it'll be replayed again, which is harmless.
+        try:
+            os.unlink(journal_path(self.root))
+        except FileNotFoundError:
+            pass
+
+    def apply(self, changes):
+        os.makedirs(self.root, exist_ok=True)
+
+        lines = []
+
+        for c in changes:
+            record = dict(c)
+            if "document" in record:
+                record["document"] = document_to_dict(record["document"])
+            if "thumbnail" in record:
+                record["thumbnail"] = thumbnail_to_dict(record["thumbnail"])
+            lines.append(dumps(record))
+
+        with file_lock(lock_path(self.root)):
+            with open(journal_path(self.root), "a", encoding="utf8") as out_file:
+                out_file.write("".join(line + "\n" for line in lines))
+                out_file.flush()
+                os.fsync(out_file.fileno())
+
+            if self._should_compact():
+                self._write(self.read())
+
+    def _should_compact(self):
+        journal_size = _file_size(journal_path(self.root))
+        db_size = _file_size(db_path(self.root))
+
+        return (
+            journal_size >= JOURNAL_COMPACTION_MIN_BYTES
+            and journal_size >= db_size * JOURNAL_COMPACTION_RATIO
+        )
+
+    def compact(self):
+        """
+        Fold the journal back into the database.
+        """
+        with file_lock(lock_path(self.root)):
+            self._write(self.read())
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docstore (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    date_saved TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS document_tags (
+    document_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (document_id, position)
+);
+
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    document_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    checksum TEXT NOT NULL,
+    source_url TEXT,
+    date_saved TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS thumbnails (
+    file_id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    tint_color TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS thumbnail_variants (
+    file_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    media_type TEXT NOT NULL,
+    PRIMARY KEY (file_id, position)
+);
+
+CREATE INDEX IF NOT EXISTS documents_date_saved ON documents (date_saved);
+CREATE INDEX IF NOT EXISTS document_tags_tag ON document_tags (tag, document_id);
+CREATE INDEX IF NOT EXISTS files_document_id ON files (document_id, position);
+CREATE INDEX IF NOT EXISTS files_checksum ON files (checksum);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+"""
+
+
+SELECT_FILES_QUERY = """
+SELECT
+    f.document_id, f.id, f.filename, f.path, f.size, f.checksum,
+    f.source_url, f.date_saved,
+    t.path, t.width, t.height, t.tint_color
+FROM files AS f JOIN thumbnails AS t ON t.file_id = f.id
+ORDER BY f.document_id, f.position
+"""
+
+
+class SqliteStorage:
+    """
+    Stores documents in a SQLite database, ``documents.sqlite3``.
+
+    Changes are applied row-by-row, so the cost of a change is proportional
+    to the size of the change, not the size of the library.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def paths(self):
+        return [sqlite_path(self.root)]
+
+    def exists(self):
+        return os.path.exists(sqlite_path(self.root))
+
+    def version(self):
+        # Bytes 24..27 of a SQLite database are the "file change counter",
+        # which is incremented by every transaction that modifies the file.
+        # Including it means we notice changes that don't affect the mtime
+        # or size of the file.
+        # See https://www.sqlite.org/fileformat.html#file_change_counter
+        try:
+            with open(sqlite_path(self.root), "rb") as infile:
+                infile.seek(24)
+                change_counter = infile.read(4)
+        except FileNotFoundError:
+            return None
+
+        return (_file_version(sqlite_path(self.root)), change_counter)
+
+    def _connect(self):
+        os.makedirs(self.root, exist_ok=True)
+
+        connection = sqlite3.connect(sqlite_path(self.root))
+        connection.executescript(SQLITE_SCHEMA)
+
+        schema = connection.execute(
+            "SELECT value FROM docstore WHERE key = 'db_schema'"
+        ).fetchone()
+
+        if schema is None:
+            with connection:
+                connection.execute(
+                    "INSERT INTO docstore (key, value) VALUES ('db_schema', ?)",
+                    (DB_SCHEMA,),
+                )
+        else:
+            assert schema[0] == DB_SCHEMA
+
+        return connection
+
+    def read(self):
+        if not self.exists():
+            return []
+
+        connection = self._connect()
+
+        try:
+            tags = {}
+            for document_id, tag in connection.execute(
+                "SELECT document_id, tag FROM document_tags ORDER BY document_id, position"
+            ):
+                tags.setdefault(document_id, []).append(tag)
+
+            variants = {}
+            for file_id, path, width, height, media_type in connection.execute(
+                "SELECT file_id, path, width, height, media_type "
+                "FROM thumbnail_variants ORDER BY file_id, position"
+            ):
+                variants.setdefault(file_id, []).append(
+                    ThumbnailVariant(
+                        path=path,
+                        dimensions=Dimensions(width=width, height=height),
+                        media_type=media_type,
+                    )
+                )
+
+            files = {}
+            for row in connection.execute(SELECT_FILES_QUERY):
+                files.setdefault(row[0], []).append(
+                    File(
+                        id=row[1],
+                        filename=row[2],
+                        path=row[3],
+                        size=row[4],
+                        checksum=row[5],
+                        source_url=row[6],
+                        date_saved=row[7],
+                        thumbnail=Thumbnail(
+                            path=row[8],
+                            dimensions=Dimensions(width=row[9], height=row[10]),
+                            tint_color=row[11],
+                            variants=variants.get(row[1], []),
+                        ),
+                    )
+                )
+
+            return [
+                Document(
+                    id=document_id,
+                    title=title,
+                    date_saved=date_saved,
+                    tags=tags.get(document_id, []),
+                    files=files.get(document_id, []),
+                )
+                for document_id, title, date_saved in connection.execute(
+                    "SELECT id, title, date_saved FROM documents "
+                    "ORDER BY date_saved DESC, rowid"
+                )
+            ]
+        finally:
+            connection.close()
+
+    def _delete_document(self, connection, doc_id):
+        connection.execute(
+            "DELETE FROM thumbnail_variants WHERE file_id IN "
+            "(SELECT id FROM files WHERE document_id = ?)",
+            (doc_id,),
+        )
+        connection.execute(
+            "DELETE FROM thumbnails WHERE file_id IN "
+            "(SELECT id FROM files WHERE document_id = ?)",
+            (doc_id,),
+        )
+        connection.execute("DELETE FROM files WHERE document_id = ?", (doc_id,))
+        connection.execute("DELETE FROM document_tags WHERE document_id = ?", (doc_id,))
+        connection.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
+
+    def _insert_document(self, connection, doc):
+        connection.execute(
+            "INSERT INTO documents (id, title, date_saved) VALUES (?, ?, ?)",
+            (doc.id, doc.title, doc.date_saved.isoformat()),
+        )
+        connection.executemany(
+            "INSERT INTO document_tags (document_id, position, tag) VALUES (?, ?, ?)",
+            [(doc.id, position, tag) for position, tag in enumerate(doc.tags)],
+        )
+        connection.executemany(
+            """
+            INSERT INTO files (
+                id, document_id, position, filename, path, size, checksum,
+                source_url, date_saved
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    f.id,
+                    doc.id,
+                    position,
+                    f.filename,
+                    f.path,
+                    f.size,
+                    f.checksum,
+                    f.source_url,
+                    f.date_saved.isoformat(),
+                )
+                for position, f in enumerate(doc.files)
+            ],
+        )
+        connection.executemany(
+            """
+            INSERT INTO thumbnails (file_id, path, width, height, tint_color)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    f.id,
+                    f.thumbnail.path,
+                    f.thumbnail.dimensions.width,
+                    f.thumbnail.dimensions.height,
+                    f.thumbnail.tint_color,
+                )
+                for f in doc.files
+            ],
+        )
+        connection.executemany(
+            """
+            INSERT INTO thumbnail_variants (
+                file_id, position, path, width, height, media_type
+            ) VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    f.id,
+                    position,
+                    v.path,
+                    v.dimensions.width,
+                    v.dimensions.height,
+                    v.media_type,
+                )
+                for f in doc.files
+                for position, v in enumerate(f.thumbnail.variants)
+            ],
+        )
+
+    def _set_thumbnail(self, connection, file_id, thumbnail):
+        cursor = connection.execute(
+            "UPDATE thumbnails SET path = ?, width = ?, height = ?, tint_color = ? "
+            "WHERE file_id = ?",
+            (
+                thumbnail.path,
+                thumbnail.dimensions.width,
+                thumbnail.dimensions.height,
+                thumbnail.tint_color,
+                file_id,
+            ),
+        )
+
+        # The file has been deleted
+        if cursor.rowcount == 0:
+            return
+
+        connection.execute(
+            "DELETE FROM thumbnail_variants WHERE file_id = ?", (file_id,)
+        )
+        connection.executemany(
+            """
+            INSERT INTO thumbnail_variants (
+                file_id, position, path, width, height, media_type
+            ) VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    file_id,
+                    position,
+                    v.path,
+                    v.dimensions.width,
+                    v.dimensions.height,
+                    v.media_type,
+                )
+                for position, v in enumerate(thumbnail.variants)
+            ],
+        )
+
+    def write(self, documents):
+        if not isinstance(documents, list) or not all(
+            isinstance(d, Document) for d in documents
+        ):
+            raise TypeError("Expected type List[Document]!")
+
+        connection = self._connect()
+
+        try:
+            with connection:
+                for table in (
+                    "thumbnail_variants",
+                    "thumbnails",
+                    "files",
+                    "document_tags",
+                    "documents",
+                ):
+                    connection.execute(f"DELETE FROM {table}")
+
+                for doc in documents:
+                    self._insert_document(connection, doc)
+        finally:
+            connection.close()
+
+    def apply(self, changes):
+        connection = self._connect()
+
+        try:
+            with connection:
+                for c in changes:
+                    if c["op"] in {"add", "update"}:
+                        self._delete_document(connection, c["document"].id)
+                        self._insert_document(connection, c["document"])
+                    elif c["op"] == "delete":
+                        self._delete_document(connection, c["id"])
+                    elif c["op"] == "set_thumbnail":
+                        self._set_thumbnail(connection, c["file_id"], c["thumbnail"])
+                    else:  # pragma: no cover
+                        raise ValueError(f"Unrecognised change operation: {c['op']}")
+        finally:
+            connection.close()
+
+    def compact(self):
+        connection = self._connect()
+
+        try:
+            connection.execute("VACUUM")
+        finally:
+            connection.close()
+
+
+STORAGE_ENGINES = {"json": JsonStorage, "sqlite": SqliteStorage}
+
+
+def last_modified(storage):
+    """
+    Returns when the database was last changed, as a POSIX timestamp,
+    or None if there isn't a database yet.
+    """
+    mtimes = []
+
+    for p in storage.paths():
+        try:
+            mtimes.append(os.stat(p).st_mtime)
+        except FileNotFoundError:
+            pass
+
+    return max(mtimes, default=None)
+
+
+def get_storage(root):
+    """
+    Returns the storage engine used by the instance at ``root``.
+
+    If there's a SQLite database, we use that; otherwise we fall back
+    to JSON, which is also what gets created for a brand new instance.
+    """
+    if SqliteStorage(root).exists():
+        return SqliteStorage(root)
+    else:
+        return JsonStorage(root)
+
+
+def convert_storage(root, *, engine):
+    """
+    Convert the instance at ``root`` to use a different storage engine.
+
+    The files used by the old engine are kept with a ``.bak`` suffix.
+    """
+    source = get_storage(root)
+    target = STORAGE_ENGINES[engine](root)
+
+    if isinstance(source, type(target)):
+        raise ValueError(f"The docstore instance at {root} already uses {engine}")
+
+    backup_paths = {p: p + ".bak" for p in source.paths() if os.path.exists(p)}
+
+    for bak_path in backup_paths.values():
+        if os.path.exists(bak_path):
+            raise FileExistsError(f"Refusing to overwrite existing backup {bak_path}")
+
+    target.write(source.read())
+
+    for path, bak_path in backup_paths.items():
+        os.rename(path, bak_path)
+
+    return target
@@ -1,13 +1,19 @@
+import mimetypes
 import os
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
 
-from PIL import Image, UnidentifiedImageError
+from PIL import Image, ImageOps, UnidentifiedImageError
 
 from docstore.models import Dimensions
 
+# Bump this whenever a change means we'd create a different thumbnail for
+# the same file, so we don't reuse old thumbnails from the artefact cache.
+THUMBNAIL_VERSION = 2
+
 
 def _is_animated_gif(path):
     """
@@ -23,6 +29,9 @@ def _is_animated_gif(path):
 
 
 def _create_gif_thumbnail_from_ffmpeg(*, path, max_size, out_dir):
+    if shutil.which("ffmpeg") is None:
+        return None
+
     im = Image.open(path)
 
     if im.width > im.height and im.width >= max_size:
@@ -35,34 +44,172 @@ def _create_gif_thumbnail_from_ffmpeg(*, path, max_size, out_dir):
 
     out_path = os.path.join(out_dir, os.path.basename(path) + ".mp4")
 
-    subprocess.check_call(
-        [
-            "ffmpeg",
-            "-i",
-            path,
-            "-movflags",
-            "faststart",
-            "-pix_fmt",
-            "yuv420p",
-            "-vf",
-            f"scale={width}:{height}",
-            out_path,
-        ],
-        stdout=subprocess.DEVNULL,
+    try:
+        subprocess.check_call(
+            [
+                "ffmpeg",
+                "-i",
+                path,
+                "-movflags",
+                "faststart",
+                "-pix_fmt",
+                "yuv420p",
+                "-vf",
+                f"scale={width}:{height}",
+                out_path,
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+    except subprocess.CalledProcessError:
+        return None
+
+    return out_path, Dimensions(width=width, height=height)
+
+
+def _thumbnail_path(*, path, out_dir):
+    """
+    Thumbnails are PNGs named after the original file, e.g. the thumbnail
+    of "cat.pdf" is "cat.pdf.png", and the thumbnail of "cat.png" is "cat.png".
+    """
+    name = os.path.basename(path)
+
+    if not name.endswith(".png"):
+        name += ".png"
+
+    return os.path.join(out_dir, name)
+
+
+def fit_dimensions(dimensions, *, max_size):
+    """
+    Returns the size of an image with these ``dimensions`` after shrinking
+    it so its longest side is at most ``max_size``.
+    """
+    longest_side = max(dimensions.width, dimensions.height)
+
+    if longest_side <= max_size:
+        return dimensions
+
+    scale = max_size / longest_side
+    return Dimensions(
+        width=max(int(dimensions.width * scale), 1),
+        height=max(int(dimensions.height * scale), 1),
+    )
+
+
+def _resize_to_fit(im, *, max_size):
+    """
+    Shrink an image so its longest side is at most ``max_size``.
+    """
+    size = fit_dimensions(Dimensions(im.width, im.height), max_size=max_size)
+
+    if size == Dimensions(im.width, im.height):
+        return im
+
+    return im.resize(
+        (size.width, size.height), resample=Image.LANCZOS, reducing_gap=3.0
     )
 
-    return out_path
+
+def _create_image_thumbnail_with_pillow(*, path, max_size, out_dir):
+    try:
+        im = Image.open(path)
+
+        # This lets the JPEG decoder do most of the downscaling for us.
+        im.draft("RGB", (max_size, max_size))
+
+        # Respect the orientation the camera recorded, and make sure we have
+        # something we can resize smoothly and save as a PNG (e.g. not CMYK
+        # or a palette).
+        im = ImageOps.exif_transpose(im)
+
+        if im.mode not in {"L", "LA", "RGB", "RGBA"}:
+            im = im.convert("RGBA")
+
+        im = _resize_to_fit(im, max_size=max_size)
+    except (OSError, Image.DecompressionBombError):
+        # Not an image, or one we can't read, e.g. a truncated JPEG
+        return None
+
+    out_path = _thumbnail_path(path=path, out_dir=out_dir)
+    im.save(out_path)
+
+    return out_path, Dimensions(width=im.width, height=im.height)
+
+
+def _create_pdf_thumbnail_with_pdftoppm(*, path, max_size, out_dir):
+    if shutil.which("pdftoppm") is None:
+        return None
+
+    out_path = _thumbnail_path(path=path, out_dir=out_dir)
+
+    try:
+        subprocess.check_call(
+            [
+                "pdftoppm",
+                "-png",
+                "-singlefile",
+                "-f",
+                "1",
+                "-l",
+                "1",
+                "-scale-to",
+                str(max_size),
+                path,
+                # pdftoppm adds the .png suffix itself
+                out_path[: -len(".png")],
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=30,
+        )
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return None
+
+    return out_path, get_dimensions(out_path)
+
+
+def _create_video_thumbnail_with_ffmpeg(*, path, max_size, out_dir):
+    if shutil.which("ffmpeg") is None:
+        return None
+
+    out_path = _thumbnail_path(path=path, out_dir=out_dir)
+
+    try:
+        subprocess.check_call(
+            [
+                "ffmpeg",
+                "-i",
+                path,
+                "-vf",
+                # Pick a representative frame from the start of the video,
+                # rather than the first frame, which is often black.
+                f"thumbnail,scale={max_size}:{max_size}:force_original_aspect_ratio=decrease",
+                "-frames:v",
+                "1",
+                out_path,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=30,
+        )
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return None
+
+    return out_path, get_dimensions(out_path)
 
 
 def _create_thumbnail_from_quick_look(*, path, max_size, out_dir):
+    if shutil.which("qlmanage") is None:
+        return None
+
     try:
         subprocess.check_call(
             ["qlmanage", "-t", path, "-s", f"{max_size}x{max_size}", "-o", out_dir],
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
-            timeout=5
+            timeout=5,
         )
-    except subprocess.TimeoutExpired:
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
         # It's possible for somethign to go wrong with the Quick Look
         # process where it just hangs and doesn't create a thumbnail.
         # If so, just continue without creating the thumbnail.
@@ -71,35 +218,218 @@ def _create_thumbnail_from_quick_look(*, path, max_size, out_dir):
     try:
         result = os.path.join(out_dir, os.listdir(out_dir)[0])
     except IndexError:
-        print(f"Quick Look could not create a thumbnail for {path}", file=sys.stderr)
-        result = os.path.join(out_dir, "generic_document.png")
-        shutil.copyfile(
-            src=os.path.join(
-                os.path.dirname(os.path.abspath(__file__)),
-                "static/generic_document.png",
-            ),
-            dst=result,
-        )
+        return None
 
     if result.endswith(".png.png"):
         os.rename(result, result.replace(".png.png", ".png"))
         result = result.replace(".png.png", ".png")
 
-    return result
+    return result, get_dimensions(result)
 
 
-def create_thumbnail(path, *, max_size=400):
+def create_generic_thumbnail(*, out_dir):
     """
-    Creates a thumbnail of the file at ``path``.
+    Copies the generic icon we use for files we can't create a thumbnail of.
 
-    Returns the path to the new file.
+    Returns a tuple (path, Dimensions) for the new file.
     """
-    kwargs = {"path": path, "max_size": max_size, "out_dir": tempfile.mkdtemp()}
+    result = os.path.join(out_dir, "generic_document.png")
+    shutil.copyfile(
+        src=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            "static/generic_document.png",
+        ),
+        dst=result,
+    )
+    return result, get_dimensions(result)
 
+
+def get_file_type(path):
+    """
+    Returns the type of the file at ``path``, which is used to choose
+    a thumbnailer -- one of the keys of ``THUMBNAILERS``.
+    """
     if _is_animated_gif(path):
-        return _create_gif_thumbnail_from_ffmpeg(**kwargs)
+        return "animated_gif"
+
+    try:
+        Image.open(path)
+    except UnidentifiedImageError:
+        pass
     else:
-        return _create_thumbnail_from_quick_look(**kwargs)
+        return "image"
+
+    with open(path, "rb") as infile:
+        if infile.read(5) == b"%PDF-":
+            return "pdf"
+
+    mimetype, _ = mimetypes.guess_type(path)
+
+    if mimetype is not None and mimetype.startswith("video/"):
+        return "video"
+
+    return "other"
+
+
+# For each type of file, the functions that can create a thumbnail of it,
+# in order of preference.  Each function takes the arguments
+# (path, max_size, out_dir), and returns a tuple (path, Dimensions) for
+# the thumbnail it created in ``out_dir`` -- or None, if it couldn't
+# create one.
+#
+# If none of them can create a thumbnail, we use a generic icon.
+THUMBNAILERS = {
+    "animated_gif": [
+        _create_gif_thumbnail_from_ffmpeg,
+        _create_image_thumbnail_with_pillow,
+    ],
+    "image": [_create_image_thumbnail_with_pillow],
+    "pdf": [_create_pdf_thumbnail_with_pdftoppm, _create_thumbnail_from_quick_look],
+    "video": [_create_video_thumbnail_with_ffmpeg, _create_thumbnail_from_quick_look],
+    "other": [_create_thumbnail_from_quick_look],
+}
+
+
+def register_thumbnailer(file_type, thumbnailer):
+    """
+    Add a thumbnailer for ``file_type``, which is tried before any of
+    the existing thumbnailers for that type.
+    """
+    THUMBNAILERS.setdefault(file_type, []).insert(0, thumbnailer)
+
+
+def create_thumbnail(path, *, max_size=400, fallback=True):
+    """
+    Creates a thumbnail of the file at ``path``.
+
+    If none of the thumbnailers can create one, we use the generic icon --
+    or if ``fallback`` is False, we return None.
+
+    Returns a tuple (path, Dimensions) for the new file.
+    """
+    out_dir = tempfile.mkdtemp()
+    file_type = get_file_type(path)
+
+    for thumbnailer in THUMBNAILERS.get(file_type, []):
+        result = thumbnailer(path=path, max_size=max_size, out_dir=out_dir)
+
+        if result is not None:
+            return result
+
+    print(f"Could not create a thumbnail for {path}", file=sys.stderr)
+
+    if not fallback:
+        shutil.rmtree(out_dir)
+        return None
+
+    return create_generic_thumbnail(out_dir=out_dir)
+
+
+# Smaller or better-compressed copies of each thumbnail, as (media type,
+# max size) pairs.  The web app lists them in a ``srcset``, so browsers can
+# download the smallest image that looks sharp at the size it's displayed.
+# The original PNG thumbnail is the fallback for browsers without WebP.
+THUMBNAIL_VARIANTS = [
+    ("image/webp", 200),
+    ("image/webp", 400),
+    ("image/png", 200),
+]
+
+_VARIANT_FORMATS = {"image/webp": ("WEBP", ".webp"), "image/png": ("PNG", ".png")}
+
+
+def variant_name(thumbnail_name, *, media_type, max_size):
+    """
+    Variants are named after the thumbnail, e.g. the 200px WebP variant
+    of "cat.pdf.png" is "cat.pdf.200.webp".
+    """
+    _, extension = _VARIANT_FORMATS[media_type]
+    return f"{os.path.splitext(thumbnail_name)[0]}.{max_size}{extension}"
+
+
+def create_thumbnail_variant(thumbnail_path, *, media_type, max_size, out_dir):
+    """
+    Creates a variant of the thumbnail at ``thumbnail_path``.
+
+    Returns a tuple (path, Dimensions) for the new file, or None if the
+    thumbnail isn't an image (e.g. the MP4 thumbnail of an animated GIF).
+    """
+    try:
+        im = Image.open(thumbnail_path)
+    except UnidentifiedImageError:
+        return None
+
+    im = _resize_to_fit(im, max_size=max_size)
+
+    image_format, _ = _VARIANT_FORMATS[media_type]
+
+    out_path = os.path.join(
+        out_dir,
+        variant_name(
+            os.path.basename(thumbnail_path), media_type=media_type, max_size=max_size
+        ),
+    )
+    im.save(out_path, format=image_format)
+
+    return out_path, Dimensions(width=im.width, height=im.height)
+
+
+# Boxes in an MP4 file that contain other boxes, on the way to the
+# track header -- see ISO/IEC 14496-12.
+_MP4_CONTAINER_BOXES = {b"moov", b"trak"}
+
+
+def _read_mp4_boxes(infile, end):
+    """
+    Generates a (type, start, end) tuple for each box in an MP4 file
+    between the current position and ``end``, where ``start`` is the
+    position of the box's contents.
+    """
+    while infile.tell() + 8 <= end:
+        box_start = infile.tell()
+        size, box_type = struct.unpack(">I4s", infile.read(8))
+
+        if size == 1:
+            (size,) = struct.unpack(">Q", infile.read(8))
+        elif size == 0:
+            size = end - box_start
+
+        if size < 8:
+            raise ValueError(f"Invalid MP4 box size: {size}")
+
+        yield box_type, infile.tell(), box_start + size
+
+        infile.seek(box_start + size)
+
+
+def _find_mp4_track_headers(infile, end):
+    for box_type, start, box_end in _read_mp4_boxes(infile, end):
+        if box_type == b"tkhd":
+            yield infile.read(box_end - start)
+        elif box_type in _MP4_CONTAINER_BOXES:
+            yield from _find_mp4_track_headers(infile, box_end)
+
+
+def _get_mp4_dimensions(path):
+    """
+    Read the dimensions of an MP4 video from its track header (``tkhd``) box,
+    which is much faster than starting a subprocess to ask ffprobe.
+    """
+    with open(path, "rb") as infile:
+        infile.seek(0, os.SEEK_END)
+        end = infile.tell()
+        infile.seek(0)
+
+        for tkhd in _find_mp4_track_headers(infile, end):
+            # The width and height are the last 8 bytes of the box, as
+            # 16.16 fixed-point numbers.  Tracks with no width and height
+            # are e.g. audio tracks, so skip them.
+            width, height = struct.unpack(">II", tkhd[-8:])
+
+            if width and height:
+                return Dimensions(width=width >> 16, height=height >> 16)
+
+    raise ValueError(f"Could not find the dimensions of video {path}")
 
 
 def get_dimensions(path):
@@ -111,21 +441,7 @@ def get_dimensions(path):
         return Dimensions(width=im.width, height=im.height)
 
     elif path.endswith(".mp4"):  # video thumbnail
-        # See https://stackoverflow.com/a/29585066/1558022
-        output = subprocess.check_output(
-            [
-                "ffprobe",
-                "-v",
-                "error",
-                "-show_entries",
-                "stream=width,height",
-                "-of",
-                "csv=p=0:s=x",
-                os.path.abspath(path),
-            ]
-        )
-        width, height = output.strip().split(b"x")
-        return Dimensions(width=int(width), height=int(height))
+        return _get_mp4_dimensions(path)
 
     else:  # pragma: no cover
         raise ValueError(f"Unrecognised thumbnail type: {path}")
@@ -1,10 +1,44 @@
-import collections
-import colorsys
-import math
-import os
-import subprocess
+import numpy as np
+from PIL import Image
 
-import wcag_contrast_ratio as contrast
+# Tint colours only need to be roughly right, so we choose them from a small
+# copy of the image -- this is much faster than looking at every pixel.
+MAX_SIZE = 100
+
+# For animated images, look at this many frames, spread across the animation.
+MAX_FRAMES = 10
+
+# Bump this whenever a change means we'd choose a different tint colour for
+# the same file, so we don't reuse old tint colours from the artefact cache.
+TINT_COLOR_VERSION = 1
+
+
+def _relative_luminance(colors):
+    """
+    Returns the WCAG relative luminance of an (n, 3) array of RGB colours.
+
+    See https://www.w3.org/TR/WCAG20/#relativeluminancedef
+    """
+    linear = np.where(
+        colors <= 0.03928, colors / 12.92, ((colors + 0.055) / 1.055) ** 2.4
+    )
+    return linear @ np.array([0.2126, 0.7152, 0.0722])
+
+
+def contrast_ratios(colors, background_color):
+    """
+    Returns the WCAG contrast ratio of each colour in ``colors`` against
+    ``background_color``.
+    """
+    luminance = _relative_luminance(np.asarray(colors, dtype=float))
+    background_luminance = _relative_luminance(
+        np.asarray(background_color, dtype=float)
+    )
+
+    lighter = np.maximum(luminance, background_luminance)
+    darker = np.minimum(luminance, background_luminance)
+
+    return (lighter + 0.05) / (darker + 0.05)
 
 
 def choose_tint_color_from_dominant_colors(dominant_colors, background_color):
@@ -14,11 +48,11 @@ def choose_tint_color_from_dominant_colors(dominant_colors, background_color):
 
     Both ``dominant_colors`` and ``background_color`` should be tuples in [0,1].
     """
+    colors = np.asarray(dominant_colors, dtype=float).reshape(-1, 3)
+
     # The minimum contrast ratio for text and background to meet WCAG AA
     # is 4.5:1, so discard any dominant colours with a lower contrast.
-    sufficient_contrast_colors = [
-        col for col in dominant_colors if contrast.rgb(col, background_color) >= 4.5
-    ]
+    sufficient_contrast = contrast_ratios(colors, background_color) >= 4.5
 
     # If none of the dominant colours meet WCAG AA with the background,
     # try again with black and white -- every colour in the RGB space
@@ -28,21 +62,19 @@ def choose_tint_color_from_dominant_colors(dominant_colors, background_color):
     # Note: you could modify the dominant colours until one of them
     # has sufficient contrast, but that's omitted here because it adds
     # a lot of complexity for a relatively unusual case.
-    if not sufficient_contrast_colors:
-        return choose_tint_color_from_dominant_colors(
-            dominant_colors=dominant_colors + [(0, 0, 0), (1, 1, 1)],
-            background_color=background_color,
-        )
+    if not sufficient_contrast.any():
+        colors = np.concatenate([colors, [(0, 0, 0), (1, 1, 1)]])
+        sufficient_contrast = contrast_ratios(colors, background_color) >= 4.5
+
+    candidates = colors[sufficient_contrast]
 
-    # Of the colors with sufficient contrast, pick the one with the
-    # highest saturation.  This is meant to optimise for colors that are
-    # more colourful/interesting than simple greys and browns.
-    hsv_candidates = {
-        tuple(rgb_col): colorsys.rgb_to_hsv(*rgb_col)
-        for rgb_col in sufficient_contrast_colors
-    }
+    # Of the colors with sufficient contrast, pick the brightest one,
+    # i.e. the one with the highest value in HSV -- which is the largest
+    # of its RGB components.  This is meant to optimise for colors that are
+    # more colourful/interesting than dark greys and browns.
+    best = candidates[candidates.max(axis=1).argmax()]
 
-    return max(hsv_candidates, key=lambda rgb_col: hsv_candidates[rgb_col][2])
+    return tuple(float(c) for c in best)
 
 
 def from_hex(hs):
@@ -52,25 +84,126 @@ def from_hex(hs):
     return int(hs[1:3], 16), int(hs[3:5], 16), int(hs[5:7], 16)
 
 
+def get_pixels(path):
+    """
+    Returns the pixels of a downsampled copy of the image at ``path``,
+    as an (n, 3) array of RGB colours in [0, 1].
+
+    Fully transparent pixels are ignored, because you can't see them.
+    """
+    im = Image.open(path)
+
+    # This lets the JPEG decoder do most of the downsampling for us.
+    im.draft("RGB", (MAX_SIZE, MAX_SIZE))
+
+    frame_count = getattr(im, "n_frames", 1)
+    frames = range(0, frame_count, max(1, frame_count // MAX_FRAMES))[:MAX_FRAMES]
+
+    pixels = []
+
+    for frame in frames:
+        im.seek(frame)
+        small_im = im.convert("RGBA")
+
+        # We sample the pixels rather than blending them, because blending
+        # creates new colours that don't appear in the image -- especially
+        # around the edges of transparent areas.
+        scale = min(1, MAX_SIZE / max(small_im.size))
+        small_im = small_im.resize(
+            (max(1, int(small_im.width * scale)), max(1, int(small_im.height * scale))),
+            resample=Image.NEAREST,
+        )
+
+        pixels.append(np.asarray(small_im).reshape(-1, 4))
+
+    pixels = np.concatenate(pixels)
+
+    opaque_pixels = pixels[pixels[:, 3] > 0]
+    if len(opaque_pixels) > 0:
+        pixels = opaque_pixels
+
+    return pixels[:, :3] / 255
+
+
+def find_dominant_colors(pixels, *, max_colors=12, max_iterations=20, seed=0):
+    """
+    Find the dominant colours in an (n, 3) array of pixels, using k-means.
+
+    Returns an (m, 3) array of colours, where m <= ``max_colors``.
+    """
+    # Most images have lots of repeated colours, so cluster each distinct
+    # colour once, weighted by how often it appears.  Packing each colour
+    # into a single integer makes finding the distinct colours much faster.
+    codes = np.round(np.asarray(pixels) * 255).astype(np.int64) @ [65536, 256, 1]
+    unique_codes, counts = np.unique(codes, return_counts=True)
+
+    colors = (
+        np.stack(
+            [unique_codes >> 16, (unique_codes >> 8) & 255, unique_codes & 255],
+            axis=1,
+        )
+        / 255
+    )
+
+    if len(colors) <= max_colors:
+        return colors
+
+    # Choose the initial centres with k-means++, i.e. prefer colours that
+    # are far away from the centres we've already picked.  We use a fixed
+    # seed, so we always get the same tint colour for the same image.
+    rng = np.random.default_rng(seed)
+
+    centers = colors[[rng.choice(len(colors), p=counts / counts.sum())]]
+    distances = ((colors - centers[0]) ** 2).sum(axis=1)
+
+    while len(centers) < max_colors:
+        weights = distances * counts
+        new_center = colors[rng.choice(len(colors), p=weights / weights.sum())]
+
+        centers = np.vstack([centers, new_center])
+        distances = np.minimum(distances, ((colors - new_center) ** 2).sum(axis=1))
+
+    for _ in range(max_iterations):
+        # The squared distance |c - m|^2 = |c|^2 - 2 c.m + |m|^2, but we
+        # only need the closest centre, so we can drop the |c|^2 term.
+        labels = ((centers**2).sum(axis=1) - 2 * colors @ centers.T).argmin(axis=1)
+
+        cluster_sizes = np.bincount(labels, weights=counts, minlength=len(centers))
+        cluster_totals = np.stack(
+            [
+                np.bincount(
+                    labels, weights=colors[:, channel] * counts, minlength=len(centers)
+                )
+                for channel in range(3)
+            ],
+            axis=1,
+        )
+
+        # If a cluster is empty, leave its centre where it is.
+        new_centers = np.where(
+            cluster_sizes[:, np.newaxis] > 0,
+            cluster_totals / np.maximum(cluster_sizes, 1)[:, np.newaxis],
+            centers,
+        )
+
+        if np.allclose(new_centers, centers):
+            break
+
+        centers = new_centers
+
+    return centers
+
+
 def choose_tint_color_for_file(path):
     """
     Returns the tint colour for a file.
     """
     background_color = (1, 1, 1)
 
-    cmd = ["dominant_colours", "--no-palette", "--max-colours=12", path]
-
-    dominant_colors = [
-        from_hex(line)
-        for line in subprocess.check_output(cmd).splitlines()
-    ]
-
-    colors = [
-        (r / 255, g / 255, b / 255) for r, g, b in dominant_colors
-    ]
+    dominant_colors = find_dominant_colors(get_pixels(path))
 
     return choose_tint_color_from_dominant_colors(
-        dominant_colors=colors, background_color=background_color
+        dominant_colors=dominant_colors, background_color=background_color
     )
 
 
@@ -0,0 +1,353 @@
+"""
+Check that stored files still match the size and checksum we recorded.
+
+Hashing a big library takes a long time, so we keep a record of every file
+that was verified successfully (a "stamp"), along with its inode, size and
+mtime at the time.  If none of those have changed, the file almost certainly
+hasn't either, and we can skip it when only checking changed files.
+
+Alternatively, ``scrub`` re-checks files continuously in the background,
+oldest-checked first, at a limited number of bytes per second.
+"""
+
+import concurrent.futures
+import datetime
+import math
+import os
+import random
+import time
+
+import attr
+
+from docstore.documents import get_store, sha256
+from docstore.storage import file_lock, read_json, write_json
+
+
+def stamps_path(root):
+    return os.path.join(root, "verify_stamps.json")
+
+
+def scrub_state_path(root):
+    return os.path.join(root, "scrub_state.json")
+
+
+def verify_lock_path(root):
+    return os.path.join(root, "verify.lock")
+
+
+def read_stamps(root):
+    return read_json(stamps_path(root))
+
+
+def write_stamps(root, stamps):
+    write_json(stamps_path(root), stamps)
+
+
+def _merge_json(path, changes, *, keep_ids=None):
+    """
+    Apply ``changes`` to the JSON dict at ``path``.  Each change maps a file
+    ID to its new value, or None to remove it.  If ``keep_ids`` is passed,
+    entries for any other file are dropped.
+
+    The caller must hold the verify lock, so changes from a ``verify`` and
+    a ``scrub`` running at the same time don't overwrite each other.
+    """
+    value = read_json(path)
+
+    for file_id, new_value in changes.items():
+        if new_value is None:
+            value.pop(file_id, None)
+        else:
+            value[file_id] = new_value
+
+    if keep_ids is not None:
+        value = {k: v for k, v in value.items() if k in keep_ids}
+
+    write_json(path, value)
+
+
+def _create_stamp(f, stat):
+    return {
+        "checksum": f.checksum,
+        "inode": stat.st_ino,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "verified_at": datetime.datetime.now().isoformat(),
+    }
+
+
+def _is_unchanged(f, stat, stamp):
+    return stamp is not None and all(
+        [
+            stamp["checksum"] == f.checksum,
+            stamp["inode"] == stat.st_ino,
+            stamp["size"] == stat.st_size,
+            stamp["mtime_ns"] == stat.st_mtime_ns,
+        ]
+    )
+
+
+def verify_file(root, f):
+    """
+    Check a single file.
+
+    Returns a tuple (errors, stat), where ``errors`` is a list of problems
+    with the file.  The file is read at most once.
+    """
+    f_path = os.path.join(root, f.path)
+
+    try:
+        stat = os.stat(f_path)
+    except FileNotFoundError:
+        return [f"Missing file\n  path     = {f_path}"], None
+
+    errors = []
+
+    if f.size != stat.st_size:
+        errors.append(
+            f"Size mismatch\n  actual   = {stat.st_size}\n  expected = {f.size}"
+        )
+
+    actual_checksum = sha256(f_path)
+
+    if f.checksum != actual_checksum:
+        errors.append(
+            f"Checksum mismatch\n  actual   = {actual_checksum}\n  expected = {f.checksum}"
+        )
+
+    return errors, stat
+
+
+def choose_files(root, documents, *, changed_only=False, sample=None):
+    """
+    Choose which files to verify.
+
+    If ``changed_only`` is True, skip files that haven't changed since they
+    were last verified successfully.  If ``sample`` is a percentage, pick
+    that fraction of the remaining files at random.
+    """
+    files = [f for doc in documents for f in doc.files]
+
+    if changed_only:
+        stamps = read_stamps(root)
+
+        def is_changed(f):
+            try:
+                stat = os.stat(os.path.join(root, f.path))
+            except FileNotFoundError:
+                return True
+
+            return not _is_unchanged(f, stat, stamps.get(f.id))
+
+        files = [f for f in files if is_changed(f)]
+
+    if sample is not None:
+        sample_size = min(len(files), math.ceil(len(files) * sample / 100))
+        files = random.sample(files, sample_size)
+
+    return files
+
+
+def verify_files(root, files, *, workers=None, progress=None):
+    """
+    Verify a list of files, using a pool of ``workers`` threads.
+
+    Returns a dict from file ID to a list of errors.  Files that pass are
+    stamped, so they can be skipped later.
+    """
+    errors = {}
+    stamp_changes = {}
+
+    # Hashing releases the GIL, so threads are enough to keep several
+    # disks (or one fast SSD) busy.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(verify_file, root, f): f for f in files}
+
+        for fut in concurrent.futures.as_completed(futures):
+            f = futures[fut]
+            f_errors, stat = fut.result()
+
+            if f_errors:
+                errors[f.id] = f_errors
+                stamp_changes[f.id] = None
+            else:
+                stamp_changes[f.id] = _create_stamp(f, stat)
+
+            if progress is not None:
+                progress()
+
+    with file_lock(verify_lock_path(root)):
+        _merge_json(stamps_path(root), stamp_changes)
+
+    return errors
+
+
+def last_checked(f, *, stamps, scrub_state):
+    """
+    Returns when this file was last checked, by either ``verify_files``
+    or ``scrub``, as an ISO 8601 string -- or None if it's never been checked.
+    """
+    checks = [
+        scrub_state.get(f.id, {}).get("checked_at"),
+        stamps.get(f.id, {}).get("verified_at"),
+    ]
+
+    return max([c for c in checks if c is not None], default=None)
+
+
+@attr.s
+class ByteBudget:
+    """
+    Limits how quickly we read files, by sleeping whenever we get ahead
+    of ``bytes_per_second``.
+    """
+
+    bytes_per_second = attr.ib()
+    bytes_read = attr.ib(default=0, init=False)
+    start = attr.ib(init=False)
+
+    def __attrs_post_init__(self):
+        self.start = time.monotonic()
+
+    def spend(self, size):
+        self.bytes_read += size
+
+        ahead_by = self.bytes_read / self.bytes_per_second - (
+            time.monotonic() - self.start
+        )
+
+        if ahead_by > 0:
+            time.sleep(ahead_by)
+
+
+def scrub(root, *, bytes_per_second, save_interval=60):
+    """
+    Check every stored file once, oldest-checked first, reading no more
+    than ``bytes_per_second``.
+
+    Progress is saved every ``save_interval`` seconds, so if the scrub is
+    interrupted, the next scrub starts with the files it didn't reach.
+
+    Generates a tuple (file, errors) for every file.
+    """
+    documents = get_store(root).snapshot().documents
+    files = [f for doc in documents for f in doc.files]
+
+    stamps = read_stamps(root)
+    scrub_state = read_json(scrub_state_path(root))
+
+    # Files that have never been checked sort first, as ""
+    files.sort(
+        key=lambda f: last_checked(f, stamps=stamps, scrub_state=scrub_state) or ""
+    )
+
+    # The results we haven't saved yet.  We only save our own results, and
+    # re-read the files each time, so we don't overwrite the results of
+    # a ``verify`` that runs while we're scrubbing.
+    stamp_changes = {}
+    scrub_state_changes = {}
+
+    def save():
+        # Forget about files that have been deleted since we last looked.
+        # The scrub can run for a long time, so look at the current files,
+        # not the ones that were stored when we started.
+        file_ids = {
+            f.id for doc in get_store(root).snapshot().documents for f in doc.files
+        }
+
+        with file_lock(verify_lock_path(root)):
+            _merge_json(stamps_path(root), stamp_changes, keep_ids=file_ids)
+            _merge_json(scrub_state_path(root), scrub_state_changes, keep_ids=file_ids)
+
+        stamp_changes.clear()
+        scrub_state_changes.clear()
+
+    budget = ByteBudget(bytes_per_second=bytes_per_second)
+    last_saved = time.monotonic()
+
+    try:
+        for f in files:
+            errors, stat = verify_file(root, f)
+
+            if errors:
+                stamp_changes[f.id] = None
+            else:
+                stamp_changes[f.id] = _create_stamp(f, stat)
+
+            scrub_state_changes[f.id] = {
+                "checked_at": datetime.datetime.now().isoformat(),
+                "errors": errors,
+            }
+
+            yield f, errors
+
+            if time.monotonic() - last_saved >= save_interval:
+                save()
+                last_saved = time.monotonic()
+
+            budget.spend(f.size)
+    finally:
+        save()
+
+
+@attr.s
+class ScrubCoverage:
+    total_files = attr.ib()
+    total_bytes = attr.ib()
+    checked_files = attr.ib()
+    checked_bytes = attr.ib()
+    failed_files = attr.ib()
+    oldest_check = attr.ib()
+
+    @property
+    def ratio(self):
+        if self.total_bytes == 0:
+            return 1.0
+
+        return self.checked_bytes / self.total_bytes
+
+
+def scrub_coverage(root, documents, *, now, window):
+    """
+    How much of the store has been checked in the ``window`` before ``now``.
+
+    ``oldest_check`` is the datetime of the least recent check, or None if
+    there's a file that has never been checked.
+    """
+    stamps = read_stamps(root)
+    scrub_state = read_json(scrub_state_path(root))
+
+    files = [f for doc in documents for f in doc.files]
+
+    checked_files = 0
+    checked_bytes = 0
+    failed_files = 0
+    oldest_check = now
+
+    for f in files:
+        checked_at = last_checked(f, stamps=stamps, scrub_state=scrub_state)
+
+        if checked_at is None:
+            oldest_check = None
+            continue
+
+        checked_at = datetime.datetime.fromisoformat(checked_at)
+
+        if now - checked_at <= window:
+            checked_files += 1
+            checked_bytes += f.size
+
+        if oldest_check is not None:
+            oldest_check = min(oldest_check, checked_at)
+
+        if scrub_state.get(f.id, {}).get("errors"):
+            failed_files += 1
+
+    return ScrubCoverage(
+        total_files=len(files),
+        total_bytes=sum(f.size for f in files),
+        checked_files=checked_files,
+        checked_bytes=checked_bytes,
+        failed_files=failed_files,
+        oldest_check=oldest_check if files else None,
+    )
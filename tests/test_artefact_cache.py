@@ -0,0 +1,92 @@
+import pytest
+
+from docstore import artefact_cache
+from docstore.artefact_cache import ArtefactCache
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return ArtefactCache(str(tmpdir / "cache.sqlite3"))
+
+
+def test_missing_artefact_is_none(cache):
+    assert cache.get("thumbnail", "sha256:123", {"version": 1}) is None
+
+
+def test_can_store_and_retrieve_artefact(cache):
+    cache.put(
+        "thumbnail",
+        "sha256:123",
+        {"version": 1},
+        metadata={"width": 100},
+        data=b"PNG",
+    )
+
+    assert cache.get("thumbnail", "sha256:123", {"version": 1}) == (
+        {"width": 100},
+        b"PNG",
+    )
+
+
+@pytest.mark.parametrize(
+    "kind, checksum, params",
+    [
+        ("tint_color", "sha256:123", {"version": 1}),
+        ("thumbnail", "sha256:456", {"version": 1}),
+        ("thumbnail", "sha256:123", {"version": 2}),
+    ],
+)
+def test_artefacts_are_keyed_on_kind_checksum_and_params(cache, kind, checksum, params):
+    cache.put("thumbnail", "sha256:123", {"version": 1}, metadata={})
+
+    assert cache.get(kind, checksum, params) is None
+
+
+def test_evicts_least_recently_used_artefacts(tmpdir, monkeypatch):
+    now = [1000]
+    monkeypatch.setattr(artefact_cache.time, "time", lambda: now[0])
+
+    cache = ArtefactCache(str(tmpdir / "cache.sqlite3"), max_bytes=2500)
+
+    for checksum in ["a", "b"]:
+        cache.put("thumbnail", checksum, {}, metadata={}, data=b"x" * 1000)
+        now[0] += 1
+
+    # Using "a" makes "b" the least recently used
+    assert cache.get("thumbnail", "a", {}) is not None
+    now[0] += 1
+
+    cache.put("thumbnail", "c", {}, metadata={}, data=b"x" * 1000)
+
+    assert cache.get("thumbnail", "a", {}) is not None
+    assert cache.get("thumbnail", "b", {}) is None
+    assert cache.get("thumbnail", "c", {}) is not None
+
+
+def test_get_or_create_only_creates_once(cache):
+    calls = []
+
+    def create():
+        calls.append(1)
+        return {"tint_color": "#ff0000"}, b""
+
+    for _ in range(3):
+        assert cache.get_or_create("tint_color", "sha256:123", {}, create) == (
+            {"tint_color": "#ff0000"},
+            b"",
+        )
+
+    assert len(calls) == 1
+
+
+def test_get_or_create_without_checksum_always_creates(cache):
+    calls = []
+
+    def create():
+        calls.append(1)
+        return {}, b""
+
+    cache.get_or_create("tint_color", None, {}, create)
+    cache.get_or_create("tint_color", None, {}, create)
+
+    assert len(calls) == 2
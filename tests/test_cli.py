@@ -6,9 +6,11 @@ import uuid
 from click.testing import CliRunner
 import pytest
 
+from docstore import storage
 from docstore.cli import main
 from docstore.documents import read_documents, store_new_document, write_documents
 from docstore.models import Dimensions, Document, File, Thumbnail
+from docstore.storage import SqliteStorage, get_storage, journal_path
 from test_models import is_recent
 
 
@@ -230,3 +232,173 @@ def test_deleting_in_empty_instance_is_error(root, runner):
 
     assert result.exit_code == 1, result.output
     assert result.output.strip() == f"There is no docstore instance at {root}!"
+
+
+def test_compacting_through_cli(root, runner):
+    documents = [
+        Document(title=f"Document {i}", date_saved=datetime.datetime(2001 + i, 1, 1))
+        for i in range(3)
+    ]
+    write_documents(root=root, documents=documents)
+
+    result = runner.invoke(["delete", documents[2].id])
+    assert result.exit_code == 0, result.output
+    assert os.path.exists(journal_path(root))
+
+    result = runner.invoke(["compact"])
+    assert result.exit_code == 0, result.output
+
+    assert not os.path.exists(journal_path(root))
+    assert read_documents(root) == [documents[1], documents[0]]
+
+
+def test_converting_through_cli(root, runner):
+    documents = [Document(title=f"Document {i}") for i in range(3)]
+    write_documents(root=root, documents=documents)
+
+    result = runner.invoke(["convert", "--to", "sqlite"])
+    assert result.exit_code == 0, result.output
+    assert isinstance(get_storage(root), SqliteStorage)
+
+    result = runner.invoke(["convert", "--to", "sqlite"])
+    assert result.exit_code == 1, result.output
+    assert (
+        result.output.strip() == f"The docstore instance at {root} already uses sqlite"
+    )
+
+
+def test_converting_empty_instance_is_error(root, runner):
+    result = runner.invoke(["convert", "--to", "sqlite"])
+
+    assert result.exit_code == 1, result.output
+    assert result.output.strip() == f"There is no docstore instance at {root}!"
+
+
+def test_shows_similar_tags(root, runner):
+    documents = [
+        Document(title="Doc1", tags=["utilities:gas", "utilities:electricity"]),
+        Document(title="Doc2", tags=["recipes", "utilities:gas"]),
+        Document(title="Doc3", tags=["recipe"]),
+    ]
+    write_documents(root=root, documents=documents)
+
+    result = runner.invoke(["show-similar-tags"])
+    assert result.exit_code == 0, result.output
+    assert result.output == "  1 recipe\n  1 recipes\n\n"
+
+
+def test_deleting_many_documents_is_one_write(root, runner, monkeypatch):
+    documents = [Document(title=f"Document {i}") for i in range(5)]
+    write_documents(root=root, documents=documents)
+
+    calls = []
+    original_apply = storage.JsonStorage.apply
+
+    def counting_apply(self, changes):
+        calls.append(changes)
+        return original_apply(self, changes)
+
+    monkeypatch.setattr(storage.JsonStorage, "apply", counting_apply)
+
+    result = runner.invoke(["delete"] + [doc.id for doc in documents[:4]])
+    assert result.exit_code == 0, result.output
+    assert result.output.split() == [doc.id for doc in documents[:4]]
+
+    assert len(calls) == 1
+    assert read_documents(root) == documents[4:]
+
+
+def test_adding_many_documents_through_cli(tmpdir, root, runner):
+    os.makedirs(tmpdir / "scans")
+    for i in range(3):
+        shutil.copyfile("tests/files/cluster.png", tmpdir / "scans" / f"scan{i}.png")
+
+    result = runner.invoke(
+        ["add-many", str(tmpdir / "scans"), "--tags", "scans, 2020", "--workers", "2"]
+    )
+    assert result.exit_code == 0, result.output
+
+    documents = read_documents(root)
+    assert sorted(result.output.split()) == sorted(doc.id for doc in documents)
+    assert sorted(doc.title for doc in documents) == ["scan0", "scan1", "scan2"]
+    assert all(doc.tags == ["scans", "2020"] for doc in documents)
+
+
+def test_reports_duplicates_when_adding_many(tmpdir, root, runner):
+    os.makedirs(tmpdir / "scans")
+    for i in range(3):
+        shutil.copyfile("tests/files/cluster.png", tmpdir / "scans" / f"scan{i}.png")
+
+    result = runner.invoke(
+        ["add-many", str(tmpdir / "scans"), "--on_duplicate", "skip"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "Found 2 duplicates" in result.output
+
+    assert len(read_documents(root)) == 1
+
+
+@pytest.mark.parametrize("sample", ["0%", "150", "lots"])
+def test_verify_rejects_bad_sample(root, runner, sample):
+    result = runner.invoke(["verify", "--sample", sample])
+
+    assert result.exit_code == 2
+    assert "--sample" in result.output
+
+
+def test_scrubbing_through_cli(root, runner):
+    result = runner.invoke(["scrub", "--once", "--bytes_per_second", "20M"])
+
+    assert result.exit_code == 0, result.output
+    assert "Checked 0 files; 100.0% of the store checked" in result.output
+
+
+def test_scrub_rejects_bad_budget(root, runner):
+    result = runner.invoke(["scrub", "--once", "--bytes_per_second", "fast"])
+
+    assert result.exit_code == 2
+
+
+def test_creating_deferred_thumbnails_through_cli(tmpdir, root, runner):
+    shutil.copyfile(src="tests/files/cluster.png", dst=tmpdir / "cluster.png")
+
+    result = runner.invoke(
+        [
+            "add",
+            str(tmpdir / "cluster.png"),
+            "--title",
+            "My cluster",
+            "--tags",
+            "",
+            "--defer_thumbnail",
+        ]
+    )
+    assert result.exit_code == 0, result.output
+
+    (doc,) = read_documents(root)
+    assert doc.files[0].thumbnail.path.endswith(".placeholder.png")
+
+    result = runner.invoke(["worker", "--once"])
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == doc.files[0].id
+
+    (doc,) = read_documents(root)
+    assert doc.files[0].thumbnail.path == "thumbnails/c/cluster.png"
+
+
+def test_regenerates_thumbnails(tmpdir, root, runner):
+    shutil.copyfile("tests/files/cluster.png", tmpdir / "cluster.png")
+    runner.invoke(
+        ["add", str(tmpdir / "cluster.png"), "--title", "Cluster", "--tags", "x"]
+    )
+
+    result = runner.invoke(["regenerate-thumbnails", "--max_size", "100"])
+    assert result.exit_code == 0, result.output
+
+    (doc,) = read_documents(root)
+    assert result.output.strip() == doc.files[0].id
+    assert doc.files[0].thumbnail.dimensions.width == 100
+
+    result = runner.invoke(["regenerate-thumbnails", "--max_size", "100"])
+    assert result.exit_code == 0, result.output
+    assert result.output == ""
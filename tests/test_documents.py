@@ -1,17 +1,32 @@
+import concurrent.futures
 import datetime
 import json
 import os
 import shutil
+import threading
 
+import attr
+import pytest
+
+from docstore import documents as documents_module, storage, thumbnails
 from docstore.documents import (
+    MAX_RANDOM_ORDERS,
+    DocumentStore,
+    Snapshot,
+    compact_documents,
     delete_document,
+    find_original_filename,
+    get_store,
     pairwise_merge_documents,
     read_documents,
     sha256,
     store_new_document,
     write_documents,
 )
-from docstore.models import Dimensions, Document, File, Thumbnail
+from docstore.job_queue import thumbnail_queue
+from docstore.models import Dimensions, Document, File, Thumbnail, ThumbnailVariant
+from docstore.storage import db_path, journal_path
+from docstore.thumbnails import get_dimensions
 
 
 def test_sha256():
@@ -139,9 +154,27 @@ def test_store_new_document(tmpdir):
     assert new_file.thumbnail == Thumbnail(
         path="thumbnails/m/my-cluster.png",
         dimensions=Dimensions(400, 260),
-        tint_color="#007f7f",
+        tint_color="#008080",
+        variants=[
+            ThumbnailVariant(
+                path="thumbnails/m/my-cluster.200.webp",
+                dimensions=Dimensions(200, 130),
+                media_type="image/webp",
+            ),
+            ThumbnailVariant(
+                path="thumbnails/m/my-cluster.400.webp",
+                dimensions=Dimensions(400, 260),
+                media_type="image/webp",
+            ),
+            ThumbnailVariant(
+                path="thumbnails/m/my-cluster.200.png",
+                dimensions=Dimensions(200, 130),
+                media_type="image/png",
+            ),
+        ],
     )
     assert os.path.exists(root / new_file.thumbnail.path)
+    assert all(os.path.exists(root / v.path) for v in new_file.thumbnail.variants)
 
     assert read_documents(root) == [new_document]
 
@@ -166,7 +199,8 @@ def test_store_new_document(tmpdir):
     assert read_documents(root) == [new_document, new_document2]
 
     assert len(os.listdir(root / "files" / "m")) == 2
-    assert len(os.listdir(root / "thumbnails" / "m")) == 2
+    # Each thumbnail has three variants
+    assert len(os.listdir(root / "thumbnails" / "m")) == 2 * 4
 
 
 def test_deleting_document(tmpdir, root):
@@ -197,3 +231,821 @@ def test_deleting_document(tmpdir, root):
     assert json.load(open(deleted_json_path))["id"] == doc1.id
     assert not os.path.exists(root / "files" / "c" / "cluster.png")
     assert os.path.exists(root / "deleted" / doc1.id / "cluster.png")
+    assert os.listdir(root / "thumbnails" / "c") == []
+
+
+def test_deleting_documents_with_a_shared_thumbnail(tmpdir, root):
+    thumbnail = Thumbnail(
+        path="thumbnails/g/generic_document.png",
+        dimensions=Dimensions(400, 400),
+        tint_color="#000000",
+    )
+    os.makedirs(root / "thumbnails" / "g")
+    shutil.copyfile("src/docstore/static/generic_document.png", root / thumbnail.path)
+
+    documents = []
+
+    for name in ["a.txt", "b.txt", "c.txt"]:
+        os.makedirs(root / "files" / name[0])
+        (root / "files" / name[0] / name).write_text("hello world")
+
+        documents.append(
+            Document(
+                title=name,
+                files=[
+                    File(
+                        filename=name,
+                        path=f"files/{name[0]}/{name}",
+                        size=11,
+                        checksum="sha256:123",
+                        thumbnail=thumbnail,
+                    )
+                ],
+            )
+        )
+
+    write_documents(root=root, documents=documents)
+
+    with get_store(root).transaction() as tx:
+        tx.delete(documents[0].id)
+        tx.delete(documents[1].id)
+
+    assert read_documents(root) == [documents[2]]
+    assert os.path.exists(root / "deleted" / documents[0].id / "a.txt")
+    assert os.path.exists(root / "deleted" / documents[1].id / "b.txt")
+
+    # The remaining document still has its thumbnail
+    assert os.path.exists(root / thumbnail.path)
+
+
+def test_files_with_the_generic_icon_have_their_own_thumbnails(tmpdir, root):
+    documents = []
+
+    for name in ["a.txt", "b.txt"]:
+        (tmpdir / name).write_text(f"This is {name}", encoding="utf8")
+
+        documents.append(
+            store_new_document(
+                root=root,
+                path=tmpdir / name,
+                title=name,
+                tags=[],
+                source_url=None,
+                date_saved=datetime.datetime.now(),
+            )
+        )
+
+    thumbnail1 = documents[0].files[0].thumbnail
+    thumbnail2 = documents[1].files[0].thumbnail
+
+    assert thumbnail1.path == "thumbnails/a/a.txt.png"
+    assert thumbnail2.path == "thumbnails/b/b.txt.png"
+
+    delete_document(root, doc_id=documents[0].id)
+
+    assert not os.path.exists(root / thumbnail1.path)
+    assert os.path.exists(root / thumbnail2.path)
+
+
+def test_deleting_a_document_with_a_missing_thumbnail(tmpdir, root):
+    shutil.copyfile(src="tests/files/cluster.png", dst=tmpdir / "cluster.png")
+
+    doc = store_new_document(
+        root=root,
+        path=tmpdir / "cluster.png",
+        title="A document with a missing thumbnail",
+        tags=[],
+        source_url=None,
+        date_saved=datetime.datetime.now(),
+    )
+    os.unlink(root / doc.files[0].thumbnail.path)
+
+    delete_document(root, doc_id=doc.id)
+
+    assert read_documents(root) == []
+    assert os.path.exists(root / "deleted" / doc.id / "cluster.png")
+
+
+def test_changes_are_recorded_in_the_journal(root):
+    doc1 = Document(title="Doc1", date_saved=datetime.datetime(2010, 1, 1))
+    doc2 = Document(title="Doc2", date_saved=datetime.datetime(2002, 2, 2))
+
+    write_documents(root=root, documents=[doc1, doc2])
+    assert not os.path.exists(journal_path(root))
+
+    db_contents = open(db_path(root)).read()
+
+    delete_document(root, doc_id=doc2.id)
+
+    # The database itself is untouched; the change only lives in the journal
+    assert open(db_path(root)).read() == db_contents
+    assert os.path.exists(journal_path(root))
+
+    assert read_documents(root) == [doc1]
+
+
+def test_compacting_folds_the_journal_into_the_database(root):
+    doc1 = Document(title="Doc1", date_saved=datetime.datetime(2010, 1, 1))
+    doc2 = Document(title="Doc2", date_saved=datetime.datetime(2002, 2, 2))
+
+    write_documents(root=root, documents=[doc1, doc2])
+    delete_document(root, doc_id=doc2.id)
+
+    compact_documents(root)
+
+    assert not os.path.exists(journal_path(root))
+    assert read_documents(root) == [doc1]
+
+
+def test_compacts_the_journal_when_it_gets_large(root, monkeypatch):
+    monkeypatch.setattr(storage, "JOURNAL_COMPACTION_MIN_BYTES", 0)
+    monkeypatch.setattr(storage, "JOURNAL_COMPACTION_RATIO", 0)
+
+    doc1 = Document(title="Doc1", date_saved=datetime.datetime(2010, 1, 1))
+    doc2 = Document(title="Doc2", date_saved=datetime.datetime(2002, 2, 2))
+
+    write_documents(root=root, documents=[doc1, doc2])
+    delete_document(root, doc_id=doc2.id)
+
+    assert not os.path.exists(journal_path(root))
+    assert read_documents(root) == [doc1]
+
+
+def test_ignores_an_incomplete_journal_record(root):
+    doc1 = Document(title="Doc1", date_saved=datetime.datetime(2010, 1, 1))
+    doc2 = Document(title="Doc2", date_saved=datetime.datetime(2002, 2, 2))
+
+    write_documents(root=root, documents=[doc1, doc2])
+
+    with open(journal_path(root), "w") as out_file:
+        out_file.write('{"op": "delete", "id": "%s"' % doc1.id)
+
+    assert read_documents(root) == [doc1, doc2]
+
+
+def test_caches_documents_separately_for_each_root(tmpdir):
+    root1 = tmpdir / "root1"
+    root2 = tmpdir / "root2"
+
+    doc1 = Document(title="Doc1")
+    doc2 = Document(title="Doc2")
+
+    write_documents(root=root1, documents=[doc1])
+    write_documents(root=root2, documents=[doc2])
+
+    for _ in range(3):
+        assert read_documents(root1) == [doc1]
+        assert read_documents(root2) == [doc2]
+
+
+def test_counts_cache_hits_and_reloads(root):
+    store = DocumentStore(root)
+    write_documents(root=root, documents=[Document(title="Doc1")])
+
+    store.snapshot()
+    store.snapshot()
+    store.snapshot()
+
+    assert store.stats == {"hits": 2, "misses": 1, "reloads": 1}
+
+    write_documents(root=root, documents=[Document(title="Doc2")])
+    assert [d.title for d in store.snapshot().documents] == ["Doc2"]
+    assert store.stats == {"hits": 2, "misses": 2, "reloads": 2}
+
+
+def test_only_one_thread_reloads_a_stale_snapshot(root, monkeypatch):
+    store = DocumentStore(root)
+
+    doc1 = Document(title="Doc1")
+    write_documents(root=root, documents=[doc1])
+    old_snapshot = store.snapshot()
+
+    doc2 = Document(title="Doc2")
+    write_documents(root=root, documents=[doc2])
+
+    reload_started = threading.Event()
+    finish_reload = threading.Event()
+
+    original_read = storage.JsonStorage.read
+
+    def slow_read(self):
+        reload_started.set()
+        finish_reload.wait()
+        return original_read(self)
+
+    monkeypatch.setattr(storage.JsonStorage, "read", slow_read)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        reloading = executor.submit(store.snapshot)
+        reload_started.wait()
+
+        # While the reload is in progress, other callers get the old snapshot
+        # immediately, rather than parsing the database again.
+        assert store.snapshot() is old_snapshot
+
+        finish_reload.set()
+        assert reloading.result().documents == (doc2,)
+
+    assert store.stats["reloads"] == 2
+    assert store.snapshot().documents == (doc2,)
+
+
+def test_snapshot_indexes():
+    f1 = File(
+        filename="cats.jpg",
+        path="files/c/cats.jpg",
+        size=100,
+        checksum="sha256:123",
+        thumbnail=Thumbnail(
+            path="thumbnails/c/cats.jpg",
+            dimensions=Dimensions(400, 300),
+            tint_color="#ffffff",
+        ),
+    )
+    f2 = attr.evolve(f1, id="f2", path="files/c/cats_1234.jpg")
+    f3 = attr.evolve(f1, id="f3", path="files/d/dogs.jpg", checksum="sha256:456")
+
+    doc1 = Document(title="Doc1", tags=["a", "b"], files=[f1])
+    doc2 = Document(title="Doc2", tags=["b", "c"], files=[f2, f3])
+    doc3 = Document(title="Doc3", tags=["a", "b", "c"])
+
+    snapshot = Snapshot(version=None, documents=[doc1, doc2, doc3])
+
+    assert snapshot.documents_by_id == {doc1.id: doc1, doc2.id: doc2, doc3.id: doc3}
+    assert snapshot.files_by_path == {
+        "files/c/cats.jpg": f1,
+        "files/c/cats_1234.jpg": f2,
+        "files/d/dogs.jpg": f3,
+    }
+    assert snapshot.files_by_checksum == {"sha256:123": [f1, f2], "sha256:456": [f3]}
+    assert snapshot.document_positions_by_tag == {
+        "a": (0, 2),
+        "b": (0, 1, 2),
+        "c": (1, 2),
+    }
+
+    assert list(snapshot.positions_with_tags(set())) == [0, 1, 2]
+    assert snapshot.positions_with_tags({"b"}) == [0, 1, 2]
+    assert snapshot.positions_with_tags({"a", "b"}) == [0, 2]
+    assert snapshot.positions_with_tags({"a", "c"}) == [2]
+    assert snapshot.positions_with_tags({"a", "d"}) == []
+
+
+def test_snapshot_sort_orders():
+    doc1 = Document(
+        title="banana", tags=["a"], date_saved=datetime.datetime(2001, 1, 1)
+    )
+    doc2 = Document(title="Apple", tags=["b"], date_saved=datetime.datetime(2003, 1, 1))
+    doc3 = Document(
+        title="cherry", tags=["a"], date_saved=datetime.datetime(2002, 1, 1)
+    )
+
+    snapshot = Snapshot(version=None, documents=[doc1, doc2, doc3])
+
+    assert snapshot.sort_order("date_saved") == (0, 2, 1)
+    assert snapshot.sort_order("date_saved", reverse=True) == (1, 2, 0)
+    assert snapshot.sort_order("title") == (1, 0, 2)
+    assert snapshot.sort_order("title", reverse=True) == (2, 0, 1)
+
+    # Each order is only sorted once
+    assert snapshot.sort_order("title") is snapshot.sort_order("title")
+
+    order = snapshot.sort_order("title", reverse=True)
+    assert snapshot.page_of_documents(set(), order=order, page_size=10) == (
+        [doc3, doc1, doc2],
+        3,
+    )
+    assert snapshot.page_of_documents({"a"}, order=order, page_size=10) == (
+        [doc3, doc1],
+        2,
+    )
+    assert snapshot.page_of_documents({"d"}, order=order, page_size=10) == ([], 0)
+
+
+def test_snapshot_random_order():
+    documents = [Document(title=f"Doc{i}") for i in range(20)]
+    snapshot = Snapshot(version=None, documents=documents)
+
+    order = snapshot.random_order(b"seed")
+
+    assert sorted(order) == list(range(20))
+    assert snapshot.random_order(b"seed") is order
+    assert snapshot.random_order(b"another seed") != order
+
+    # The shuffle depends only on the seed, not on the snapshot
+    assert Snapshot(version=None, documents=documents).random_order(b"seed") == order
+
+
+def test_snapshot_rank_in_order():
+    documents = [Document(title=f"Doc{i}") for i in range(20)]
+    snapshot = Snapshot(version=None, documents=documents)
+
+    orders = [snapshot.sort_order("title")] + [
+        snapshot.random_order(seed) for seed in range(MAX_RANDOM_ORDERS + 2)
+    ]
+
+    for order in orders:
+        assert [snapshot.rank_in_order(order, pos) for pos in order] == list(range(20))
+
+    # Orders we didn't create are searched instead
+    assert snapshot.rank_in_order((3, 1, 2), 2) == 2
+
+
+def test_snapshot_page_of_documents():
+    documents = [
+        Document(title=f"Doc{i}", tags=["even" if i % 2 == 0 else "odd"])
+        for i in range(10)
+    ]
+    snapshot = Snapshot(version=None, documents=documents)
+    order = tuple(reversed(range(10)))
+
+    assert snapshot.page_of_documents(set(), order=order, page_size=3) == (
+        [documents[9], documents[8], documents[7]],
+        10,
+    )
+    assert snapshot.page_of_documents({"even"}, order=order, page_size=3, offset=3) == (
+        [documents[2], documents[0]],
+        5,
+    )
+
+    # A cursor starts the page after that document
+    assert snapshot.page_of_documents(
+        {"even"}, order=order, page_size=2, after=documents[7].id
+    ) == ([documents[6], documents[4]], 5)
+    assert snapshot.page_of_documents(
+        set(), order=order, page_size=2, offset=6, after=documents[7].id
+    ) == ([documents[6], documents[5]], 10)
+
+    # An unknown cursor falls back to the offset
+    assert snapshot.page_of_documents(
+        set(), order=order, page_size=2, offset=6, after="deleted"
+    ) == ([documents[3], documents[2]], 10)
+
+    assert snapshot.page_of_documents({"missing"}, order=order, page_size=2) == (
+        [],
+        0,
+    )
+
+
+def test_snapshot_tag_tally():
+    doc1 = Document(title="Doc1", tags=["a", "b"])
+    doc2 = Document(title="Doc2", tags=["b", "c"])
+    snapshot = Snapshot(version=None, documents=[doc1, doc2])
+
+    assert snapshot.tag_tally(set()) == {"a": 1, "b": 2, "c": 1}
+    assert snapshot.tag_tally({"c"}) == {"b": 1, "c": 1}
+    assert snapshot.tag_tally({"d"}) == {}
+
+
+def test_find_original_filename(root):
+    thumbnail = Thumbnail(
+        path="thumbnails/c/cats.jpg",
+        dimensions=Dimensions(400, 300),
+        tint_color="#ffffff",
+    )
+    doc = Document(
+        title="Doc1",
+        files=[
+            File(
+                filename="Cats & Dogs.jpg",
+                path="files/c/cats-dogs.jpg",
+                size=100,
+                checksum="sha256:123",
+                thumbnail=thumbnail,
+            )
+        ],
+    )
+    write_documents(root=root, documents=[doc])
+
+    assert (
+        find_original_filename(root, path=root / "files" / "c" / "cats-dogs.jpg")
+        == "Cats & Dogs.jpg"
+    )
+
+    with pytest.raises(ValueError, match="Couldn't find file stored with path"):
+        find_original_filename(root, path=root / "files" / "d" / "dogs.jpg")
+
+
+class TestTransaction:
+    @pytest.fixture
+    def documents(self, root):
+        documents = [
+            Document(
+                title=f"Doc{i}",
+                tags=[f"tag{i}"],
+                date_saved=datetime.datetime(2001 + i, 1, 1),
+            )
+            for i in range(4)
+        ]
+        write_documents(root=root, documents=documents)
+        return documents
+
+    @pytest.fixture
+    def apply_calls(self, monkeypatch):
+        calls = []
+        original_apply = storage.JsonStorage.apply
+
+        def counting_apply(self, changes):
+            calls.append(changes)
+            return original_apply(self, changes)
+
+        monkeypatch.setattr(storage.JsonStorage, "apply", counting_apply)
+        return calls
+
+    def test_commits_all_changes_in_one_write(self, root, documents, apply_calls):
+        new_doc = Document(title="NewDoc", date_saved=datetime.datetime(2000, 1, 1))
+
+        with get_store(root).transaction() as tx:
+            tx.delete(documents[0].id)
+            tx.set_tags(documents[1].id, tags=["retagged"])
+            merged_doc = tx.merge(
+                doc1=documents[2],
+                doc2=documents[3],
+                new_title="Merged",
+                new_tags=["tag2", "tag3"],
+            )
+            tx.add(new_doc)
+
+            # Nothing is written until the transaction finishes
+            assert len(read_documents(root)) == 4
+
+        assert len(apply_calls) == 1
+
+        assert read_documents(root) == [
+            merged_doc,
+            attr.evolve(documents[1], tags=["retagged"]),
+            new_doc,
+        ]
+        assert merged_doc.title == "Merged"
+        assert merged_doc.date_saved == documents[2].date_saved
+        assert os.path.exists(root / "deleted" / documents[0].id / "document.json")
+        assert not os.path.exists(root / "deleted" / documents[3].id)
+
+    def test_later_changes_see_earlier_ones(self, root, documents):
+        with get_store(root).transaction() as tx:
+            tx.set_tags(documents[0].id, tags=["a"])
+            tx.set_tags(documents[0].id, tags=tx.get(documents[0].id).tags + ["b"])
+
+        assert read_documents(root)[-1].tags == ["a", "b"]
+
+    def test_nothing_is_written_if_there_is_an_error(
+        self, root, documents, apply_calls
+    ):
+        with pytest.raises(KeyError):
+            with get_store(root).transaction() as tx:
+                tx.delete(documents[0].id)
+                tx.delete("doesnotexist")
+
+        assert apply_calls == []
+        assert len(read_documents(root)) == 4
+        assert not os.path.exists(root / "deleted")
+
+    def test_empty_transaction_does_not_write(self, root, documents, apply_calls):
+        with get_store(root).transaction():
+            pass
+
+        assert apply_calls == []
+
+    def test_cannot_update_a_missing_document(self, root, documents):
+        with pytest.raises(KeyError):
+            with get_store(root).transaction() as tx:
+                tx.update(Document(title="NewDoc"))
+
+    def test_can_set_thumbnail(self, root):
+        thumbnails = [
+            Thumbnail(
+                path=f"thumbnails/{i}.png",
+                dimensions=Dimensions(1, 1),
+                tint_color="#000",
+            )
+            for i in range(3)
+        ]
+        files = [
+            File(
+                filename=f"{i}.png",
+                path=f"files/{i}.png",
+                size=1,
+                checksum="sha256:123",
+                thumbnail=thumbnails[i],
+            )
+            for i in range(2)
+        ]
+        doc = Document(title="Doc", files=files)
+        write_documents(root=root, documents=[doc])
+
+        with get_store(root).transaction() as tx:
+            old_thumbnail = tx.set_thumbnail(files[1].id, thumbnail=thumbnails[2])
+
+        assert old_thumbnail == thumbnails[1]
+        assert [f.thumbnail for f in read_documents(root)[0].files] == [
+            thumbnails[0],
+            thumbnails[2],
+        ]
+
+        with pytest.raises(KeyError):
+            with get_store(root).transaction() as tx:
+                tx.set_thumbnail("doesnotexist", thumbnail=thumbnails[0])
+
+
+class TestDuplicates:
+    @pytest.fixture
+    def original(self, tmpdir, root):
+        shutil.copyfile(src="tests/files/cluster.png", dst=tmpdir / "cluster.png")
+
+        return store_new_document(
+            root=root,
+            path=tmpdir / "cluster.png",
+            title="The original",
+            tags=["tag1"],
+            source_url=None,
+            date_saved=datetime.datetime(2001, 1, 1),
+        )
+
+    def store_duplicate(self, tmpdir, root, on_duplicate):
+        shutil.copyfile(src="tests/files/cluster.png", dst=tmpdir / "copy.png")
+
+        return store_new_document(
+            root=root,
+            path=tmpdir / "copy.png",
+            title="The copy",
+            tags=["tag1", "tag2"],
+            source_url="https://example.org/copy.png",
+            date_saved=datetime.datetime(2002, 2, 2),
+            on_duplicate=on_duplicate,
+        )
+
+    def test_can_skip_duplicates(self, tmpdir, root, original):
+        doc = self.store_duplicate(tmpdir, root, on_duplicate="skip")
+
+        assert doc == original
+        assert read_documents(root) == [original]
+        assert os.path.exists(tmpdir / "copy.png")
+
+    def test_can_attach_duplicates(self, tmpdir, root, original):
+        doc = self.store_duplicate(tmpdir, root, on_duplicate="attach")
+
+        assert doc.id == original.id
+        assert doc.title == "The original"
+        assert doc.tags == ["tag1", "tag2"]
+        assert doc.files[0].source_url == "https://example.org/copy.png"
+        assert read_documents(root) == [doc]
+        assert not os.path.exists(tmpdir / "copy.png")
+
+    def test_can_hardlink_duplicates(self, tmpdir, root, original, monkeypatch):
+        def fail_create_thumbnail(path):
+            raise AssertionError("Should not create a new thumbnail")
+
+        monkeypatch.setattr(documents_module, "create_thumbnail", fail_create_thumbnail)
+
+        doc = self.store_duplicate(tmpdir, root, on_duplicate="hardlink")
+
+        assert doc.id != original.id
+        assert doc.title == "The copy"
+        assert read_documents(root) == [original, doc]
+
+        new_file = doc.files[0]
+        original_file = original.files[0]
+
+        assert new_file.path == "files/c/copy.png"
+        assert new_file.checksum == original_file.checksum
+        assert new_file.thumbnail.path == "thumbnails/c/copy.png"
+        assert new_file.thumbnail.dimensions == original_file.thumbnail.dimensions
+
+        assert os.path.samefile(root / new_file.path, root / original_file.path)
+        assert os.path.samefile(
+            root / new_file.thumbnail.path, root / original_file.thumbnail.path
+        )
+
+        assert [v.path for v in new_file.thumbnail.variants] == [
+            "thumbnails/c/copy.200.webp",
+            "thumbnails/c/copy.400.webp",
+            "thumbnails/c/copy.200.png",
+        ]
+        for new_v, original_v in zip(
+            new_file.thumbnail.variants, original_file.thumbnail.variants
+        ):
+            assert os.path.samefile(root / new_v.path, root / original_v.path)
+
+        # They have the same names as a thumbnail created for the new file
+        thumbnail = documents_module.create_file_thumbnail(
+            root=root, file_path=str(root / new_file.path), checksum=new_file.checksum
+        )
+        assert thumbnail == new_file.thumbnail
+
+        # Deleting one copy leaves the other intact
+        delete_document(root, doc_id=original.id)
+        assert os.path.exists(root / new_file.path)
+        assert os.path.exists(root / new_file.thumbnail.path)
+        assert all(os.path.exists(root / v.path) for v in new_file.thumbnail.variants)
+
+    def test_hardlinked_duplicates_of_the_generic_icon_are_pngs(self, tmpdir, root):
+        # Older stores have files that share the generic icon as their
+        # thumbnail, rather than a copy named after the file
+        os.makedirs(root / "files" / "o")
+        (root / "files" / "o" / "original.txt").write_text("hello world")
+
+        os.makedirs(root / "thumbnails" / "g")
+        shutil.copyfile(
+            "src/docstore/static/generic_document.png",
+            root / "thumbnails" / "g" / "generic_document.png",
+        )
+
+        original = Document(
+            title="The original",
+            files=[
+                File(
+                    filename="original.txt",
+                    path="files/o/original.txt",
+                    size=11,
+                    checksum=sha256(root / "files" / "o" / "original.txt"),
+                    thumbnail=Thumbnail(
+                        path="thumbnails/g/generic_document.png",
+                        dimensions=Dimensions(400, 400),
+                        tint_color="#000000",
+                    ),
+                )
+            ],
+        )
+        write_documents(root=root, documents=[original])
+
+        (tmpdir / "copy.txt").write_text("hello world", encoding="utf8")
+
+        doc = store_new_document(
+            root=root,
+            path=tmpdir / "copy.txt",
+            title="The copy",
+            tags=[],
+            source_url=None,
+            date_saved=datetime.datetime.now(),
+            on_duplicate="hardlink",
+        )
+
+        new_file = doc.files[0]
+
+        assert new_file.path == "files/c/copy.txt"
+        assert new_file.thumbnail.path == "thumbnails/c/copy.txt.png"
+        assert os.path.samefile(
+            root / new_file.thumbnail.path,
+            root / "thumbnails" / "g" / "generic_document.png",
+        )
+
+    def test_stores_duplicates_by_default(self, tmpdir, root, original):
+        doc = self.store_duplicate(tmpdir, root, on_duplicate="store")
+
+        assert doc.id != original.id
+        assert len(read_documents(root)) == 2
+
+    def test_unrecognised_duplicate_policy_is_error(self, tmpdir, root, original):
+        with pytest.raises(ValueError, match="Unrecognised duplicate policy"):
+            self.store_duplicate(tmpdir, root, on_duplicate="ignore")
+
+
+def test_can_defer_creating_thumbnail(tmpdir, root, monkeypatch):
+    def no_thumbnails(*args, **kwargs):
+        raise AssertionError("Tried to create a thumbnail")
+
+    monkeypatch.setattr(documents_module, "create_thumbnail", no_thumbnails)
+
+    shutil.copyfile(src="tests/files/cluster.png", dst=tmpdir / "cluster.png")
+
+    doc = store_new_document(
+        root=root,
+        path=str(tmpdir / "cluster.png"),
+        title="My cluster",
+        tags=[],
+        source_url=None,
+        date_saved=datetime.datetime.now(),
+        defer_thumbnail=True,
+    )
+
+    thumbnail = doc.files[0].thumbnail
+    assert thumbnail.path == "thumbnails/c/cluster.png.placeholder.png"
+    assert os.path.exists(root / thumbnail.path)
+    assert read_documents(root) == [doc]
+
+    assert thumbnail_queue(root).jobs() == [
+        (
+            doc.files[0].id,
+            {
+                "file_id": doc.files[0].id,
+                "path": "files/c/cluster.png",
+                "checksum": doc.files[0].checksum,
+            },
+        )
+    ]
+
+
+def test_reuses_thumbnails_and_tint_colors_for_identical_files(
+    tmpdir, root, monkeypatch
+):
+    calls = []
+
+    def counting(fn):
+        def wrapper(*args, **kwargs):
+            calls.append(fn.__name__)
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+    monkeypatch.setattr(
+        documents_module,
+        "create_thumbnail",
+        counting(documents_module.create_thumbnail),
+    )
+    monkeypatch.setattr(
+        documents_module,
+        "choose_tint_color",
+        counting(documents_module.choose_tint_color),
+    )
+
+    stored = []
+
+    for _ in range(2):
+        shutil.copyfile(src="tests/files/cluster.png", dst=tmpdir / "cluster.png")
+        stored.append(
+            store_new_document(
+                root=root,
+                path=str(tmpdir / "cluster.png"),
+                title="My cluster",
+                tags=[],
+                source_url=None,
+                date_saved=datetime.datetime.now(),
+            )
+        )
+
+    assert calls == ["create_thumbnail", "choose_tint_color"]
+
+    thumbnail1 = stored[0].files[0].thumbnail
+    thumbnail2 = stored[1].files[0].thumbnail
+
+    assert thumbnail1.path == "thumbnails/c/cluster.png"
+    assert thumbnail2.path.startswith("thumbnails/c/cluster_")
+    assert thumbnail2.dimensions == thumbnail1.dimensions
+    assert thumbnail2.tint_color == thumbnail1.tint_color
+
+    assert (root / thumbnail1.path).read_bytes() == (
+        root / thumbnail2.path
+    ).read_bytes()
+
+
+def test_does_not_reuse_the_generic_thumbnail(tmpdir, root, monkeypatch):
+    os.makedirs(root / "files" / "n")
+    file_path = str(root / "files" / "n" / "notes.txt")
+    with open(file_path, "w") as outfile:
+        outfile.write("hello world")
+
+    # The first time, we can't create a thumbnail, so we get the generic icon
+    monkeypatch.setattr(thumbnails, "THUMBNAILERS", {"other": []})
+
+    thumbnail1 = documents_module.create_file_thumbnail(
+        root=root, file_path=file_path, checksum=sha256(file_path)
+    )
+
+    assert thumbnail1.dimensions == get_dimensions(
+        "src/docstore/static/generic_document.png"
+    )
+
+    # Then somebody installs a thumbnailer, and we try again
+    def fake_thumbnailer(*, path, max_size, out_dir):
+        out_path = os.path.join(out_dir, "notes.txt.png")
+        shutil.copyfile("tests/files/cluster.png", out_path)
+        return out_path, get_dimensions(out_path)
+
+    monkeypatch.setattr(thumbnails, "THUMBNAILERS", {"other": [fake_thumbnailer]})
+
+    thumbnail2 = documents_module.create_file_thumbnail(
+        root=root, file_path=file_path, checksum=sha256(file_path)
+    )
+
+    assert thumbnail2.dimensions == get_dimensions("tests/files/cluster.png")
+    assert (root / thumbnail2.path).read_bytes() == open(
+        "tests/files/cluster.png", "rb"
+    ).read()
+
+
+def test_reuses_tint_colors_chosen_outside_ingest(tmpdir, root, monkeypatch):
+    # e.g. by a migration
+    tint_color = documents_module.choose_file_tint_color(
+        root=root,
+        thumbnail_path="tests/files/cluster.png",
+        file_path="tests/files/cluster.png",
+        checksum=sha256("tests/files/cluster.png"),
+    )
+
+    def no_tint_colors(*args, **kwargs):
+        raise AssertionError("Tried to choose a tint colour")
+
+    monkeypatch.setattr(documents_module, "choose_tint_color", no_tint_colors)
+
+    shutil.copyfile(src="tests/files/cluster.png", dst=tmpdir / "cluster.png")
+
+    doc = store_new_document(
+        root=root,
+        path=tmpdir / "cluster.png",
+        title="My cluster",
+        tags=[],
+        source_url=None,
+        date_saved=datetime.datetime.now(),
+    )
+
+    assert doc.files[0].thumbnail.tint_color == tint_color
@@ -1,7 +1,16 @@
 import concurrent.futures
+import hashlib
 import os
 
-from docstore.file_normalisation import normalised_filename_copy
+import pytest
+
+from docstore import file_normalisation
+from docstore.documents import sha256
+from docstore.file_normalisation import (
+    BUFFER_SIZE,
+    normalised_filename_copy,
+    normalised_filename_copy_with_checksum,
+)
 
 
 def test_copies_a_file(tmpdir):
@@ -77,3 +86,45 @@ def test_copies_multiple_files_concurrently(tmpdir):
     }
 
     assert dst_contents == {"Hello world", "Bonjour le monde", "Hallo Welt"}
+
+
+def test_computes_checksum_while_copying(tmpdir):
+    src = tmpdir / "src.bin"
+    dst = tmpdir / "dst.bin"
+
+    # Bigger than the copy buffer, so we copy it in several chunks
+    data = os.urandom(BUFFER_SIZE * 2 + 123)
+    src.write_binary(data)
+
+    out_path, size, checksum = normalised_filename_copy_with_checksum(src=src, dst=dst)
+
+    assert out_path == dst
+    assert dst.read_binary() == data
+    assert size == len(data)
+    assert checksum == "sha256:" + hashlib.sha256(data).hexdigest()
+    assert checksum == sha256(out_path)
+
+
+def test_missing_source_does_not_leave_a_file_behind(tmpdir):
+    with pytest.raises(FileNotFoundError):
+        normalised_filename_copy_with_checksum(
+            src=tmpdir / "missing.txt", dst=tmpdir / "dst.txt"
+        )
+
+    assert not (tmpdir / "dst.txt").exists()
+
+
+def test_failed_copy_does_not_leave_a_partial_file_behind(tmpdir, monkeypatch):
+    src = tmpdir / "src.bin"
+    src.write_binary(os.urandom(BUFFER_SIZE * 2))
+
+    def failing_copy(infile, out_file):
+        out_file.write(infile.read(BUFFER_SIZE))
+        raise OSError("Read error")
+
+    monkeypatch.setattr(file_normalisation, "_copy_and_hash", failing_copy)
+
+    with pytest.raises(OSError, match="Read error"):
+        normalised_filename_copy_with_checksum(src=src, dst=tmpdir / "out" / "dst.bin")
+
+    assert os.listdir(tmpdir / "out") == []
@@ -0,0 +1,365 @@
+import concurrent.futures
+import json
+import os
+import shutil
+
+import pytest
+
+from docstore.documents import delete_document, get_store, read_documents
+from docstore.ingest import (
+    create_queued_thumbnails,
+    entries_from_directory,
+    read_manifest,
+    regenerate_thumbnails,
+    store_many_documents,
+)
+from docstore.job_queue import thumbnail_queue
+from docstore.models import Dimensions
+
+
+def test_reads_csv_manifest(tmpdir):
+    manifest_path = str(tmpdir / "manifest.csv")
+
+    with open(manifest_path, "w") as out_file:
+        out_file.write(
+            "path,title,tags,source_url\n"
+            'statement.pdf,My statement,"bank, statement",https://example.org\n'
+            "/scans/letter.pdf,,,\n"
+        )
+
+    assert read_manifest(manifest_path) == [
+        {
+            "path": str(tmpdir / "statement.pdf"),
+            "title": "My statement",
+            "tags": ["bank", "statement"],
+            "source_url": "https://example.org",
+        },
+        {
+            "path": "/scans/letter.pdf",
+            "title": "",
+            "tags": [],
+            "source_url": None,
+        },
+    ]
+
+
+def test_reads_jsonl_manifest(tmpdir):
+    manifest_path = str(tmpdir / "manifest.jsonl")
+
+    with open(manifest_path, "w") as out_file:
+        out_file.write(
+            json.dumps({"path": "a.pdf", "title": "A", "tags": ["x", "y"]})
+            + "\n\n"
+            + json.dumps({"path": "b.pdf", "tags": "z"})
+            + "\n"
+        )
+
+    assert read_manifest(manifest_path) == [
+        {
+            "path": str(tmpdir / "a.pdf"),
+            "title": "A",
+            "tags": ["x", "y"],
+            "source_url": None,
+        },
+        {
+            "path": str(tmpdir / "b.pdf"),
+            "title": "",
+            "tags": ["z"],
+            "source_url": None,
+        },
+    ]
+
+
+def test_unrecognised_manifest_is_error(tmpdir):
+    with pytest.raises(ValueError, match="Unrecognised manifest format"):
+        read_manifest(str(tmpdir / "manifest.xml"))
+
+
+def test_creates_entries_from_directory(tmpdir):
+    for name in ("b.pdf", "a.png", ".DS_Store"):
+        (tmpdir / name).write("")
+    os.makedirs(tmpdir / "subdir")
+
+    assert entries_from_directory(str(tmpdir), tags=["scans"]) == [
+        {
+            "path": str(tmpdir / "a.png"),
+            "title": "a",
+            "tags": ["scans"],
+            "source_url": None,
+        },
+        {
+            "path": str(tmpdir / "b.pdf"),
+            "title": "b",
+            "tags": ["scans"],
+            "source_url": None,
+        },
+    ]
+
+
+def test_stores_many_documents(tmpdir, root):
+    entries = []
+
+    for i in range(5):
+        path = str(tmpdir / f"cluster{i}.png")
+        shutil.copyfile("tests/files/cluster.png", path)
+        entries.append(
+            {"path": path, "title": f"Cluster {i}", "tags": ["x"], "source_url": None}
+        )
+
+    results = list(store_many_documents(root, entries, workers=2, batch_size=2))
+
+    assert [r.entry for r in results] == entries
+    assert {doc.title for doc in read_documents(root)} == {
+        f"Cluster {i}" for i in range(5)
+    }
+    assert not any(os.path.exists(e["path"]) for e in entries)
+
+
+def test_reports_files_that_cannot_be_stored(tmpdir, root):
+    entries = [
+        {
+            "path": str(tmpdir / "doesnotexist.pdf"),
+            "title": "Missing",
+            "tags": [],
+            "source_url": None,
+        }
+    ]
+
+    (result,) = store_many_documents(root, entries, workers=1)
+
+    assert result.entry == entries[0]
+    assert isinstance(result.error, FileNotFoundError)
+    assert read_documents(root) == []
+
+
+@pytest.mark.parametrize("on_duplicate", ["skip", "attach", "hardlink"])
+def test_detects_duplicates(tmpdir, root, on_duplicate):
+    entries = []
+
+    for i in range(3):
+        path = str(tmpdir / f"cluster{i}.png")
+        shutil.copyfile("tests/files/cluster.png", path)
+        entries.append(
+            {"path": path, "title": f"Cluster {i}", "tags": [], "source_url": None}
+        )
+
+    results = list(
+        store_many_documents(root, entries, workers=2, on_duplicate=on_duplicate)
+    )
+
+    assert [r.error for r in results] == [None, None, None]
+    assert [r.duplicate_of for r in results] == [
+        None,
+        results[0].document,
+        results[0].document,
+    ]
+
+
+def test_unrecognised_duplicate_policy_is_error(root):
+    with pytest.raises(ValueError, match="Unrecognised duplicate policy"):
+        list(store_many_documents(root, [], on_duplicate="ignore"))
+
+
+def test_creates_queued_thumbnails(tmpdir, root):
+    entries = []
+
+    for i in range(3):
+        path = str(tmpdir / f"cluster{i}.png")
+        shutil.copyfile("tests/files/cluster.png", path)
+        entries.append({"path": path, "title": "", "tags": [], "source_url": None})
+
+    results = list(store_many_documents(root, entries, defer_thumbnails=True))
+    placeholders = [r.document.files[0].thumbnail for r in results]
+
+    assert len(thumbnail_queue(root)) == 3
+    assert all(t.path.endswith(".placeholder.png") for t in placeholders)
+
+    # If a file is deleted before its thumbnail is created, the job is dropped
+    delete_document(root, doc_id=results[0].document.id)
+
+    thumbnail_results = list(create_queued_thumbnails(root, workers=2, batch_size=1))
+
+    assert [r.file_id for r in thumbnail_results] == [
+        r.document.files[0].id for r in results[1:]
+    ]
+    assert all(r.error is None for r in thumbnail_results)
+    assert len(thumbnail_queue(root)) == 0
+
+    stored_thumbnails = [doc.files[0].thumbnail for doc in read_documents(root)]
+
+    assert sorted(t.path for t in stored_thumbnails) == [
+        "thumbnails/c/cluster1.png",
+        "thumbnails/c/cluster2.png",
+    ]
+    assert all(os.path.exists(root / t.path) for t in stored_thumbnails)
+    assert not any(os.path.exists(root / t.path) for t in placeholders)
+
+
+class InterruptedExecutor:
+    """
+    Runs each job when its result is requested, but first calls
+    ``interruption()`` -- to simulate somebody changing the database
+    while the workers are busy.
+    """
+
+    def __init__(self, interruption):
+        self.interruption = interruption
+
+    def __call__(self, max_workers=None):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def submit(self, fn, *args):
+        executor = self
+
+        class Future:
+            def result(self):
+                if executor.interruption is not None:
+                    executor.interruption()
+                    executor.interruption = None
+
+                return fn(*args)
+
+            def cancel(self):
+                pass
+
+        return Future()
+
+
+def test_queued_thumbnails_do_not_undo_concurrent_changes(tmpdir, root, monkeypatch):
+    entries = []
+
+    for i in range(2):
+        path = str(tmpdir / f"cluster{i}.png")
+        shutil.copyfile("tests/files/cluster.png", path)
+        entries.append({"path": path, "title": "", "tags": [], "source_url": None})
+
+    doc1, doc2 = [
+        r.document for r in store_many_documents(root, entries, defer_thumbnails=True)
+    ]
+
+    def interruption():
+        delete_document(root, doc_id=doc1.id)
+
+        with get_store(root).transaction() as tx:
+            tx.set_tags(doc2.id, tags=["new tag"])
+
+    monkeypatch.setattr(
+        concurrent.futures, "ProcessPoolExecutor", InterruptedExecutor(interruption)
+    )
+
+    list(create_queued_thumbnails(root))
+
+    (stored_doc,) = read_documents(root)
+
+    assert stored_doc.id == doc2.id
+    assert stored_doc.tags == ["new tag"]
+    assert stored_doc.files[0].thumbnail.path == "thumbnails/c/cluster1.png"
+
+
+def test_keeps_jobs_that_fail(tmpdir, root):
+    path = str(tmpdir / "cluster.png")
+    shutil.copyfile("tests/files/cluster.png", path)
+
+    (stored,) = store_many_documents(
+        root,
+        [{"path": path, "title": "", "tags": [], "source_url": None}],
+        defer_thumbnails=True,
+    )
+    stored_file = stored.document.files[0]
+    os.unlink(root / stored_file.path)
+
+    (result,) = create_queued_thumbnails(root)
+
+    assert isinstance(result.error, FileNotFoundError)
+    assert len(thumbnail_queue(root)) == 1
+    assert read_documents(root)[0].files[0].thumbnail == stored_file.thumbnail
+
+
+def test_regenerates_thumbnails(tmpdir, root):
+    entries = []
+
+    for i in range(3):
+        path = str(tmpdir / f"cluster{i}.png")
+        shutil.copyfile("tests/files/cluster.png", path)
+        entries.append({"path": path, "title": "", "tags": [], "source_url": None})
+
+    stored = list(store_many_documents(root, entries))
+    file_ids = [r.document.files[0].id for r in stored]
+    old_thumbnails = [r.document.files[0].thumbnail for r in stored]
+
+    results = list(regenerate_thumbnails(root, max_size=100, workers=2))
+
+    assert sorted(r.file_id for r in results) == sorted(file_ids)
+    assert all(r.error is None for r in results)
+
+    for doc in read_documents(root):
+        assert doc.files[0].thumbnail.dimensions == Dimensions(100, 65)
+        assert os.path.exists(root / doc.files[0].thumbnail.path)
+
+    # The new thumbnails have new paths, because browsers cache thumbnails
+    # forever, and the old thumbnails are deleted
+    for t in old_thumbnails:
+        assert not os.path.exists(root / t.path)
+
+    # If nothing has changed, there's nothing to do
+    assert list(regenerate_thumbnails(root, max_size=100)) == []
+
+    # If the parameters change, every thumbnail is regenerated
+    assert len(list(regenerate_thumbnails(root, max_size=200))) == 3
+
+
+def test_regenerating_thumbnails_does_not_undo_concurrent_changes(
+    tmpdir, root, monkeypatch
+):
+    entries = []
+
+    for i in range(2):
+        path = str(tmpdir / f"cluster{i}.png")
+        shutil.copyfile("tests/files/cluster.png", path)
+        entries.append({"path": path, "title": "", "tags": [], "source_url": None})
+
+    doc1, doc2 = [r.document for r in store_many_documents(root, entries)]
+
+    def interruption():
+        delete_document(root, doc_id=doc1.id)
+
+        with get_store(root).transaction() as tx:
+            tx.set_tags(doc2.id, tags=["new tag"])
+
+    monkeypatch.setattr(
+        concurrent.futures, "ProcessPoolExecutor", InterruptedExecutor(interruption)
+    )
+
+    list(regenerate_thumbnails(root, max_size=100))
+
+    (stored_doc,) = read_documents(root)
+
+    assert stored_doc.id == doc2.id
+    assert stored_doc.tags == ["new tag"]
+    assert stored_doc.files[0].thumbnail.dimensions == Dimensions(100, 65)
+
+
+def test_interrupted_regeneration_resumes_where_it_left_off(tmpdir, root):
+    entries = []
+
+    for i in range(3):
+        path = str(tmpdir / f"cluster{i}.png")
+        shutil.copyfile("tests/files/cluster.png", path)
+        entries.append({"path": path, "title": "", "tags": [], "source_url": None})
+
+    list(store_many_documents(root, entries))
+
+    first_run = regenerate_thumbnails(root, max_size=100, batch_size=1)
+    first_result = next(first_run)
+    first_run.close()
+
+    second_results = list(regenerate_thumbnails(root, max_size=100, batch_size=1))
+
+    assert len(second_results) == 2
+    assert first_result.file_id not in {r.file_id for r in second_results}
@@ -0,0 +1,52 @@
+import os
+
+from docstore.job_queue import JobQueue
+
+
+def test_empty_queue(tmpdir):
+    queue = JobQueue(str(tmpdir / "queue"))
+
+    assert queue.jobs() == []
+    assert len(queue) == 0
+
+
+def test_jobs_are_returned_oldest_first(tmpdir):
+    queue = JobQueue(str(tmpdir / "queue"))
+
+    for i, job_id in enumerate(["c", "a", "b"]):
+        queue.put(job_id, {"number": i})
+        os.utime(os.path.join(queue.path, f"{job_id}.json"), ns=(i, i))
+
+    assert queue.jobs() == [
+        ("c", {"number": 0}),
+        ("a", {"number": 1}),
+        ("b", {"number": 2}),
+    ]
+    assert len(queue) == 3
+
+
+def test_queue_persists(tmpdir):
+    JobQueue(str(tmpdir / "queue")).put("a", {"name": "Alice"})
+
+    assert JobQueue(str(tmpdir / "queue")).jobs() == [("a", {"name": "Alice"})]
+
+
+def test_putting_a_job_again_replaces_it(tmpdir):
+    queue = JobQueue(str(tmpdir / "queue"))
+
+    queue.put("a", {"version": 1})
+    queue.put("a", {"version": 2})
+
+    assert queue.jobs() == [("a", {"version": 2})]
+
+
+def test_can_remove_jobs(tmpdir):
+    queue = JobQueue(str(tmpdir / "queue"))
+
+    queue.put("a", {})
+    queue.put("b", {})
+
+    queue.remove("a")
+    queue.remove("doesnotexist")
+
+    assert queue.jobs() == [("b", {})]
@@ -3,7 +3,16 @@ import uuid
 
 import pytest
 
-from docstore.models import Dimensions, Document, File, Thumbnail, from_json, to_json
+from docstore.models import (
+    Dimensions,
+    Document,
+    File,
+    Thumbnail,
+    document_from_dict,
+    document_to_dict,
+    from_json,
+    to_json,
+)
 
 
 def is_recent(ds):
@@ -54,6 +63,35 @@ def test_can_serialise_document_to_json():
     assert from_json(to_json(documents)) == documents
 
 
+def test_can_serialise_non_ascii_document_to_json():
+    documents = [Document(title="Café menu ☕️", tags=["food:café"])]
+    assert from_json(to_json(documents)) == documents
+
+
+def test_can_read_document_without_source_url():
+    doc = Document(
+        title="An old document",
+        files=[
+            File(
+                filename="cats.jpg",
+                path="files/c/cats.jpg",
+                size=100,
+                checksum="sha256:123",
+                thumbnail=Thumbnail(
+                    path="thumbnails/c/cats.jpg",
+                    dimensions=Dimensions(400, 300),
+                    tint_color="#ffffff",
+                ),
+            )
+        ],
+    )
+
+    serialised_doc = document_to_dict(doc)
+    del serialised_doc["files"][0]["source_url"]
+
+    assert document_from_dict(serialised_doc) == doc
+
+
 @pytest.mark.parametrize("documents", [[1, 2, 3], {"a", "b", "c"}])
 def test_to_json_with_bad_list_is_typeerror(documents):
     with pytest.raises(TypeError, match=r"Expected type List\[Document\]!"):
@@ -0,0 +1,49 @@
+from docstore import page_cache
+from docstore.page_cache import PageCache
+
+
+def test_caches_pages_for_a_version():
+    cache = PageCache()
+
+    assert cache.get("v1", "/") is None
+    cache.put("v1", "/", "<html>")
+    assert cache.get("v1", "/") == "<html>"
+
+    assert cache.stats == {"hits": 1, "misses": 1, "invalidations": 0}
+
+
+def test_new_version_clears_the_cache():
+    cache = PageCache()
+    cache.put("v1", "/", "<html>")
+    cache.put("v1", "/?tag=cats", "<html>cats</html>")
+
+    assert cache.get("v2", "/") is None
+    assert len(cache) == 0
+    assert cache.stats["invalidations"] == 1
+
+
+def test_evicts_least_recently_used_page():
+    cache = PageCache(max_entries=2)
+    cache.put("v1", "a", "A")
+    cache.put("v1", "b", "B")
+
+    cache.get("v1", "a")
+    cache.put("v1", "c", "C")
+
+    assert cache.get("v1", "a") == "A"
+    assert cache.get("v1", "b") is None
+    assert cache.get("v1", "c") == "C"
+
+
+def test_pages_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(page_cache.time, "monotonic", lambda: now[0])
+
+    cache = PageCache(max_age=60)
+    cache.put("v1", "/", "<html>")
+
+    now[0] = 150.0
+    assert cache.get("v1", "/") == "<html>"
+
+    now[0] = 161.0
+    assert cache.get("v1", "/") is None
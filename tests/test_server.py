@@ -1,13 +1,17 @@
 import datetime
+import os
 import re
 import shutil
+import urllib.parse
 
+import attr
 import bs4
 import pytest
 
-from docstore.documents import store_new_document, write_documents
+from docstore import server
+from docstore.documents import Snapshot, store_new_document, write_documents
 from docstore.models import Document
-from docstore.server import create_app
+from docstore.server import create_app, page_validators, thumbnail_url
 
 
 @pytest.fixture
@@ -44,7 +48,7 @@ def test_shows_documents(tmpdir, root, client):
 
     # TODO: Detect this thumbnail URL from the page HTML
     resp = client.get("/thumbnails/c/cluster.png")
-    assert resp.data[:8] == b"\x89\x50\x4E\x47\x0D\x0A\x1A\x0A"  # PNG magic number
+    assert resp.data[:8] == b"\x89\x50\x4e\x47\x0d\x0a\x1a\x0a"  # PNG magic number
 
     resp = client.get("/files/c/cluster.png")
     assert resp.data == open("tests/files/cluster.png", "rb").read()
@@ -83,6 +87,59 @@ def test_paginates_document(root, client):
     assert b"Document 0" in resp_page_2.data
 
 
+def test_can_configure_page_size(root):
+    documents = [Document(title=f"Document {i}") for i in range(30)]
+    write_documents(root=root, documents=documents)
+
+    app = create_app(
+        root=root, title="My test instance", thumbnail_width=200, page_size=25
+    )
+    resp = app.test_client().get("/")
+
+    assert b"Document 5" in resp.data
+    assert b"Document 4" not in resp.data
+    assert b"showing documents 1&ndash;25 of 30." in resp.data
+
+
+def test_next_page_link_uses_a_cursor(root, client):
+    documents = [Document(title=f"Document {i}") for i in range(200)]
+    write_documents(root=root, documents=documents)
+
+    resp = client.get("/")
+    soup = bs4.BeautifulSoup(resp.data, "html.parser")
+    next_url = soup.find("a", string="next »").attrs["href"]
+
+    assert next_url == f"?page=2&after={documents[100].id}"
+
+    # If a new document is added, the next page still picks up where the
+    # last one left off
+    write_documents(root=root, documents=documents + [Document(title="Document 200")])
+
+    resp = client.get("/" + next_url)
+    assert b"Document 100" not in resp.data
+    assert b"Document 99" in resp.data
+    assert b"Document 0" in resp.data
+    assert b"showing documents 101&ndash;200 of 201." in resp.data
+
+
+def test_cursor_after_the_last_document_is_an_empty_page(root):
+    documents = [Document(title=f"Document {i}", tags=["a"]) for i in range(5)]
+    write_documents(root=root, documents=documents)
+
+    app = create_app(
+        root=root, title="My test instance", thumbnail_width=200, page_size=2
+    )
+    resp = app.test_client().get(f"/?tag=a&page=2&after={documents[0].id}")
+    assert resp.status_code == 200
+
+    soup = bs4.BeautifulSoup(resp.data, "html.parser")
+    assert soup.find("a", string="next »").attrs["href"] == "#"
+
+    # Removing a tag changes the order, so it forgets the cursor
+    remove_url = soup.find("a", attrs={"class": "remove_tag"}).attrs["href"]
+    assert "after" not in remove_url
+
+
 def test_documents_with_lots_of_tags(root, client):
     documents = [Document(title=f"Document {i}", tags=[f"tag{i}"]) for i in range(200)]
 
@@ -211,6 +268,222 @@ def test_sets_thumbnail_width(client):
     assert tidy(style_tag.string) == ".thumbnail { width: 100px; }"
 
 
+def test_lists_thumbnail_variants_in_srcset(tmpdir, root, client):
+    shutil.copyfile("tests/files/cluster.png", str(tmpdir / "cluster.png"))
+    store_new_document(
+        root=root,
+        path=str(tmpdir / "cluster.png"),
+        title="My test document",
+        tags=[],
+        source_url=None,
+        date_saved=datetime.datetime.now(),
+    )
+
+    resp = client.get("/")
+
+    soup = bs4.BeautifulSoup(resp.data, "html.parser")
+    picture = soup.find("picture")
+
+    webp_source = picture.find("source")
+    assert webp_source.attrs["type"] == "image/webp"
+    assert re.fullmatch(
+        r"/thumbnails/c/cluster\.200\.webp\?v=[0-9a-f]{8} 200w, "
+        r"/thumbnails/c/cluster\.400\.webp\?v=[0-9a-f]{8} 400w",
+        webp_source.attrs["srcset"],
+    )
+    assert webp_source.attrs["sizes"] == "200px"
+
+    img = picture.find("img")
+    assert re.fullmatch(r"/thumbnails/c/cluster\.png\?v=[0-9a-f]{8}", img.attrs["src"])
+    assert re.fullmatch(
+        r"/thumbnails/c/cluster\.200\.png\?v=[0-9a-f]{8} 200w, "
+        r"/thumbnails/c/cluster\.png\?v=[0-9a-f]{8} 400w",
+        img.attrs["srcset"],
+    )
+
+    resp = client.get("/thumbnails/c/cluster.200.webp")
+    assert resp.data[8:12] == b"WEBP"
+
+
+def store_cluster(tmpdir, root):
+    shutil.copyfile("tests/files/cluster.png", str(tmpdir / "cluster.png"))
+    return store_new_document(
+        root=root,
+        path=str(tmpdir / "cluster.png"),
+        title="My test document",
+        tags=[],
+        source_url=None,
+        date_saved=datetime.datetime.now(),
+    )
+
+
+def test_thumbnails_are_immutable(tmpdir, root, client):
+    store_cluster(tmpdir, root)
+
+    resp = client.get("/thumbnails/c/cluster.png")
+
+    assert resp.status_code == 200
+    assert resp.cache_control.immutable
+    assert resp.cache_control.max_age == 365 * 24 * 60 * 60
+
+
+def test_thumbnail_url_changes_when_file_changes(tmpdir, root, client):
+    doc = store_cluster(tmpdir, root)
+    f = doc.files[0]
+
+    assert thumbnail_url(f) != thumbnail_url(
+        attr.evolve(f, checksum="sha256:different")
+    )
+    assert thumbnail_url(f) != thumbnail_url(f, f.thumbnail.variants[0])
+
+
+def test_files_have_checksum_etag(tmpdir, root, client):
+    doc = store_cluster(tmpdir, root)
+    checksum = doc.files[0].checksum.split(":")[1]
+
+    resp = client.get("/files/c/cluster.png")
+
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] == f'"{checksum}"'
+
+    resp = client.get(
+        "/files/c/cluster.png", headers={"If-None-Match": f'"{checksum}"'}
+    )
+
+    assert resp.status_code == 304
+    assert resp.data == b""
+
+
+def test_serves_byte_ranges_of_files(tmpdir, root, client):
+    store_cluster(tmpdir, root)
+
+    with open("tests/files/cluster.png", "rb") as infile:
+        expected = infile.read()
+
+    resp = client.get("/files/c/cluster.png", headers={"Range": "bytes=0-9"})
+
+    assert resp.status_code == 206
+    assert resp.data == expected[:10]
+    assert resp.headers["Content-Range"] == f"bytes 0-9/{len(expected)}"
+    assert resp.headers["Accept-Ranges"] == "bytes"
+    assert resp.headers["Content-Disposition"] == "filename*=utf-8''cluster.png"
+
+
+@pytest.mark.parametrize(
+    "file_offload, header, expected_value",
+    [
+        ("x-sendfile", "X-Sendfile", "{root}/files/c/cluster.png"),
+        ("x-accel-redirect", "X-Accel-Redirect", "/_docstore/files/c/cluster.png"),
+    ],
+)
+def test_can_offload_files_to_front_end_server(
+    tmpdir, root, file_offload, header, expected_value
+):
+    doc = store_cluster(tmpdir, root)
+    checksum = doc.files[0].checksum.split(":")[1]
+
+    app = create_app(
+        root=root,
+        title="My test instance",
+        thumbnail_width=200,
+        file_offload=file_offload,
+    )
+    client = app.test_client()
+
+    resp = client.get("/files/c/cluster.png", headers={"Range": "bytes=0-9"})
+
+    assert resp.status_code == 200
+    assert resp.data == b""
+    assert resp.headers[header] == expected_value.format(root=os.path.abspath(root))
+    assert resp.headers["ETag"] == f'"{checksum}"'
+    assert resp.headers["Content-Disposition"] == "filename*=utf-8''cluster.png"
+    assert "Content-Type" not in resp.headers
+
+    resp = client.get(
+        "/files/c/cluster.png", headers={"If-None-Match": f'"{checksum}"'}
+    )
+
+    assert resp.status_code == 304
+    assert header not in resp.headers
+
+
+def test_escapes_accel_redirect_path(tmpdir, root):
+    shutil.copyfile("tests/files/cluster.png", str(tmpdir / "café cluster.png"))
+    store_new_document(
+        root=root,
+        path=str(tmpdir / "café cluster.png"),
+        title="My test document",
+        tags=[],
+        source_url=None,
+        date_saved=datetime.datetime.now(),
+    )
+
+    app = create_app(
+        root=root,
+        title="My test instance",
+        thumbnail_width=200,
+        file_offload="x-accel-redirect",
+        accel_redirect_prefix="/internal",
+    )
+
+    (stored_name,) = os.listdir(root / "files" / "c")
+    resp = app.test_client().get(f"/files/c/{stored_name}")
+
+    assert resp.headers["X-Accel-Redirect"] == (
+        "/internal/files/c/" + urllib.parse.quote(stored_name)
+    )
+
+
+def test_unknown_file_is_404(tmpdir, root, client):
+    store_cluster(tmpdir, root)
+    shutil.copyfile("tests/files/cluster.png", str(root / "files" / "c" / "extra.png"))
+
+    assert client.get("/files/c/extra.png").status_code == 404
+    assert client.get("/files/c/missing.png").status_code == 404
+
+
+@pytest.mark.parametrize(
+    "sort_by, expected_titles",
+    [
+        ("date (newest first)", ["Cherry", "Apple", "banana"]),
+        ("date (oldest first)", ["banana", "Apple", "Cherry"]),
+        ("title (A to Z)", ["Apple", "banana", "Cherry"]),
+        ("title (Z to A)", ["Cherry", "banana", "Apple"]),
+    ],
+)
+def test_sorts_documents(root, client, sort_by, expected_titles):
+    documents = [
+        Document(title=title, date_saved=datetime.datetime(2001, 1, day))
+        for day, title in enumerate(["banana", "Apple", "Cherry"], start=1)
+    ]
+    write_documents(root=root, documents=documents)
+
+    resp = client.get("/", query_string={"sortBy": sort_by})
+    assert resp.status_code == 200
+
+    soup = bs4.BeautifulSoup(resp.data, "html.parser")
+    titles = [
+        title.contents[0].strip() for title in soup.find_all("h2", class_="title")
+    ]
+    assert titles == expected_titles
+
+
+def test_random_order_is_stable_across_pages(root, client):
+    documents = [Document(title=f"Document {i}") for i in range(250)]
+    write_documents(root=root, documents=documents)
+
+    def get_titles(page):
+        resp = client.get("/", query_string={"sortBy": "random", "page": page})
+        soup = bs4.BeautifulSoup(resp.data, "html.parser")
+        return [
+            title.contents[0].strip() for title in soup.find_all("h2", class_="title")
+        ]
+
+    titles = get_titles(page=1) + get_titles(page=2) + get_titles(page=3)
+
+    assert sorted(titles) == sorted(doc.title for doc in documents)
+
+
 def test_tags_are_sorted_alphabetically(root, client):
     doc = Document(title="My document", tags=["bulgaria", "austria", "croatia"])
     write_documents(root=root, documents=[doc])
@@ -238,3 +511,118 @@ def test_gets_curly_quotes(root, client):
         soup.find("div", attrs={"id": "aside_inner"}).text.strip()
         == "docstore/Isn’t this a good title?"
     )
+
+
+def test_caches_rendered_pages(root, client):
+    write_documents(root=root, documents=[Document(title="My document", tags=["a"])])
+    page_cache = client.application.config["PAGE_CACHE"]
+
+    resp1 = client.get("/?tag=a&sortBy=title+(A+to+Z)")
+    resp2 = client.get("/?sortBy=title+(A+to+Z)&tag=a")
+
+    assert resp1.data == resp2.data
+    assert page_cache.stats["hits"] == 1
+
+    # When the database changes, we render the page again
+    write_documents(
+        root=root, documents=[Document(title="My new document", tags=["a"])]
+    )
+
+    resp3 = client.get("/?tag=a&sortBy=title+(A+to+Z)")
+
+    assert b"My new document" in resp3.data
+    assert page_cache.stats["hits"] == 1
+
+
+def test_does_not_cache_random_order(root, client):
+    write_documents(root=root, documents=[Document(title="My document")])
+    page_cache = client.application.config["PAGE_CACHE"]
+
+    client.get("/?sortBy=random")
+    client.get("/?sortBy=random")
+
+    assert len(page_cache) == 0
+    assert page_cache.stats["hits"] == 0
+
+
+def test_index_page_supports_conditional_requests(root, client, monkeypatch):
+    # Pin the time, so the validators don't change between requests
+    monkeypatch.setattr(server.time, "time", lambda: 1_000_000.0)
+
+    write_documents(root=root, documents=[Document(title="My document")])
+
+    resp = client.get("/")
+    etag = resp.headers["ETag"]
+    last_modified = resp.headers["Last-Modified"]
+
+    assert resp.status_code == 200
+    assert resp.cache_control.no_cache
+    assert resp.last_modified is not None
+
+    resp = client.get("/", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.data == b""
+    assert resp.headers["ETag"] == etag
+
+    resp = client.get("/", headers={"If-Modified-Since": last_modified})
+    assert resp.status_code == 304
+
+    # A different view of the same database has a different ETag
+    resp = client.get("/?sortBy=title+(A+to+Z)", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+
+    # So does the same view after the database changes
+    write_documents(root=root, documents=[Document(title="My new document")])
+
+    resp = client.get("/", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert b"My new document" in resp.data
+
+
+def test_conditional_request_does_not_render_the_page(root, client, monkeypatch):
+    monkeypatch.setattr(server.time, "time", lambda: 1_000_000.0)
+
+    write_documents(root=root, documents=[Document(title="My document")])
+    etag = client.get("/").headers["ETag"]
+
+    def fail(*args, **kwargs):  # pragma: no cover
+        raise AssertionError("Should not render the page")
+
+    monkeypatch.setattr(server, "render_template", fail)
+    monkeypatch.setattr(Snapshot, "page_of_documents", fail)
+
+    assert client.get("/", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_page_validators_change_with_the_time():
+    kwargs = {"version": ("v1",), "cache_key": ("/", ()), "db_last_modified": 1000}
+
+    etag1, last_modified1 = page_validators(**kwargs, now=2000)
+    etag2, last_modified2 = page_validators(**kwargs, now=2010)
+    etag3, last_modified3 = page_validators(**kwargs, now=2050)
+
+    assert etag1 == etag2 != etag3
+    assert last_modified1 == last_modified2 < last_modified3
+    assert last_modified3.timestamp() == 2040
+
+
+def test_random_order_has_no_etag(root, client):
+    write_documents(root=root, documents=[Document(title="My document")])
+
+    resp = client.get("/?sortBy=random")
+
+    assert resp.status_code == 200
+    assert "ETag" not in resp.headers
+
+
+def test_metrics(root, client):
+    write_documents(root=root, documents=[Document(title="My document")])
+
+    resp = client.get("/metrics")
+
+    assert resp.status_code == 200
+    assert resp.headers["Content-Type"].startswith("text/plain")
+    assert b"docstore_scrub_coverage_ratio 1.0\n" in resp.data
+    assert b"docstore_snapshot_misses_total" in resp.data
+    assert b"docstore_page_cache_hits_total 0\n" in resp.data
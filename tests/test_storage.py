@@ -0,0 +1,306 @@
+import datetime
+import os
+import pickle
+import threading
+import time
+
+import attr
+import pytest
+
+from docstore import storage
+from docstore.documents import delete_document, read_documents, write_documents
+from docstore.models import (
+    Dimensions,
+    Document,
+    File,
+    Thumbnail,
+    ThumbnailVariant,
+    to_json,
+)
+from docstore.storage import (
+    JsonStorage,
+    SqliteStorage,
+    add_change,
+    convert_storage,
+    db_path,
+    delete_change,
+    get_storage,
+    last_modified,
+    read_json,
+    snapshot_cache_path,
+    sqlite_path,
+    thumbnail_change,
+    update_change,
+    write_json,
+)
+
+
+def create_document(i):
+    return Document(
+        title=f"Document {i}",
+        date_saved=datetime.datetime(2001 + i, 1, 1),
+        tags=[f"tag{i}", "shared", f"another:tag{i}"],
+        files=[
+            File(
+                filename=f"cats{i}_{j}.jpg",
+                path=f"files/c/cats{i}_{j}.jpg",
+                size=100 * i + j,
+                checksum=f"sha256:{i}{j}",
+                source_url=f"https://example.org/cats{i}" if j == 0 else None,
+                thumbnail=Thumbnail(
+                    path=f"thumbnails/c/cats{i}_{j}.jpg",
+                    dimensions=Dimensions(400, 300 + j),
+                    tint_color="#ff0000",
+                    variants=(
+                        [
+                            ThumbnailVariant(
+                                path=f"thumbnails/c/cats{i}_{j}.{size}.webp",
+                                dimensions=Dimensions(size, size * 3 // 4),
+                                media_type="image/webp",
+                            )
+                            for size in (200, 400)
+                        ]
+                        if j == 0
+                        else []
+                    ),
+                ),
+            )
+            for j in range(i)
+        ],
+    )
+
+
+@pytest.fixture
+def documents():
+    # Newest first, which is the order they're read back in
+    return [create_document(i) for i in reversed(range(4))]
+
+
+@pytest.mark.parametrize("storage_class", [JsonStorage, SqliteStorage])
+class TestStorage:
+    def test_empty_storage(self, root, storage_class):
+        storage = storage_class(root)
+        assert not storage.exists()
+        assert storage.read() == []
+
+    def test_can_write_and_read(self, root, storage_class, documents):
+        storage = storage_class(root)
+        storage.write(documents)
+
+        assert storage.exists()
+        assert storage.read() == documents
+
+    def test_can_apply_changes(self, root, storage_class, documents):
+        storage = storage_class(root)
+        storage.write(documents[:2])
+
+        updated_doc = Document(
+            id=documents[0].id,
+            title="An updated title",
+            date_saved=documents[0].date_saved,
+            tags=["new tag"],
+            files=documents[0].files[:1],
+        )
+
+        version_before = storage.version()
+
+        storage.apply(
+            [
+                add_change(documents[2]),
+                update_change(updated_doc),
+                delete_change(documents[1].id),
+            ]
+        )
+
+        assert storage.version() != version_before
+        assert storage.read() == [updated_doc, documents[2]]
+
+    def test_can_change_a_thumbnail(self, root, storage_class, documents):
+        storage = storage_class(root)
+        storage.write(documents[:3])
+
+        f = documents[0].files[0]
+        new_thumbnail = Thumbnail(
+            path="thumbnails/n/new.png",
+            dimensions=Dimensions(100, 100),
+            tint_color="#00ff00",
+            variants=[
+                ThumbnailVariant(
+                    path="thumbnails/n/new.200.webp",
+                    dimensions=Dimensions(100, 100),
+                    media_type="image/webp",
+                )
+            ],
+        )
+
+        storage.apply(
+            [
+                thumbnail_change(f.id, new_thumbnail),
+                # The file has been deleted, so this is ignored
+                delete_change(documents[1].id),
+                thumbnail_change(documents[1].files[0].id, new_thumbnail),
+            ]
+        )
+
+        assert storage.read() == [
+            attr.evolve(
+                documents[0],
+                files=[attr.evolve(f, thumbnail=new_thumbnail)]
+                + documents[0].files[1:],
+            ),
+            documents[2],
+        ]
+
+    def test_applying_a_change_twice_is_harmless(self, root, storage_class, documents):
+        storage = storage_class(root)
+        storage.write(documents[:1])
+
+        changes = [add_change(documents[1]), delete_change(documents[0].id)]
+        storage.apply(changes)
+        storage.apply(changes)
+
+        assert storage.read() == [documents[1]]
+
+    def test_can_compact(self, root, storage_class, documents):
+        storage = storage_class(root)
+        storage.write(documents[:2])
+        storage.apply([delete_change(documents[0].id)])
+
+        storage.compact()
+
+        assert storage.read() == [documents[1]]
+
+    def test_last_modified(self, root, storage_class, documents):
+        storage = storage_class(root)
+        assert last_modified(storage) is None
+
+        storage.write(documents[:1])
+        os.utime(storage.paths()[0], (1000, 1000))
+        assert last_modified(storage) == 1000
+
+        storage.apply([add_change(documents[1])])
+        assert last_modified(storage) > 1000
+
+    @pytest.mark.parametrize("bad_documents", [[1, 2, 3], {"a", "b", "c"}])
+    def test_write_with_bad_list_is_typeerror(self, root, storage_class, bad_documents):
+        with pytest.raises(TypeError, match=r"Expected type List\[Document\]!"):
+            storage_class(root).write(bad_documents)
+
+
+def test_compaction_does_not_lose_concurrent_changes(root, documents, monkeypatch):
+    json_storage = JsonStorage(root)
+    json_storage.write(documents[:1])
+    json_storage.apply([add_change(documents[1])])
+
+    # Pause the compaction after it's read the journal, and try to append
+    # another change in the meantime.
+    has_read = threading.Event()
+    original_read = JsonStorage.read
+
+    def slow_read(self):
+        result = original_read(self)
+        has_read.set()
+        time.sleep(0.5)
+        return result
+
+    monkeypatch.setattr(JsonStorage, "read", slow_read)
+
+    compaction = threading.Thread(target=json_storage.compact)
+    compaction.start()
+    has_read.wait()
+
+    JsonStorage(root).apply([add_change(documents[2])])
+    compaction.join()
+
+    monkeypatch.setattr(JsonStorage, "read", original_read)
+    assert {d.id for d in json_storage.read()} == {d.id for d in documents[:3]}
+
+
+def test_uses_json_by_default(root):
+    assert isinstance(get_storage(root), JsonStorage)
+
+
+def test_uses_sqlite_if_database_exists(root, documents):
+    SqliteStorage(root).write(documents)
+
+    assert isinstance(get_storage(root), SqliteStorage)
+    assert read_documents(root) == documents
+
+    delete_document(root, doc_id=documents[-1].id)
+    assert read_documents(root) == documents[:-1]
+    assert not os.path.exists(db_path(root))
+
+
+def test_can_convert_between_engines(root, documents):
+    write_documents(root=root, documents=documents)
+
+    convert_storage(root, engine="sqlite")
+    assert isinstance(get_storage(root), SqliteStorage)
+    assert os.path.exists(db_path(root) + ".bak")
+    assert read_documents(root) == documents
+
+    with pytest.raises(ValueError, match="already uses sqlite"):
+        convert_storage(root, engine="sqlite")
+
+    convert_storage(root, engine="json")
+    assert isinstance(get_storage(root), JsonStorage)
+    assert os.path.exists(sqlite_path(root) + ".bak")
+    assert read_documents(root) == documents
+
+    # The backup from the first conversion is in the way
+    with pytest.raises(FileExistsError):
+        convert_storage(root, engine="sqlite")
+
+
+class TestSnapshotCache:
+    def test_uses_the_snapshot_if_json_is_unchanged(self, root, documents, monkeypatch):
+        JsonStorage(root).write(documents)
+        assert os.path.exists(snapshot_cache_path(root))
+
+        def fail_from_json(json_string):
+            raise AssertionError("Should not parse the JSON")
+
+        monkeypatch.setattr(storage, "from_json", fail_from_json)
+
+        assert JsonStorage(root).read() == documents
+
+    def test_rebuilds_the_snapshot_if_json_is_changed(self, root, documents):
+        JsonStorage(root).write(documents)
+
+        # Edit the JSON by hand, bypassing docstore
+        with open(db_path(root), "w") as out_file:
+            out_file.write(to_json(documents[:1]))
+
+        assert JsonStorage(root).read() == documents[:1]
+
+        # The rebuilt snapshot matches the new JSON
+        with open(snapshot_cache_path(root), "rb") as infile:
+            assert pickle.load(infile) == JsonStorage(root)._snapshot_key()
+            assert pickle.load(infile) == documents[:1]
+
+    def test_builds_the_snapshot_on_first_read(self, root, documents):
+        JsonStorage(root).write(documents)
+        os.unlink(snapshot_cache_path(root))
+
+        assert JsonStorage(root).read() == documents
+        assert os.path.exists(snapshot_cache_path(root))
+        assert JsonStorage(root).read() == documents
+
+    def test_ignores_a_corrupt_snapshot(self, root, documents):
+        JsonStorage(root).write(documents)
+
+        with open(snapshot_cache_path(root), "wb") as out_file:
+            out_file.write(b"not a pickle")
+
+        assert JsonStorage(root).read() == documents
+
+
+def test_reads_and_writes_json(tmpdir):
+    path = str(tmpdir / "state.json")
+
+    assert read_json(path) == {}
+
+    write_json(path, {"a": {"checksum": "sha256:123"}})
+
+    assert read_json(path) == {"a": {"checksum": "sha256:123"}}
+    assert os.listdir(tmpdir) == ["state.json"]
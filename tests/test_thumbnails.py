@@ -1,41 +1,67 @@
+import os
+import struct
+
 from PIL import Image
 import pytest
 
-from docstore.thumbnails import create_thumbnail, get_dimensions
+from docstore import thumbnails
+from docstore.models import Dimensions
+from docstore.thumbnails import (
+    THUMBNAILERS,
+    create_thumbnail,
+    create_thumbnail_variant,
+    get_dimensions,
+    get_file_type,
+    register_thumbnailer,
+    variant_name,
+)
 
 
 @pytest.mark.parametrize(
     "filename", ["Newtons_cradle.gif", "Rotating_earth_(large).gif"]
 )
 def test_creates_thumbnail_of_animated_gif(filename):
-    path = create_thumbnail(f"tests/files/{filename}", max_size=400)
+    path, dimensions = create_thumbnail(f"tests/files/{filename}", max_size=400)
     assert path.endswith(".mp4")
+    assert dimensions == get_dimensions(path)
+
+
+def test_animated_gif_without_ffmpeg_gets_a_still_thumbnail(monkeypatch):
+    monkeypatch.setattr(thumbnails.shutil, "which", lambda name: None)
+
+    path, dimensions = create_thumbnail("tests/files/Newtons_cradle.gif")
+
+    assert path.endswith("/Newtons_cradle.gif.png")
+    assert dimensions == get_dimensions(path)
 
 
 def test_creates_thumbnail_of_single_frame_gif():
-    path = create_thumbnail(
+    path, dimensions = create_thumbnail(
         "tests/files/Rotating_earth_(large)_singleframe.gif", max_size=400
     )
     assert path.endswith(".png")
 
     im = Image.open(path)
     assert im.size == (400, 400)
+    assert dimensions == Dimensions(400, 400)
 
 
 def test_creates_thumbnail_of_png():
-    path = create_thumbnail("tests/files/cluster.png", max_size=250)
+    path, dimensions = create_thumbnail("tests/files/cluster.png", max_size=250)
     assert path.endswith("/cluster.png")
 
     im = Image.open(path)
     assert im.size == (250, 162)
+    assert dimensions == Dimensions(250, 162)
 
 
 def test_creates_thumbnail_of_pdf():
-    path = create_thumbnail("tests/files/snakes.pdf", max_size=350)
+    path, dimensions = create_thumbnail("tests/files/snakes.pdf", max_size=350)
     assert path.endswith("/snakes.pdf.png")
 
     im = Image.open(path)
     assert im.size == (247, 350)
+    assert dimensions == Dimensions(247, 350)
 
 
 def test_creates_thumbnail_if_no_quicklook_plugin_available(tmpdir):
@@ -44,7 +70,7 @@ def test_creates_thumbnail_if_no_quicklook_plugin_available(tmpdir):
     with open(path, "wb") as outfile:
         outfile.write(b"SQLite format 3\x00")
 
-    path = create_thumbnail(path)
+    create_thumbnail(path)
 
 
 def test_gets_dimensions_of_an_image():
@@ -54,8 +80,219 @@ def test_gets_dimensions_of_an_image():
 
 
 def test_gets_dimensions_of_a_video():
-    thumbnail_path = create_thumbnail("tests/files/Newtons_cradle.gif")
+    thumbnail_path, _ = create_thumbnail("tests/files/Newtons_cradle.gif")
 
     dimensions = get_dimensions(thumbnail_path)
     assert dimensions.width == 400
     assert dimensions.height == 300
+
+
+def test_creates_image_thumbnail_without_a_subprocess(monkeypatch):
+    def no_subprocesses(*args, **kwargs):
+        raise AssertionError("Tried to run a subprocess")
+
+    monkeypatch.setattr(thumbnails.subprocess, "check_call", no_subprocesses)
+
+    path, _ = create_thumbnail("tests/files/cluster.png", max_size=100)
+
+    assert Image.open(path).size == (100, 65)
+
+
+def test_image_thumbnail_respects_exif_orientation(tmpdir):
+    path = str(tmpdir / "photo.jpg")
+
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise
+    Image.new("CMYK", (800, 600)).save(path, exif=exif)
+
+    thumbnail_path, dimensions = create_thumbnail(path, max_size=400)
+
+    assert thumbnail_path.endswith("/photo.jpg.png")
+    assert Image.open(thumbnail_path).size == (300, 400)
+    assert dimensions == Dimensions(300, 400)
+
+
+def test_truncated_image_gets_the_generic_thumbnail(tmpdir):
+    path = str(tmpdir / "truncated.jpg")
+
+    Image.effect_noise((800, 600), sigma=50).convert("RGB").save(path)
+
+    with open(path, "rb") as infile:
+        data = infile.read()
+
+    with open(path, "wb") as outfile:
+        outfile.write(data[: len(data) // 2])
+
+    thumbnail_path, _ = create_thumbnail(path)
+
+    assert thumbnail_path.endswith("/generic_document.png")
+
+
+@pytest.mark.parametrize(
+    "filename, file_type",
+    [
+        ("Newtons_cradle.gif", "animated_gif"),
+        ("Rotating_earth_(large)_singleframe.gif", "image"),
+        ("cluster.png", "image"),
+        ("snakes.pdf", "pdf"),
+        ("credits.txt", "other"),
+    ],
+)
+def test_gets_file_type(filename, file_type):
+    assert get_file_type(f"tests/files/{filename}") == file_type
+
+
+def test_gets_file_type_of_video(tmpdir):
+    path = str(tmpdir / "movie.mp4")
+
+    with open(path, "wb") as outfile:
+        outfile.write(b"\x00\x00\x00\x18ftypmp42")
+
+    assert get_file_type(path) == "video"
+
+
+def test_uses_registered_thumbnailer(monkeypatch, tmpdir):
+    monkeypatch.setattr(
+        thumbnails, "THUMBNAILERS", {k: list(v) for k, v in THUMBNAILERS.items()}
+    )
+
+    def fake_thumbnailer(*, path, max_size, out_dir):
+        out_path = os.path.join(out_dir, "fake.png")
+        Image.new("RGB", (max_size, max_size)).save(out_path)
+        return out_path, Dimensions(max_size, max_size)
+
+    register_thumbnailer("other", fake_thumbnailer)
+
+    path, dimensions = create_thumbnail("tests/files/credits.txt", max_size=50)
+
+    assert path.endswith("/fake.png")
+    assert Image.open(path).size == (50, 50)
+    assert dimensions == Dimensions(50, 50)
+
+
+def test_falls_back_to_generic_thumbnail(monkeypatch):
+    monkeypatch.setattr(thumbnails, "THUMBNAILERS", {"other": [lambda **kwargs: None]})
+
+    path, dimensions = create_thumbnail("tests/files/credits.txt")
+
+    assert path.endswith("/generic_document.png")
+    assert dimensions == get_dimensions(path)
+
+
+def test_can_skip_the_generic_thumbnail(monkeypatch):
+    monkeypatch.setattr(thumbnails, "THUMBNAILERS", {"other": [lambda **kwargs: None]})
+
+    assert create_thumbnail("tests/files/credits.txt", fallback=False) is None
+
+
+def mp4_box(box_type, contents):
+    return struct.pack(">I4s", 8 + len(contents), box_type) + contents
+
+
+def tkhd_box(*, version, width, height):
+    # version + flags, then the times, track ID and duration, whose size
+    # depends on the version
+    times = b"\x00" * (20 if version == 0 else 32)
+
+    return mp4_box(
+        b"tkhd",
+        bytes([version, 0, 0, 7])
+        + times
+        + b"\x00" * 8  # reserved
+        + b"\x00" * 8  # layer, alternate group, volume, reserved
+        + b"\x00" * 36  # matrix
+        + struct.pack(">II", width << 16, height << 16),
+    )
+
+
+@pytest.mark.parametrize("version", [0, 1])
+def test_gets_dimensions_of_mp4_from_track_header(tmpdir, version):
+    path = str(tmpdir / "movie.mp4")
+
+    audio_track = mp4_box(b"trak", tkhd_box(version=version, width=0, height=0))
+    video_track = mp4_box(b"trak", tkhd_box(version=version, width=640, height=360))
+
+    with open(path, "wb") as outfile:
+        outfile.write(mp4_box(b"ftyp", b"mp42\x00\x00\x00\x00"))
+        outfile.write(
+            mp4_box(
+                b"moov", mp4_box(b"mvhd", b"\x00" * 100) + audio_track + video_track
+            )
+        )
+        outfile.write(mp4_box(b"mdat", b"\x00" * 1000))
+
+    assert get_dimensions(path) == Dimensions(640, 360)
+
+
+def test_gets_dimensions_of_mp4_with_64_bit_box_size(tmpdir):
+    path = str(tmpdir / "movie.mp4")
+
+    tkhd = tkhd_box(version=0, width=320, height=240)
+    video_track = mp4_box(b"trak", tkhd)
+
+    moov_contents = video_track
+    large_moov = (
+        struct.pack(">I4sQ", 1, b"moov", 16 + len(moov_contents)) + moov_contents
+    )
+
+    with open(path, "wb") as outfile:
+        outfile.write(large_moov)
+
+    assert get_dimensions(path) == Dimensions(320, 240)
+
+
+def test_mp4_without_video_track_is_error(tmpdir):
+    path = str(tmpdir / "audio.mp4")
+
+    with open(path, "wb") as outfile:
+        outfile.write(
+            mp4_box(b"moov", mp4_box(b"trak", tkhd_box(version=0, width=0, height=0)))
+        )
+
+    with pytest.raises(ValueError, match="Could not find the dimensions"):
+        get_dimensions(path)
+
+
+@pytest.mark.parametrize(
+    "thumbnail_name, media_type, max_size, expected",
+    [
+        ("cat.png", "image/webp", 200, "cat.200.webp"),
+        ("cat.pdf.png", "image/webp", 400, "cat.pdf.400.webp"),
+        ("cat.pdf.png", "image/png", 200, "cat.pdf.200.png"),
+    ],
+)
+def test_variant_name(thumbnail_name, media_type, max_size, expected):
+    assert (
+        variant_name(thumbnail_name, media_type=media_type, max_size=max_size)
+        == expected
+    )
+
+
+def test_creates_webp_variant(tmpdir):
+    path, dimensions = create_thumbnail_variant(
+        "tests/files/cluster.png",
+        media_type="image/webp",
+        max_size=200,
+        out_dir=str(tmpdir),
+    )
+
+    assert path == str(tmpdir / "cluster.200.webp")
+    assert dimensions == Dimensions(200, 130)
+
+    im = Image.open(path)
+    assert im.format == "WEBP"
+    assert im.size == (200, 130)
+
+
+def test_does_not_create_variants_of_videos(tmpdir):
+    path = str(tmpdir / "Newtons_cradle.gif.mp4")
+
+    with open(path, "wb") as outfile:
+        outfile.write(mp4_box(b"ftyp", b"mp42\x00\x00\x00\x00"))
+
+    assert (
+        create_thumbnail_variant(
+            path, media_type="image/webp", max_size=200, out_dir=str(tmpdir)
+        )
+        is None
+    )
@@ -1,14 +1,20 @@
+import numpy as np
+from PIL import Image
 import pytest
 
 from docstore.thumbnails import create_thumbnail
 from docstore.tint_colors import (
+    choose_tint_color_for_file,
     choose_tint_color_from_dominant_colors,
     choose_tint_color,
+    contrast_ratios,
+    find_dominant_colors,
+    get_pixels,
 )
 
 
 def test_choose_tint_color():
-    thumbnail_path = create_thumbnail("tests/files/Newtons_cradle.gif")
+    thumbnail_path, _ = create_thumbnail("tests/files/Newtons_cradle.gif")
 
     tint_color = choose_tint_color(
         thumbnail_path=thumbnail_path, file_path="tests/files/Newtons_cradle.gif"
@@ -33,3 +39,70 @@ def test_selects_black_or_white_if_unsufficient_contrast(
         )
         == expected_tint
     )
+
+
+def test_chooses_tint_color_for_animated_gif_without_a_thumbnail():
+    tint_color = choose_tint_color_for_file("tests/files/Newtons_cradle.gif")
+    assert all(0.4 <= c <= 0.5 for c in tint_color), tint_color
+
+
+def test_chooses_brightest_color_with_sufficient_contrast():
+    tint_color = choose_tint_color_from_dominant_colors(
+        dominant_colors=[(0.1, 0.1, 0.1), (0.9, 0.9, 0.9), (0, 0, 0.6), (0.5, 0, 0)],
+        background_color=(1, 1, 1),
+    )
+
+    assert tint_color == (0, 0, 0.6)
+
+
+@pytest.mark.parametrize(
+    "color, background_color, expected_ratio",
+    [
+        ((0, 0, 0), (1, 1, 1), 21),
+        ((1, 1, 1), (0, 0, 0), 21),
+        ((1, 1, 1), (1, 1, 1), 1),
+        ((0.5, 0.5, 0.5), (1, 1, 1), 3.98),
+    ],
+)
+def test_contrast_ratios(color, background_color, expected_ratio):
+    (ratio,) = contrast_ratios([color], background_color)
+
+    assert ratio == pytest.approx(expected_ratio, abs=0.01)
+
+
+def test_finds_dominant_colors():
+    rng = np.random.default_rng(seed=1)
+
+    # Two clusters of pixels, around (0.2, 0.2, 0.8) and (0.9, 0.5, 0.1)
+    pixels = np.concatenate(
+        [
+            rng.normal((0.2, 0.2, 0.8), 0.02, size=(500, 3)),
+            rng.normal((0.9, 0.5, 0.1), 0.02, size=(1000, 3)),
+        ]
+    ).clip(0, 1)
+
+    dominant_colors = find_dominant_colors(pixels, max_colors=2)
+
+    assert sorted(dominant_colors.round(1).tolist()) == [
+        [0.2, 0.2, 0.8],
+        [0.9, 0.5, 0.1],
+    ]
+
+
+def test_returns_every_color_if_there_are_only_a_few():
+    pixels = np.array([(1, 0, 0), (0, 1, 0), (1, 0, 0)])
+
+    assert find_dominant_colors(pixels).tolist() == [[0, 1, 0], [1, 0, 0]]
+
+
+def test_ignores_transparent_pixels(tmpdir):
+    path = str(tmpdir / "transparent.png")
+
+    im = Image.new("RGBA", (100, 100), color=(255, 0, 0, 0))
+    im.paste((0, 0, 255, 255), (0, 0, 50, 50))
+    im.save(path)
+
+    pixels = get_pixels(path)
+
+    assert len(pixels) == 50 * 50
+    assert (pixels == (0, 0, 1)).all()
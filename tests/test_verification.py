@@ -0,0 +1,269 @@
+import datetime
+import os
+
+import pytest
+
+from docstore import verification
+from docstore.documents import sha256, write_documents
+from docstore.models import Dimensions, Document, File, Thumbnail
+from docstore.verification import (
+    ByteBudget,
+    choose_files,
+    read_stamps,
+    scrub,
+    scrub_coverage,
+    verify_file,
+    verify_files,
+)
+
+
+def create_document(root, name, contents):
+    path = os.path.join(root, "files", name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, "wb") as out_file:
+        out_file.write(contents)
+
+    return Document(
+        title=name,
+        files=[
+            File(
+                filename=name,
+                path=os.path.join("files", name),
+                size=len(contents),
+                checksum=sha256(path),
+                thumbnail=Thumbnail(
+                    path="thumbnails/" + name,
+                    dimensions=Dimensions(400, 400),
+                    tint_color="#ff0000",
+                ),
+            )
+        ],
+    )
+
+
+def test_good_file_has_no_errors(root):
+    doc = create_document(root, "a.txt", b"hello world")
+
+    errors, stat = verify_file(root, doc.files[0])
+
+    assert errors == []
+    assert stat.st_size == 11
+
+
+def test_reports_size_and_checksum_mismatch(root):
+    doc = create_document(root, "a.txt", b"hello world")
+
+    with open(os.path.join(root, "files", "a.txt"), "wb") as out_file:
+        out_file.write(b"goodbye")
+
+    errors, _ = verify_file(root, doc.files[0])
+
+    assert len(errors) == 2
+    assert errors[0].startswith("Size mismatch")
+    assert errors[1].startswith("Checksum mismatch")
+    assert sha256(os.path.join(root, "files", "a.txt")) in errors[1]
+
+
+def test_reports_missing_file(root):
+    doc = create_document(root, "a.txt", b"hello world")
+    os.unlink(os.path.join(root, "files", "a.txt"))
+
+    errors, stat = verify_file(root, doc.files[0])
+
+    assert len(errors) == 1
+    assert errors[0].startswith("Missing file")
+    assert stat is None
+
+
+def test_hashes_each_file_once(root, monkeypatch):
+    documents = [create_document(root, f"{i}.txt", b"x" * i) for i in range(5)]
+    hashed = []
+
+    def fake_sha256(path):
+        hashed.append(path)
+        return "sha256:wrong"
+
+    monkeypatch.setattr(verification, "sha256", fake_sha256)
+
+    errors = verify_files(root, choose_files(root, documents), workers=2)
+
+    assert len(errors) == 5
+    assert sorted(hashed) == sorted(
+        os.path.join(root, "files", f"{i}.txt") for i in range(5)
+    )
+
+
+def test_only_stamps_good_files(root):
+    good = create_document(root, "good.txt", b"good")
+    bad = create_document(root, "bad.txt", b"bad")
+
+    with open(os.path.join(root, "files", "bad.txt"), "wb") as out_file:
+        out_file.write(b"BAD")
+
+    progress = []
+
+    errors = verify_files(
+        root, choose_files(root, [good, bad]), progress=lambda: progress.append(1)
+    )
+
+    assert list(errors) == [bad.files[0].id]
+    assert list(read_stamps(root)) == [good.files[0].id]
+    assert len(progress) == 2
+
+
+def test_changed_only_skips_files_verified_since_last_change(root):
+    unchanged = create_document(root, "unchanged.txt", b"unchanged")
+    modified = create_document(root, "modified.txt", b"modified")
+    new = create_document(root, "new.txt", b"new")
+
+    verify_files(root, choose_files(root, [unchanged, modified]))
+
+    path = os.path.join(root, "files", "modified.txt")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    chosen = choose_files(root, [unchanged, modified, new], changed_only=True)
+
+    assert chosen == [modified.files[0], new.files[0]]
+
+
+def test_failed_files_are_checked_again(root):
+    doc = create_document(root, "a.txt", b"hello world")
+    verify_files(root, doc.files)
+
+    with open(os.path.join(root, "files", "a.txt"), "wb") as out_file:
+        out_file.write(b"goodbye")
+
+    assert verify_files(root, choose_files(root, [doc], changed_only=True))
+    assert choose_files(root, [doc], changed_only=True) == doc.files
+
+
+@pytest.mark.parametrize("sample, expected_count", [(10, 1), (50, 5), (100, 10)])
+def test_sample_chooses_percentage_of_files(root, sample, expected_count):
+    documents = [create_document(root, f"{i}.txt", b"x") for i in range(10)]
+
+    chosen = choose_files(root, documents, sample=sample)
+
+    assert len(chosen) == expected_count
+    assert len({f.id for f in chosen}) == expected_count
+
+
+def test_scrub_checks_oldest_first(root, monkeypatch):
+    documents = [create_document(root, f"{i}.txt", b"x") for i in range(3)]
+    write_documents(root=root, documents=documents)
+
+    verify_files(root, documents[0].files)
+    verify_files(root, documents[2].files)
+
+    checked = [f for f, _ in scrub(root, bytes_per_second=1024**3)]
+
+    assert checked == [
+        documents[1].files[0],
+        documents[0].files[0],
+        documents[2].files[0],
+    ]
+
+    # Now they've all been checked, the next scrub starts with the file
+    # that was checked first in the last scrub.
+    checked = [f for f, _ in scrub(root, bytes_per_second=1024**3)]
+
+    assert checked[0] == documents[1].files[0]
+
+
+def test_interrupted_scrub_resumes_where_it_left_off(root):
+    documents = [create_document(root, f"{i}.txt", b"x") for i in range(4)]
+    write_documents(root=root, documents=documents)
+
+    first_scrub = scrub(root, bytes_per_second=1024**3)
+    checked_first = [next(first_scrub)[0], next(first_scrub)[0]]
+    first_scrub.close()
+
+    checked_second = [f for f, _ in scrub(root, bytes_per_second=1024**3)]
+
+    assert not any(f in checked_first for f in checked_second[:2])
+    assert checked_second[2:] == checked_first
+
+
+def test_scrub_records_errors(root):
+    doc = create_document(root, "a.txt", b"hello world")
+    write_documents(root=root, documents=[doc])
+    verify_files(root, doc.files)
+
+    os.unlink(os.path.join(root, "files", "a.txt"))
+
+    ((f, errors),) = scrub(root, bytes_per_second=1024**3)
+
+    assert errors[0].startswith("Missing file")
+    assert read_stamps(root) == {}
+
+
+def test_scrub_keeps_stamps_from_a_concurrent_verify(root):
+    documents = [create_document(root, f"{i}.txt", b"x") for i in range(3)]
+    write_documents(root=root, documents=documents[:2])
+
+    running_scrub = scrub(root, bytes_per_second=1024**3)
+    next(running_scrub)
+
+    # While the scrub is running, somebody stores and verifies a new file
+    write_documents(root=root, documents=documents)
+    verify_files(root, documents[2].files)
+
+    for _ in running_scrub:
+        pass
+
+    assert set(read_stamps(root)) == {doc.files[0].id for doc in documents}
+
+
+def test_byte_budget_sleeps_when_ahead(monkeypatch):
+    now = [100.0]
+    sleeps = []
+
+    monkeypatch.setattr(verification.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(verification.time, "sleep", sleeps.append)
+
+    budget = ByteBudget(bytes_per_second=1000)
+
+    budget.spend(500)
+    assert sleeps == [0.5]
+
+    now[0] = 102.0
+    budget.spend(500)
+    assert sleeps == [0.5]
+
+
+def test_scrub_coverage(root):
+    documents = [create_document(root, f"{i}.txt", b"x" * 10) for i in range(4)]
+    verify_files(root, documents[0].files + documents[1].files)
+
+    now = datetime.datetime.now()
+    coverage = scrub_coverage(
+        root, documents, now=now, window=datetime.timedelta(days=7)
+    )
+
+    assert coverage.total_files == 4
+    assert coverage.total_bytes == 40
+    assert coverage.checked_files == 2
+    assert coverage.ratio == 0.5
+    assert coverage.failed_files == 0
+    assert coverage.oldest_check is None
+
+    # A week later, none of those checks count
+    coverage = scrub_coverage(
+        root,
+        documents[:2],
+        now=now + datetime.timedelta(days=8),
+        window=datetime.timedelta(days=7),
+    )
+
+    assert coverage.ratio == 0
+    assert coverage.oldest_check <= now
+
+
+def test_empty_store_is_fully_covered(root):
+    coverage = scrub_coverage(
+        root, [], now=datetime.datetime.now(), window=datetime.timedelta(days=7)
+    )
+
+    assert coverage.ratio == 1
+    assert coverage.oldest_check is None